@@ -1,8 +1,9 @@
 from django.contrib import admin
 
-from .models import Mail, MailProvider, TrackedMailSender, User
+from .models import Mail, MailProvider, MailSyncState, TrackedMailSender, User
 
 admin.site.register(Mail)
+admin.site.register(MailSyncState)
 admin.site.register(MailProvider)
 admin.site.register(User)
 admin.site.register(TrackedMailSender)
@@ -1,9 +1,19 @@
 import base64
+import hashlib
+import os
+import threading
+import time
+from functools import cached_property
 
 import rsa
 from api.encrypt.base import AbstractEncryptionService
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from django.conf import settings
 
+ENVELOPE_VERSION = "v1"
+DATA_KEY_BYTES = 32
+NONCE_BYTES = 12
+
 
 class EncryptionService(AbstractEncryptionService):
     """
@@ -11,8 +21,88 @@ class EncryptionService(AbstractEncryptionService):
 
     Реализует два основных метода `encrypt()` и `decrypt()`,
     унаследованных от абстрактного базового класса `AbstractEncryptionService`.
+
+    Пароли шифруются конвертом: AES-GCM с ключом данных, который сам зашифрован
+    открытым RSA-ключом и хранится рядом с шифром в формате
+    v1:<id RSA-ключа>:<ключ данных>:<nonce>:<шифр>. Один ключ данных используется
+    процессом для data_key_uses паролей, поэтому RSA-расшифровка нужна один раз
+    на ключ данных, а не на каждый пароль. Шифры старого формата (RSA без конверта)
+    и шифры прежних RSA-ключей из OLD_PRIVATE_KEYS по-прежнему расшифровываются.
+
+    Ключи разбираются один раз за время жизни процесса. Расшифрованные пароли
+    хранятся в памяти процесса не дольше cache_ttl секунд, ключом служит хэш шифра.
+    Хэш шифра и есть механизм инвалидации: новый пароль получает новый шифр
+    и никогда не берется из кэша, поэтому кэши воркеров не нужно очищать
+    при изменении или удалении ящика в процессе api.
+
+    :param cache_ttl: float - время хранения расшифрованного пароля в секундах, 0 - не хранить
+    :param cache_size: int - число паролей в кэше, после которого удаляются устаревшие
+    :param envelope: bool - шифровать конвертом, False - только RSA (прежний формат)
+    :param data_key_uses: int - число паролей, шифруемых одним ключом данных
     """
 
+    def __init__(
+        self,
+        cache_ttl: float = settings.PASSWORD_CACHE_TTL_SEC,
+        cache_size: int = 10000,
+        envelope: bool = settings.ENCRYPTION_ENVELOPE,
+        data_key_uses: int = 100000,
+    ) -> None:
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.envelope = envelope
+        self.data_key_uses = data_key_uses
+        self._cache: dict[str, tuple[str, float]] = dict()
+        self._data_keys: dict[str, bytes] = dict()
+        self._data_key: tuple[bytes, str] | None = None
+        self._data_key_used = 0
+        self._lock = threading.Lock()
+
+    @cached_property
+    def public_key(self) -> rsa.PublicKey:
+        """Открытый ключ из настроек проекта"""
+        key = self._format_key(
+            key=settings.PUBLIC_KEY,
+            prefix=settings.PUBLIC_KEY_PREFIX,
+            suffix=settings.PUBLIC_KEY_SUFFIX,
+        )
+        return rsa.PublicKey.load_pkcs1_openssl_pem(key)
+
+    @cached_property
+    def private_key(self) -> rsa.PrivateKey:
+        """Закрытый ключ из настроек проекта"""
+        key = self._format_key(
+            key=settings.PRIVATE_KEY,
+            prefix=settings.PRIVATE_KEY_PREFIX,
+            suffix=settings.PRIVATE_KEY_SUFFIX,
+        )
+        return rsa.PrivateKey.load_pkcs1(key, format="PEM")
+
+    @cached_property
+    def private_keys(self) -> dict[str, rsa.PrivateKey]:
+        """Закрытые ключи по их id: текущий и прежние из OLD_PRIVATE_KEYS"""
+        keys = [self.private_key] + [
+            rsa.PrivateKey.load_pkcs1(
+                self._format_key(
+                    key=key,
+                    prefix=settings.PRIVATE_KEY_PREFIX,
+                    suffix=settings.PRIVATE_KEY_SUFFIX,
+                ),
+                format="PEM",
+            )
+            for key in settings.OLD_PRIVATE_KEYS
+        ]
+        return {self._key_id(key.n, key.e): key for key in keys}
+
+    @cached_property
+    def key_id(self) -> str:
+        """Идентификатор текущего RSA-ключа"""
+        return self._key_id(self.public_key.n, self.public_key.e)
+
+    @staticmethod
+    def _key_id(n: int, e: int) -> str:
+        return hashlib.sha256(f"{n}:{e}".encode()).hexdigest()[:16]
+
     @staticmethod
     def _format_key(key: str, prefix: str, suffix: str) -> bytes:
         """
@@ -57,29 +147,146 @@ class EncryptionService(AbstractEncryptionService):
         :param password: Строка, представляющая пароль в открытом виде.
         :return: Объект str, представляющий зашифрованный пароль.
         """
-        key = self._format_key(
-            key=settings.PUBLIC_KEY,
-            prefix=settings.PUBLIC_KEY_PREFIX,
-            suffix=settings.PUBLIC_KEY_SUFFIX,
+        if not self.envelope:
+            crypto = rsa.encrypt(self._encode(password), self.public_key)
+            return base64.b64encode(crypto).decode("utf-8")
+
+        data_key, wrapped_key = self._next_data_key()
+        header = f"{ENVELOPE_VERSION}:{self.key_id}:{wrapped_key}"
+        nonce = os.urandom(NONCE_BYTES)
+        crypto = AESGCM(data_key).encrypt(
+            nonce, self._encode(password), header.encode()
         )
-        password = self._encode(password)  # type: ignore
-        public = rsa.PublicKey.load_pkcs1_openssl_pem(key)
-        crypto = rsa.encrypt(password, public)
-        return base64.b64encode(crypto).decode("utf-8")
+        return ":".join(
+            (header, self._b64(nonce), self._b64(crypto)),
+        )
+
+    def _next_data_key(self) -> tuple[bytes, str]:
+        """
+        Возвращает ключ данных процесса и его RSA-шифр, создавая новый
+        после data_key_uses использований.
+        """
+        with self._lock:
+            if self._data_key is None or self._data_key_used >= self.data_key_uses:
+                data_key = AESGCM.generate_key(bit_length=DATA_KEY_BYTES * 8)
+                wrapped_key = self._b64(rsa.encrypt(data_key, self.public_key))
+                self._data_key = (data_key, wrapped_key)
+                self._data_keys[wrapped_key] = data_key
+                self._data_key_used = 0
+            self._data_key_used += 1
+            return self._data_key
+
+    @staticmethod
+    def _b64(data: bytes) -> str:
+        return base64.b64encode(data).decode("ascii")
+
+    def is_current(self, password: bytes | str) -> bool:
+        """
+        Проверяет, зашифрован ли пароль в текущем формате текущим RSA-ключом.
+
+        :param password: Шифр пароля.
+        :return: False, если пароль нужно перешифровать.
+        """
+        if isinstance(password, bytes):
+            password = password.decode("ascii")
+        if not self.envelope:
+            return not password.startswith(f"{ENVELOPE_VERSION}:")
+        return password.startswith(f"{ENVELOPE_VERSION}:{self.key_id}:")
+
+    def reencrypt(self, password: bytes | str) -> str:
+        """
+        Перешифровывает пароль в текущем формате текущим RSA-ключом.
+
+        :param password: Шифр пароля.
+        :return: Объект str, представляющий зашифрованный пароль.
+        """
+        if isinstance(password, str):
+            password = password.encode("ascii")
+        return self.encrypt(self._decrypt(password))
 
     def decrypt(self, password: bytes) -> str:
         """
         Расшифровывает пароль и возвращает его в виде строки.
+        Повторная расшифровка того же шифра в пределах cache_ttl берется из кэша.
 
         :param password: Объект bytes, представляющий зашифрованный пароль.
         :return: Строка, представляющая расшифрованный пароль.
         """
-        key = self._format_key(
-            key=settings.PRIVATE_KEY,
-            prefix=settings.PRIVATE_KEY_PREFIX,
-            suffix=settings.PRIVATE_KEY_SUFFIX,
-        )
-        private = rsa.PrivateKey.load_pkcs1(key, format="PEM")
+        if not self.cache_ttl:
+            return self._decrypt(password)
+
+        key = self._cache_key(password)
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        plain = self._decrypt(password)
+        with self._lock:
+            if len(self._cache) >= self.cache_size:
+                self._prune(now)
+            self._cache[key] = (plain, now + self.cache_ttl)
+        return plain
+
+    def _decrypt(self, password: bytes) -> str:
+        """
+        Расшифровывает пароль закрытым ключом без использования кэша.
+        """
+        if password.startswith(f"{ENVELOPE_VERSION}:".encode()):
+            return self._decrypt_envelope(password.decode("ascii"))
+
         crypto = base64.b64decode(password)
-        password = rsa.decrypt(crypto, private)
-        return self._decode(password)
+        error: rsa.DecryptionError | None = None
+        for private_key in self.private_keys.values():
+            try:
+                return self._decode(rsa.decrypt(crypto, private_key))
+            except rsa.DecryptionError as err:
+                error = err
+        raise error  # type: ignore
+
+    def _decrypt_envelope(self, password: str) -> str:
+        """
+        Расшифровывает пароль в формате конверта.
+        """
+        version, key_id, wrapped_key, nonce, crypto = password.split(":")
+        data_key = self._data_keys.get(wrapped_key)
+        if data_key is None:
+            private_key = self.private_keys.get(key_id)
+            if private_key is None:
+                raise rsa.DecryptionError(f"Unknown encryption key {key_id}")
+            data_key = rsa.decrypt(base64.b64decode(wrapped_key), private_key)
+            with self._lock:
+                if len(self._data_keys) >= self.cache_size:
+                    self._data_keys.clear()
+                self._data_keys[wrapped_key] = data_key
+        plain = AESGCM(data_key).decrypt(
+            base64.b64decode(nonce),
+            base64.b64decode(crypto),
+            f"{version}:{key_id}:{wrapped_key}".encode(),
+        )
+        return self._decode(plain)
+
+    @staticmethod
+    def _cache_key(password: bytes | str) -> str:
+        if isinstance(password, str):
+            password = password.encode()
+        return hashlib.sha256(password).hexdigest()
+
+    def _prune(self, now: float) -> None:
+        expired = [key for key, (_, expires) in self._cache.items() if expires <= now]
+        for key in expired:
+            del self._cache[key]
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+
+    def forget(self, password: bytes | str | None = None) -> None:
+        """
+        Удаляет из кэша расшифрованный пароль для шифра password или весь кэш.
+
+        :param password: Шифр пароля, None - очистить весь кэш.
+        """
+        with self._lock:
+            if password is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(self._cache_key(password), None)
@@ -0,0 +1,57 @@
+# Generated by Django 4.1.7 on 2026-10-17 13:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MailSyncState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "uid_validity",
+                    models.BigIntegerField(
+                        blank=True, null=True, verbose_name="UIDVALIDITY папки"
+                    ),
+                ),
+                (
+                    "last_uid",
+                    models.BigIntegerField(
+                        default=0, verbose_name="Последний обработанный UID"
+                    ),
+                ),
+                (
+                    "last_checked_at",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="Время последней проверки"
+                    ),
+                ),
+                (
+                    "mail",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="sync_state",
+                        to="api.mail",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Состояние синхронизации",
+                "verbose_name_plural": "Состояния синхронизации",
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.1.7 on 2026-10-17 14:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0002_mailsyncstate"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="plain_text_mode",
+            field=models.CharField(
+                choices=[
+                    ("browser", "Скриншот браузером"),
+                    ("image", "Изображение текста без браузера"),
+                    ("message", "Текстовое сообщение"),
+                ],
+                default="browser",
+                max_length=16,
+                verbose_name="Отображение текстовых писем",
+            ),
+        ),
+    ]
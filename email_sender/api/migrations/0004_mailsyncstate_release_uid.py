@@ -0,0 +1,21 @@
+# Generated by Django 4.1.7 on 2026-10-17 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0003_user_plain_text_mode"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mailsyncstate",
+            name="release_uid",
+            field=models.BigIntegerField(
+                blank=True,
+                null=True,
+                verbose_name="Первый возвращенный в непрочитанные UID",
+            ),
+        ),
+    ]
@@ -1,11 +1,16 @@
 from django.db import models
 
-__all__ = ("User", "MailProvider", "Mail", "TrackedMailSender")
+__all__ = ("User", "MailProvider", "Mail", "MailSyncState", "TrackedMailSender")
 
 
 class User(models.Model):
     """Модель пользователя."""
 
+    class PlainTextMode(models.TextChoices):
+        BROWSER = "browser", "Скриншот браузером"
+        IMAGE = "image", "Изображение текста без браузера"
+        MESSAGE = "message", "Текстовое сообщение"
+
     tg_id = models.BigIntegerField(unique=True, verbose_name="Идентификатор в телеграм")
     first_name = models.CharField(max_length=150, verbose_name="Имя")
     second_name = models.CharField(
@@ -14,6 +19,12 @@ class User(models.Model):
     registered_at = models.DateTimeField(
         auto_now_add=True, verbose_name="Дата регистрации"
     )
+    plain_text_mode = models.CharField(
+        max_length=16,
+        choices=PlainTextMode.choices,
+        default=PlainTextMode.BROWSER,
+        verbose_name="Отображение текстовых писем",
+    )
 
     def __str__(self) -> str:
         return f"{self.tg_id}"
@@ -59,13 +70,43 @@ class Mail(models.Model):
         verbose_name = "Почта"
 
     def to_json(self) -> dict:
+        sync_state: MailSyncState | None = getattr(self, "sync_state", None)
         return {
             "email": self.email,
             "password": self.password,
             "provider": self.provider.to_json(),
+            "uid_validity": sync_state.uid_validity if sync_state else None,
+            "last_uid": sync_state.last_uid if sync_state else 0,
         }
 
 
+class MailSyncState(models.Model):
+    """Модель состояния синхронизации папки INBOX почтового ящика."""
+
+    mail = models.OneToOneField(
+        "Mail", on_delete=models.CASCADE, related_name="sync_state"
+    )
+    uid_validity = models.BigIntegerField(
+        null=True, blank=True, verbose_name="UIDVALIDITY папки"
+    )
+    last_uid = models.BigIntegerField(
+        default=0, verbose_name="Последний обработанный UID"
+    )
+    last_checked_at = models.DateTimeField(
+        null=True, blank=True, verbose_name="Время последней проверки"
+    )
+    release_uid = models.BigIntegerField(
+        null=True, blank=True, verbose_name="Первый возвращенный в непрочитанные UID"
+    )
+
+    def __str__(self) -> str:
+        return f"{self.mail}:{self.uid_validity}:{self.last_uid}"
+
+    class Meta:
+        verbose_name_plural = "Состояния синхронизации"
+        verbose_name = "Состояние синхронизации"
+
+
 class TrackedMailSender(models.Model):
     """Модель отправителя."""
 
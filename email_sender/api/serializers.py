@@ -15,7 +15,7 @@ class UserSerializer(ModelSerializer):
 
     class Meta:
         model = User
-        fields = ("id", "tg_id", "first_name", "second_name")
+        fields = ("id", "tg_id", "first_name", "second_name", "plain_text_mode")
 
     def _get_user_second_name(self, user: User) -> bool:
         """
@@ -189,7 +189,7 @@ class UserCreateSerializer(ModelSerializer):
 
     class Meta:
         model = User
-        fields = ("first_name", "second_name")
+        fields = ("first_name", "second_name", "plain_text_mode")
 
 
 class MailCreateSerializer(MailSerializer):
@@ -11,6 +11,7 @@ class AbstractUserService(abc.ABC):
     Определяет абстрактные методы, которые должны быть реализованы в подклассах:
     `get_user()`,
     `create_user()`,
+    `update_user()`,
     `get_senders()`,
     `get_mails()`,
     `connect_sender()`,
@@ -35,6 +36,15 @@ class AbstractUserService(abc.ABC):
         :return: Объект ответа.
         """
 
+    @abc.abstractmethod
+    def update_user(self, request: Request) -> Response:
+        """
+        Изменяет данные и настройки пользователя.
+
+        :param request: Объект запроса с изменяемыми полями.
+        :return: Объект ответа.
+        """
+
     @abc.abstractmethod
     def get_senders(self, request: Request) -> Response:
         """
@@ -26,6 +26,7 @@ class UserService(AbstractUserService):
     Реализует основные методы -
     `create_user()`,
     `get_user()`,
+    `update_user()`,
     `get_senders()`,
     `get_mails()`,
     `connect_sender()`,
@@ -83,6 +84,21 @@ class UserService(AbstractUserService):
             serialized_user = UserSerializer(user)
             return Response(serialized_user.data, status=status.HTTP_200_OK)
 
+    def update_user(self, request: Request) -> Response:
+        """
+        Изменяет данные и настройки пользователя, например отображение текстовых писем.
+
+        :param request: Объект запроса с изменяемыми полями.
+        :return: Объект ответа.
+        """
+        if token := self._authenticate_user(request):
+            user = self._get_user(token)
+            serialized_user = UserSerializer(user, data=request.data, partial=True)
+            if serialized_user.is_valid():
+                serialized_user.save()
+                return Response(serialized_user.data, status=status.HTTP_200_OK)
+            return Response(serialized_user.errors, status=status.HTTP_400_BAD_REQUEST)
+
     def _setup_paginator(self) -> PageNumberPagination:
         """
         Создает и настраивает объект пагинации.
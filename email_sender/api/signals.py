@@ -1,13 +1,16 @@
 from api.encrypt import encryption_service
-from api.models import Mail, User
-from app_celery.tasks import create_periodic_task
-from django.db.models.signals import post_save, pre_save
+from api.models import Mail, MailProvider, TrackedMailSender, User
+from app_celery.tasks import SCHEDULER_PER_USER, create_periodic_task, refresh_user
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
 
 @receiver(post_save, sender=User)
 def create_task(sender, **kwargs):
-    if kwargs.get("created"):
+    # в режиме sharded пользователь проверяется задачей своего шарда
+    if kwargs.get("created") and settings.SCHEDULER_MODE == SCHEDULER_PER_USER:
         tg_id = kwargs.get("instance").tg_id
         create_periodic_task(tg_id)
 
@@ -17,6 +20,37 @@ def encrypt_pass(sender, instance: Mail, **kwargs):
     if instance.pk is None:
         instance.password = encryption_service.encrypt(password=instance.password)
 
+
+@receiver(post_save, sender=Mail)
+@receiver(post_delete, sender=Mail)
+@receiver(post_save, sender=TrackedMailSender)
+@receiver(post_delete, sender=TrackedMailSender)
+def refresh_user_snapshot(sender, instance: Mail | TrackedMailSender, **kwargs):
+    users = User.objects.filter(pk=instance.user_id)
+    refresh_users(list(users.values_list("tg_id", flat=True)))
+
+
+@receiver(post_save, sender=MailProvider)
+def refresh_provider_users(sender, instance: MailProvider, **kwargs):
+    users = User.objects.filter(mail__provider=instance).distinct()
+    refresh_users(list(users.values_list("tg_id", flat=True)))
+
+
+@receiver(post_save, sender=User)
+def refresh_user_settings(sender, instance: User, **kwargs):
+    # снимок содержит настройки пользователя, например отображение текстовых писем
+    if not kwargs.get("created"):
+        refresh_users([instance.tg_id])
+
+
+def refresh_users(tg_ids: list[int]) -> None:
+    # снимки пересобираются после фиксации транзакции, чтобы не прочитать отмененные изменения
+    def refresh() -> None:
+        for tg_id in tg_ids:
+            refresh_user(tg_id)
+
+    transaction.on_commit(refresh)
+
 from django.views.generic import CreateView, UpdateView, DeleteView, ListView, DetailView, View
 from rest_framework.views import APIView, View, ViewSet, GenericViewSet
 from rest_framework.generics import ListAPIView, CreateAPIView, RetrieveAPIView, UpdateAPIView, DestroyAPIView
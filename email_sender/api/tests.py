@@ -42,6 +42,21 @@ class UserApiTest(APITransactionTestCase):
         response = self.client.get(self.url, **headers)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_update_plain_text_mode(self):
+        """Тестируем изменение отображения текстовых писем и отклонение неизвестного режима."""
+        User.objects.create(tg_id=123123, first_name="user")
+
+        response = self.client.patch(
+            self.url, {"plain_text_mode": "message"}, **self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(User.objects.get().plain_text_mode, "message")
+
+        response = self.client.patch(
+            self.url, {"plain_text_mode": "fax"}, **self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_without_headers(self):
         """Тестируем что без идентификатора пользователя в заголовках выдается верный статус код."""
         response = self.client.get(self.url)
@@ -8,7 +8,9 @@ from .views.senders import SendersListView
 urlpatterns = [
     path(
         "users/",
-        users.UsersViewSet.as_view({"get": "retrieve", "post": "create"}),
+        users.UsersViewSet.as_view(
+            {"get": "retrieve", "post": "create", "patch": "partial_update"}
+        ),
         name="users_view",
     ),
     path(
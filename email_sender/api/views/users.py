@@ -6,7 +6,7 @@ from rest_framework.request import Request
 
 
 class UsersViewSet(ViewSet):
-    http_method_names = ("get", "post")
+    http_method_names = ("get", "post", "patch")
 
     @extend_schema(request=UserCreateSerializer, responses=UserSerializer)
     async def create(self, request: Request):
@@ -25,3 +25,12 @@ class UsersViewSet(ViewSet):
         :return: Объект ответа.
         """
         return user_service.get_user(request)
+
+    @extend_schema(request=UserCreateSerializer, responses=UserSerializer)
+    async def partial_update(self, request: Request):
+        """
+        Метод для изменения данных и настроек пользователя.
+        :param request: Объект запроса.
+        :return: Объект ответа.
+        """
+        return user_service.update_user(request)
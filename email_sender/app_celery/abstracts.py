@@ -35,7 +35,7 @@ class AbstractMailService(ABC):
 
     @abstractmethod
     async def generate_screenshot(
-        self, content: str, folder_name: str, msg_id: int
+        self, content: str, folder_name: str, msg_id: int, caption: str | None = None
     ) -> None:
         """
         Метод получения скриншота сообщений
@@ -43,6 +43,7 @@ class AbstractMailService(ABC):
         :param content: Тело сообщения в виде html-страницы для визуализации в браузере
         :param folder_name: имя директории в виде email-адреса получателя, куда будут сохраняться скриншоты
         :param msg_id: int - id сообщения для скриншота
+        :param caption: str - подпись скриншота с отправителем и получателем письма
         """
 
     @abstractmethod
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AppCeleryConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "app_celery"
+
+    def ready(self):
+        from app_celery import signals
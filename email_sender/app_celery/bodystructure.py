@@ -0,0 +1,306 @@
+import base64
+import re
+from dataclasses import dataclass, field
+from email.message import Message
+from itertools import takewhile
+from typing import Any
+
+LITERAL = re.compile(rb"\{(?P<size>\d+)\}$")
+LITERAL_START = re.compile(rb"\{(?P<size>\d+)\}\r\n")
+ATOM_END = frozenset(b' ()"\r\n')
+
+
+@dataclass
+class BodyPart:
+    """
+    Часть письма из ответа BODYSTRUCTURE, которая не является multipart.
+
+    :param section: str - номер части для BODY[section], например 1.2
+    :param maintype: str - основной тип содержимого, например text
+    :param subtype: str - подтип содержимого, например html
+    :param size: int - размер части в байтах в кодировке передачи
+    """
+
+    section: str
+    maintype: str
+    subtype: str
+    size: int = 0
+    encoding: str = "7bit"
+    params: dict[str, str] = field(default_factory=dict)
+    content_id: str | None = None
+    disposition: str | None = None
+    filename: str | None = None
+
+    @property
+    def content_type(self) -> str:
+        return f"{self.maintype}/{self.subtype}"
+
+    @property
+    def is_attachment(self) -> bool:
+        return self.disposition == "attachment" or (
+            self.filename is not None and self.content_id is None
+        )
+
+
+def join_literals(lines: list) -> bytes:
+    """
+    Восстанавливает ответ сервера из строк aioimaplib, в которых литералы {n}
+    вынесены в отдельные элементы списка. Последняя строка ответа (статус команды)
+    должна быть исключена вызывающей стороной.
+    """
+    chunks: list[bytes] = list()
+    literal_next = False
+    for line in lines:
+        if not isinstance(line, (bytes, bytearray)):
+            continue
+        chunks.append(bytes(line))
+        if literal_next:
+            literal_next = False
+        elif LITERAL.search(line):
+            chunks.append(b"\r\n")
+            literal_next = True
+    return b"".join(chunks)
+
+
+def parse_list(data: bytes) -> list:
+    """
+    Разбирает данные ответа imap-сервера в дерево списков.
+    Атомы и строки возвращаются как bytes, NIL - как None.
+
+    :param data: bytes - ответ сервера
+    :return: list - элементы верхнего уровня
+    """
+    stack: list[list] = [[]]
+    pos = 0
+    while pos < len(data):
+        char = data[pos]
+        if char in b" \r\n":
+            pos += 1
+        elif char == ord("("):
+            stack.append([])
+            pos += 1
+        elif char == ord(")"):
+            if len(stack) == 1:
+                raise ValueError(f"Unbalanced parenthesis at {pos}")
+            item = stack.pop()
+            stack[-1].append(item)
+            pos += 1
+        elif char == ord('"'):
+            end = pos + 1
+            value = bytearray()
+            while end < len(data) and data[end] != ord('"'):
+                if data[end] == ord("\\"):
+                    end += 1
+                    if end >= len(data):
+                        raise ValueError(f"Unterminated string at {pos}")
+                value.append(data[end])
+                end += 1
+            if end >= len(data):
+                raise ValueError(f"Unterminated string at {pos}")
+            stack[-1].append(bytes(value))
+            pos = end + 1
+        elif (match := LITERAL_START.match(data, pos)) is not None:
+            start = match.end()
+            size = int(match.group("size"))
+            stack[-1].append(data[start : start + size])  # noqa: E203
+            pos = start + size
+        else:
+            end = pos
+            while end < len(data) and data[end] not in ATOM_END:
+                end += 1
+            atom = data[pos:end]
+            stack[-1].append(None if atom.upper() == b"NIL" else atom)
+            pos = end
+    if len(stack) != 1:
+        raise ValueError("Unbalanced parenthesis")
+    return stack[0]
+
+
+def parse_fetch_all(lines: list) -> dict[int, dict[str, Any]]:
+    """
+    Разбирает ответ на UID FETCH в словарь {uid письма: {элемент данных: значение}}.
+    Ответы FETCH без UID (например, уведомления об изменении флагов) пропускаются.
+
+    :param lines: строки ответа aioimaplib без строки статуса
+    :return: dict - например {5: {"UID": b"5", "BODY[1]": b"..."}}
+    """
+    items = parse_list(join_literals(lines))
+    result: dict[int, dict[str, Any]] = dict()
+    for i, item in enumerate(items[:-1]):
+        if item != b"FETCH" or not isinstance(items[i + 1], list):
+            continue
+        data = items[i + 1]
+        message = {
+            _str(key).upper(): value for key, value in zip(data[::2], data[1::2])
+        }
+        uid = _str(message.get("UID"))
+        if uid.isdigit():
+            result.setdefault(int(uid), dict()).update(message)
+    return result
+
+
+def _str(value: Any) -> str:
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode(errors="replace")
+    return ""
+
+
+def _params(value: Any) -> dict[str, str]:
+    if not isinstance(value, list):
+        return dict()
+    return {_str(key).lower(): _str(val) for key, val in zip(value[::2], value[1::2])}
+
+
+def _walk(node: list, section: str, parts: list[BodyPart]) -> None:
+    if not node:
+        raise ValueError("Empty body structure")
+    if isinstance(node[0], list):
+        # после дочерних частей следуют подтип multipart и необязательные расширения
+        children = takewhile(lambda child: isinstance(child, list), node)
+        for number, child in enumerate(children, start=1):
+            _walk(child, f"{section}.{number}" if section else str(number), parts)
+        return
+
+    maintype, subtype = _str(node[0]).lower(), _str(node[1]).lower()
+    params = _params(node[2])
+    if maintype == "text":
+        extension = 8
+    elif (maintype, subtype) == ("message", "rfc822"):
+        extension = 10
+    else:
+        extension = 7
+    disposition: str | None = None
+    disposition_params: dict[str, str] = dict()
+    if len(node) > extension + 1 and isinstance(node[extension + 1], list):
+        disposition_data = node[extension + 1] + [None, None]
+        disposition = _str(disposition_data[0]).lower() or None
+        disposition_params = _params(disposition_data[1])
+    content_id = _str(node[3]).strip("<>") or None
+    parts.append(
+        BodyPart(
+            section=section or "1",
+            maintype=maintype,
+            subtype=subtype,
+            size=int(_str(node[6]) or 0),
+            encoding=_str(node[5]).lower() or "7bit",
+            params=params,
+            content_id=content_id,
+            disposition=disposition,
+            filename=disposition_params.get("filename") or params.get("name"),
+        )
+    )
+
+
+def parse_bodystructure(structure: list) -> list[BodyPart]:
+    """
+    Возвращает список частей письма (кроме multipart) из разобранного BODYSTRUCTURE.
+    Вложенные письма message/rfc822 не раскрываются.
+
+    :param structure: list - значение BODYSTRUCTURE из parse_fetch_all
+    """
+    parts: list[BodyPart] = list()
+    _walk(structure, "", parts)
+    return parts
+
+
+def select_parts(
+    parts: list[BodyPart], max_bytes: int
+) -> tuple[BodyPart | None, list[BodyPart]]:
+    """
+    Выбирает часть письма для рендера и встроенные в нее изображения.
+    Предпочтение отдается text/html, затем text/plain. Изображения с Content-ID
+    добавляются по порядку, пока их суммарный размер вместе с текстом не превышает max_bytes.
+
+    :param parts: части письма из parse_bodystructure
+    :param max_bytes: int - бюджет байт на письмо, 0 - без ограничения
+    :return: tuple - (текстовая часть или None, список изображений)
+    """
+    texts = [
+        part for part in parts if part.maintype == "text" and not part.is_attachment
+    ]
+    text = next((part for part in texts if part.subtype == "html"), None) or next(
+        (part for part in texts if part.subtype == "plain"), None
+    )
+    if text is None:
+        return None, list()
+
+    budget = max_bytes - text.size if max_bytes else None
+    images: list[BodyPart] = list()
+    if text.subtype != "html":
+        return text, images
+    for part in parts:
+        if part.maintype != "image" or part.content_id is None:
+            continue
+        if budget is not None:
+            if part.size > budget:
+                continue
+            budget -= part.size
+        images.append(part)
+    return text, images
+
+
+def decode_part(part: BodyPart, payload: bytes) -> bytes:
+    """
+    Декодирует содержимое части письма из кодировки передачи (base64, quoted-printable)
+    """
+    message = Message()
+    message["Content-Transfer-Encoding"] = part.encoding
+    message.set_payload(payload)
+    return message.get_payload(decode=True)
+
+
+def decode_text(part: BodyPart, payload: bytes) -> str:
+    """
+    Декодирует текстовую часть письма с учетом ее кодировки
+    """
+    data = decode_part(part, payload)
+    try:
+        return data.decode(part.params.get("charset") or "utf-8", errors="replace")
+    except LookupError:
+        return data.decode(errors="replace")
+
+
+def message_images(message: Message) -> list[tuple[BodyPart, bytes]]:
+    """
+    Встроенные изображения cid: письма, загруженного целиком, в формате inline_images
+
+    :param message: Message - разобранное письмо
+    :return: список пар (часть письма, содержимое в base64)
+    """
+    images: list[tuple[BodyPart, bytes]] = list()
+    for part in message.walk():
+        content_id = (part.get("Content-ID") or "").strip().strip("<>")
+        if part.get_content_maintype() != "image" or not content_id:
+            continue
+        part_body = BodyPart(
+            section="",
+            maintype="image",
+            subtype=part.get_content_subtype(),
+            encoding="base64",
+            content_id=content_id,
+        )
+        images.append(
+            (part_body, base64.b64encode(part.get_payload(decode=True) or b""))
+        )
+    return images
+
+
+def inline_images(template: str, images: list[tuple[BodyPart, bytes]]) -> str:
+    """
+    Заменяет ссылки cid: в шаблоне письма на data URI с содержимым изображений
+
+    :param template: str - html письма
+    :param images: список пар (часть письма, содержимое в кодировке передачи)
+    """
+    for part, payload in images:
+        if part.encoding == "base64":
+            encoded = re.sub(rb"\s+", b"", payload)
+        else:
+            encoded = base64.b64encode(decode_part(part, payload))
+        template = re.sub(
+            f"cid:{re.escape(part.content_id or '')}",
+            f"data:{part.content_type};base64,{encoded.decode()}",
+            template,
+            flags=re.IGNORECASE,
+        )
+    return template
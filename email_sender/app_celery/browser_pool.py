@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import os
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from app_celery.metrics import metrics
+from django.conf import settings
+from playwright.async_api import Browser, Page, Playwright, async_playwright
+
+RENDERS_BUCKETS: tuple[float, ...] = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+@dataclass
+class PooledBrowser:
+    """Запущенный экземпляр браузера, его процесс и число выполненных им рендеров"""
+
+    browser: Browser
+    renders: int = 0
+    pid: int | None = None
+
+
+def child_pids(pid: int) -> list[int]:
+    """
+    Непосредственные дочерние процессы процесса pid по /proc/<pid>/task/*/children.
+    Без /proc возвращает пустой список.
+    """
+    children: list[int] = list()
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return children
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children", "rb") as children_file:
+                children.extend(int(child) for child in children_file.read().split())
+        except OSError:
+            continue
+    return children
+
+
+def descendant_pids(pid: int) -> set[int]:
+    """
+    Все потомки процесса pid, без самого процесса
+    """
+    descendants: set[int] = set()
+    stack = child_pids(pid)
+    while stack:
+        child = stack.pop()
+        if child not in descendants:
+            descendants.add(child)
+            stack.extend(child_pids(child))
+    return descendants
+
+
+def rss_mb(pids: set[int]) -> float:
+    """
+    Суммарная резидентная память (RSS, МБ) процессов pids по /proc/<pid>/statm
+    """
+    pages = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm", "rb") as statm_file:
+                pages += int(statm_file.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def process_tree_rss_mb(pid: int) -> float:
+    """
+    Резидентная память (RSS, МБ) процесса pid и всех его потомков,
+    например главного процесса браузера и его процессов содержимого
+    """
+    return rss_mb({pid} | descendant_pids(pid))
+
+
+def children_rss_mb() -> float:
+    """
+    Суммарная резидентная память (RSS, МБ) всех дочерних процессов текущего процесса:
+    драйвера playwright и запущенных им браузеров. Работает только при наличии /proc,
+    в остальных случаях возвращает 0.
+    """
+    return rss_mb(descendant_pids(os.getpid()))
+
+
+class BrowserPool:
+    """
+    Пул браузеров Firefox, общий для процесса воркера.
+
+    Браузеры запускаются лениво при первом рендере и переиспользуются между письмами:
+    для каждого рендера создается отдельный контекст (изолированные cookies, кэш, хранилище),
+    который закрывается сразу после снятия скриншота.
+    Браузер перезапускается после max_renders рендеров или если его процессы
+    заняли больше max_memory_mb мегабайт. Память считается только по дереву процессов
+    этого браузера и читается в потоке, чтобы не блокировать событийный цикл.
+
+    :param size: int - максимальное число одновременно запущенных браузеров
+    :param max_renders: int - число рендеров, после которого браузер перезапускается
+    :param max_memory_mb: int - порог памяти процессов одного браузера в МБ, 0 - без ограничения
+    :param close_timeout: float - время ожидания освобождения браузеров при остановке пула
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        max_renders: int = 100,
+        max_memory_mb: int = 0,
+        close_timeout: float = 30,
+    ) -> None:
+        self.size = size
+        self.max_renders = max_renders
+        self.max_memory_mb = max_memory_mb
+        self.close_timeout = close_timeout
+        self._playwright: Playwright | None = None
+        self._browsers: asyncio.Queue | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._launch_lock: asyncio.Lock | None = None
+
+    @property
+    def started(self) -> bool:
+        return self._browsers is not None
+
+    async def _start(self) -> None:
+        """
+        Метод инициализации пула в текущем событийном цикле.
+        Браузеры не запускаются, в очередь кладутся пустые слоты.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._browsers is not None:
+            return
+        if self._loop is not None and self._loop is not loop:
+            logging.warning(
+                msg="Browser pool is reused from another event loop, resetting it"
+            )
+            self._playwright = None
+        self._loop = loop
+        self._browsers = asyncio.Queue()
+        self._launch_lock = asyncio.Lock()
+        for _ in range(self.size):
+            self._browsers.put_nowait(None)
+
+    async def _launch(self) -> PooledBrowser:
+        """
+        Метод запуска нового экземпляра браузера
+        """
+        assert self._launch_lock is not None
+        # запуски по одному, чтобы новый процесс браузера однозначно относился к запуску
+        async with self._launch_lock:
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            before = await asyncio.to_thread(descendant_pids, os.getpid())
+            browser = await self._playwright.firefox.launch()
+            launched = await asyncio.to_thread(descendant_pids, os.getpid()) - before
+        metrics.incr("browser_pool.launches")
+        pid = await asyncio.to_thread(self._browser_pid, launched)
+        return PooledBrowser(browser=browser, pid=pid)
+
+    @staticmethod
+    def _browser_pid(launched: set[int]) -> int | None:
+        """
+        Главный процесс запущенного браузера: новый процесс, родитель которого
+        не является новым процессом. None, если его не удалось определить
+        """
+        roots = launched - {child for pid in launched for child in descendant_pids(pid)}
+        return roots.pop() if len(roots) == 1 else None
+
+    async def _recycle_reason(self, pooled: PooledBrowser) -> str | None:
+        """
+        Возвращает причину перезапуска браузера или None, если браузер можно переиспользовать
+        """
+        if not pooled.browser.is_connected():
+            return "disconnected"
+        if self.max_renders and pooled.renders >= self.max_renders:
+            return "renders"
+        if self.max_memory_mb and pooled.pid is not None:
+            memory = await asyncio.to_thread(process_tree_rss_mb, pooled.pid)
+            if memory >= self.max_memory_mb:
+                return "memory"
+        return None
+
+    async def _retire(self, pooled: PooledBrowser, reason: str) -> None:
+        """
+        Метод закрытия браузера с учетом статистики его использования
+        """
+        metrics.incr(f"browser_pool.recycled.{reason}")
+        metrics.observe(
+            "browser_pool.renders_per_browser", pooled.renders, RENDERS_BUCKETS
+        )
+        try:
+            await pooled.browser.close()
+        except Exception as err:
+            logging.warning(msg="Failed to close browser", exc_info=err)
+
+    @asynccontextmanager
+    async def page(self) -> AsyncIterator[Page]:
+        """
+        Контекстный менеджер, выдающий новую страницу в изолированном контексте браузера.
+        Если все браузеры заняты, ожидает освобождения одного из них.
+        """
+        await self._start()
+        browsers = self._browsers
+        assert browsers is not None
+
+        wait_started = time.monotonic()
+        pooled: PooledBrowser | None = await browsers.get()
+        metrics.observe("browser_pool.wait_seconds", time.monotonic() - wait_started)
+        try:
+            if pooled is None or not pooled.browser.is_connected():
+                pooled = await self._launch()
+            context = await pooled.browser.new_context()
+            try:
+                yield await context.new_page()
+            finally:
+                pooled.renders += 1
+                metrics.incr("browser_pool.renders")
+                await context.close()
+        finally:
+            if pooled is not None:
+                reason = await self._recycle_reason(pooled)
+                if reason is not None:
+                    await self._retire(pooled, reason)
+                    pooled = None
+            browsers.put_nowait(pooled)
+
+    async def close(self) -> None:
+        """
+        Метод остановки пула: дожидается освобождения браузеров, закрывает их и драйвер playwright
+        """
+        if self._browsers is None:
+            return
+        browsers, self._browsers = self._browsers, None
+        for _ in range(self.size):
+            try:
+                pooled = await asyncio.wait_for(
+                    browsers.get(), timeout=self.close_timeout
+                )
+            except asyncio.TimeoutError:
+                logging.warning(msg="Timeout waiting for browser to be released")
+                break
+            if pooled is not None:
+                await self._retire(pooled, "shutdown")
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+        self._loop = None
+        logging.info(msg=f"Browser pool closed, stats: {self.stats()}")
+
+    def stats(self) -> dict:
+        """
+        Статистика пула: число запусков и рендеров, рендеров на браузер, время ожидания браузера
+        """
+        snapshot = metrics.snapshot(prefix="browser_pool.")
+        return {
+            "size": self.size,
+            "idle": self._browsers.qsize() if self._browsers is not None else 0,
+            **snapshot["counters"],
+            **snapshot["histograms"],
+        }
+
+
+browser_pool = BrowserPool(
+    size=settings.BROWSER_POOL_SIZE,
+    max_renders=settings.BROWSER_POOL_MAX_RENDERS,
+    max_memory_mb=settings.BROWSER_POOL_MAX_MEMORY_MB,
+)
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import random
+from contextlib import suppress
+
+import aioimaplib
+from api.encrypt import EncryptionService, encryption_service
+from app_celery.metrics import metrics
+from app_celery.schemes import Mail
+from app_celery.services import PLAIN_TEXT_BROWSER, MailService
+from app_celery.snapshots import user_snapshots
+from app_celery.utils import STATE_AUTH, get_tracked_mailboxes, save_sync_states
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+
+class MailboxWatcher:
+    """
+    IDLE-соединение с одним почтовым ящиком.
+
+    Держит соединение с imap-сервером в режиме IDLE и по уведомлению EXISTS передает
+    письма с uid больше последнего обработанного в MailService, который отбирает письма
+    отслеживаемых отправителей, рендерит и отправляет их пользователю.
+    Последний обработанный uid сохраняется в состоянии синхронизации ящика,
+    поэтому после переподключения или перезапуска шлюза пропущенные письма догружаются.
+    IDLE перезапускается раньше серверного таймаута в 29 минут, при обрыве соединения
+    выполняется переподключение с экспоненциальной задержкой.
+    Если сервер не поддерживает IDLE, ящик опрашивается командой NOOP.
+
+    :param tg_id: int - telegram_id владельца ящика
+    :param mail: Mail - отслеживаемый почтовый ящик
+    :param senders: список отслеживаемых адресов отправителей
+    :param encrypt_method: EncryptionService - сервис расшифровки пароля
+    :param plain_text_mode: str - отображение текстовых писем владельца ящика
+    """
+
+    def __init__(
+        self,
+        tg_id: int,
+        mail: Mail,
+        senders: list[str],
+        encrypt_method: EncryptionService = encryption_service,
+        plain_text_mode: str = PLAIN_TEXT_BROWSER,
+    ) -> None:
+        self.tg_id = tg_id
+        self.mail = mail
+        self.senders = senders
+        self.plain_text_mode = plain_text_mode
+        self.encrypt_method = encrypt_method
+        self.connected: bool = False
+        self.last_uid: int | None = None
+        self._attempt: int = 0
+
+    async def run(self) -> None:
+        """
+        Метод поддержания соединения: переподключается после любой ошибки
+        """
+        while True:
+            try:
+                await self._session()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logging.warning(
+                    msg=f"IDLE connection to {self.mail.email} lost: {err!r}"
+                )
+            finally:
+                self.connected = False
+            metrics.incr("idle_gateway.reconnects")
+            await asyncio.sleep(self._backoff())
+
+    def _backoff(self) -> float:
+        """
+        Задержка перед следующим подключением: экспоненциальная, со случайным разбросом
+        """
+        delay = min(
+            settings.IMAP_IDLE_BACKOFF_MAX_SEC,
+            settings.IMAP_IDLE_BACKOFF_BASE_SEC * 2**self._attempt,
+        )
+        self._attempt += 1
+        return delay * random.uniform(0.5, 1)
+
+    def _make_service(self, imap_client: aioimaplib.IMAP4_SSL) -> MailService:
+        mail_service = MailService.from_settings(
+            tg_id=self.tg_id,
+            mails=[self.mail],
+            senders=self.senders,
+            encrypt_method=self.encrypt_method,
+            plain_text_mode=self.plain_text_mode,
+        )
+        mail_service.imap_client = imap_client
+        return mail_service
+
+    async def _session(self) -> None:
+        """
+        Метод одной сессии: подключение, выбор INBOX и цикл ожидания новых писем
+        """
+        imap_client = aioimaplib.IMAP4_SSL(
+            host=self.mail.provider["host"],
+            port=self.mail.provider["port"],
+            timeout=settings.IMAP_TIMEOUT_SEC,
+        )
+        try:
+            await imap_client.wait_hello_from_server()
+            password = self.encrypt_method.decrypt(self.mail.password.encode())  # type: ignore
+            await imap_client.login(self.mail.email, password)
+            if imap_client.get_state() != STATE_AUTH:
+                raise ConnectionError(f"Login to {self.mail.email} failed")
+
+            response = await imap_client.select("INBOX")
+            uid_validity, _ = MailService.mailbox_status(response)
+            if self.last_uid is None or uid_validity != self.mail.uid_validity:
+                mail_service = self._make_service(imap_client)
+                self.last_uid = mail_service.sync_from_uid(self.mail, response) - 1
+                self.mail.uid_validity = uid_validity
+            self.connected = True
+            self._attempt = 0
+            await self._process(imap_client)
+
+            idle_supported = imap_client.has_capability("IDLE")
+            while True:
+                if idle_supported:
+                    has_new = await self._idle(imap_client)
+                else:
+                    has_new = await self._poll(imap_client)
+                if has_new:
+                    await self._process(imap_client)
+        finally:
+            with suppress(Exception):
+                await imap_client.logout()
+
+    async def _idle(self, imap_client: aioimaplib.IMAP4_SSL) -> bool:
+        """
+        Метод одного цикла IDLE. Завершается по уведомлению EXISTS
+        или по истечении IMAP_IDLE_RENEW_SEC для перезапуска IDLE.
+
+        :return: bool - пришли ли новые письма
+        """
+        idle = await imap_client.idle_start(timeout=settings.IMAP_IDLE_RENEW_SEC)
+        has_new = False
+        while imap_client.has_pending_idle():
+            push = await imap_client.wait_server_push()
+            if push == aioimaplib.STOP_WAIT_SERVER_PUSH:
+                break
+            if any(line.endswith(b"EXISTS") for line in push):
+                has_new = True
+                break
+        imap_client.idle_done()
+        await asyncio.wait_for(idle, settings.IMAP_TIMEOUT_SEC)
+        metrics.incr("idle_gateway.idle_cycles")
+        return has_new
+
+    async def _poll(self, imap_client: aioimaplib.IMAP4_SSL) -> bool:
+        """
+        Метод опроса ящика для серверов без поддержки IDLE
+
+        :return: bool - всегда True, новые письма определяются по uid
+        """
+        await asyncio.sleep(settings.IMAP_IDLE_POLL_SEC)
+        await imap_client.noop()
+        return True
+
+    async def _process(self, imap_client: aioimaplib.IMAP4_SSL) -> None:
+        """
+        Метод обработки писем, пришедших после последнего обработанного uid
+        """
+        mail_service = self._make_service(imap_client)
+        from_uids = {self.mail.email: self.last_uid or 0}
+        last_uid = await mail_service.process_new_messages(
+            self.mail.email, from_uid=(self.last_uid or 0) + 1
+        )
+        metrics.incr("idle_gateway.fetches")
+        sync_states = {
+            self.mail.email: {
+                "uid_validity": self.mail.uid_validity,
+                "last_uid": last_uid,
+            }
+        }
+        sync_states = await sync_to_async(save_sync_states)(sync_states, from_uids)
+        # после отката конвейером следующая загрузка начинается с возвращенных писем
+        self.last_uid = sync_states.get(self.mail.email, {}).get("last_uid", last_uid)
+        self.mail.last_uid = self.last_uid
+        # снимок не должен вернуть опросу устаревший uid после отключения IDLE
+        await sync_to_async(user_snapshots.save_sync_states)(self.tg_id, sync_states)
+
+
+class IdleGateway:
+    """
+    Шлюз IMAP IDLE: держит по одному IDLE-соединению на каждый отслеживаемый ящик.
+
+    Раз в refresh_interval секунд перечитывает из бд список ящиков и отправителей:
+    запускает наблюдение за новыми ящиками, останавливает удаленные,
+    переподключает ящики со смененным паролем или провайдером.
+
+    :param refresh_interval: int - период обновления списка ящиков в секундах
+    """
+
+    def __init__(self, refresh_interval: int = settings.IMAP_IDLE_REFRESH_SEC) -> None:
+        self.refresh_interval = refresh_interval
+        self.watchers: dict[str, tuple[MailboxWatcher, asyncio.Task]] = dict()
+
+    @property
+    def connections(self) -> int:
+        """Число открытых IDLE-соединений процесса"""
+        return sum(watcher.connected for watcher, _ in self.watchers.values())
+
+    async def refresh(self) -> None:
+        """
+        Метод синхронизации запущенных наблюдателей со списком ящиков в бд
+        """
+        mailboxes = await sync_to_async(get_tracked_mailboxes)()
+        wanted = {item["mail"]["email"]: item for item in mailboxes}
+
+        for email in list(self.watchers):
+            watcher, task = self.watchers[email]
+            item = wanted.get(email)
+            if (
+                item is None
+                or item["tg_id"] != watcher.tg_id
+                or Mail(**item["mail"]) != watcher.mail
+            ):
+                task.cancel()
+                del self.watchers[email]
+
+        for email, item in wanted.items():
+            if email in self.watchers:
+                self.watchers[email][0].senders = item["senders"]
+                self.watchers[email][0].plain_text_mode = item["plain_text_mode"]
+                continue
+            watcher = MailboxWatcher(
+                tg_id=item["tg_id"],
+                mail=Mail(**item["mail"]),
+                senders=item["senders"],
+                plain_text_mode=item["plain_text_mode"],
+            )
+            self.watchers[email] = (
+                watcher,
+                asyncio.create_task(watcher.run(), name=f"idle:{email}"),
+            )
+
+        metrics.set_gauge("idle_gateway.mailboxes", len(self.watchers))
+        metrics.set_gauge("idle_gateway.connections", self.connections)
+        logging.info(
+            msg=f"IDLE gateway holds {self.connections} connections "
+            f"for {len(self.watchers)} mailboxes"
+        )
+
+    async def run(self) -> None:
+        """
+        Метод запуска шлюза, работает до отмены
+        """
+        try:
+            while True:
+                await self.refresh()
+                await asyncio.sleep(self.refresh_interval)
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        """
+        Метод остановки всех наблюдателей
+        """
+        tasks = [task for _, task in self.watchers.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.watchers.clear()
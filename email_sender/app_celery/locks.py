@@ -0,0 +1,227 @@
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, TypeVar
+
+import redis
+from app_celery.metrics import metrics
+from django.conf import settings
+from redis.exceptions import RedisError
+
+T = TypeVar("T")
+
+# KEYS: ключ аренды; ARGV: токен владельца, новое время жизни в миллисекундах
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS: ключ аренды; ARGV: токен владельца
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaseManager:
+    """
+    Аренды (распределенные блокировки с временем жизни) для проверок почты.
+
+    Проверка пользователя или шарда выполняется, только если получена аренда его ключа,
+    поэтому запуск, начатый beat до завершения предыдущего, не обрабатывает те же ящики повторно.
+    Такой запуск пропускается и оставляет отметку, по которой владелец аренды
+    после завершения выполняет проверку еще раз (запуски объединяются).
+    Пока проверка идет, аренда продлевается в фоновом потоке, поэтому длинные
+    проверки не теряют ее, а аренда упавшего воркера истекает через ttl.
+
+    Аренды хранятся в redis, если задан url, иначе (и при недоступности redis) - в памяти процесса.
+
+    :param url: str - адрес redis
+    :param ttl: float - время жизни аренды в секундах
+    :param prefix: str - префикс ключей
+    :param coalesce: bool - повторять проверку после пропущенного запуска
+    """
+
+    def __init__(
+        self,
+        url: str = "",
+        ttl: float = 60,
+        prefix: str = "mail_lease",
+        coalesce: bool = True,
+    ) -> None:
+        self.url = url
+        self.ttl = ttl
+        self.prefix = prefix
+        self.coalesce = coalesce
+        self._client: redis.Redis | None = None
+        self._lock = threading.Lock()
+        self._leases: dict[str, tuple[str, float]] = dict()
+        self._reruns: set[str] = set()
+
+    @property
+    def ttl_ms(self) -> int:
+        return max(1, int(self.ttl * 1000))
+
+    def _redis(self) -> redis.Redis | None:
+        if not self.url:
+            return None
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def _on_redis_error(self, err: RedisError) -> None:
+        logging.warning(msg=f"Redis lease storage is unavailable: {err!r}")
+        metrics.incr("mail_lease.redis_errors")
+
+    def acquire(self, name: str) -> str | None:
+        """
+        Метод получения аренды
+
+        :param name: str - имя аренды, например user:123
+        :return: str - токен владельца или None, если аренда занята
+        """
+        token = uuid.uuid4().hex
+        client = self._redis()
+        if client is not None:
+            try:
+                acquired = client.set(
+                    f"{self.prefix}:{name}", token, nx=True, px=self.ttl_ms
+                )
+                return token if acquired else None
+            except RedisError as err:
+                self._on_redis_error(err)
+        with self._lock:
+            now = time.monotonic()
+            holder = self._leases.get(name)
+            if holder is not None and holder[1] > now:
+                return None
+            self._leases[name] = (token, now + self.ttl)
+        return token
+
+    def renew(self, name: str, token: str) -> bool:
+        """
+        Метод продления аренды на ttl
+
+        :return: bool - False, если аренда истекла или перешла другому владельцу
+        """
+        client = self._redis()
+        if client is not None:
+            try:
+                return bool(
+                    client.eval(
+                        RENEW_SCRIPT, 1, f"{self.prefix}:{name}", token, self.ttl_ms
+                    )
+                )
+            except RedisError as err:
+                self._on_redis_error(err)
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is None or holder[0] != token:
+                return False
+            self._leases[name] = (token, time.monotonic() + self.ttl)
+        return True
+
+    def release(self, name: str, token: str) -> None:
+        """
+        Метод освобождения аренды. Чужая аренда не освобождается
+        """
+        client = self._redis()
+        if client is not None:
+            try:
+                client.eval(RELEASE_SCRIPT, 1, f"{self.prefix}:{name}", token)
+                return
+            except RedisError as err:
+                self._on_redis_error(err)
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is not None and holder[0] == token:
+                del self._leases[name]
+
+    def request_rerun(self, name: str) -> None:
+        """
+        Метод отметки пропущенного запуска для повторной проверки владельцем аренды
+        """
+        client = self._redis()
+        if client is not None:
+            try:
+                client.set(f"{self.prefix}:{name}:rerun", 1, px=self.ttl_ms)
+                return
+            except RedisError as err:
+                self._on_redis_error(err)
+        with self._lock:
+            self._reruns.add(name)
+
+    def take_rerun(self, name: str) -> bool:
+        """
+        Метод получения и сброса отметки пропущенного запуска
+        """
+        client = self._redis()
+        if client is not None:
+            try:
+                return bool(client.getdel(f"{self.prefix}:{name}:rerun"))
+            except RedisError as err:
+                self._on_redis_error(err)
+        with self._lock:
+            if name in self._reruns:
+                self._reruns.discard(name)
+                return True
+        return False
+
+    def _keep_alive(self, name: str, token: str, stop: threading.Event) -> None:
+        while not stop.wait(self.ttl / 3):
+            if self.renew(name, token):
+                metrics.incr("mail_lease.renewed")
+                continue
+            metrics.incr("mail_lease.lost")
+            logging.warning(msg=f"Lease {name} was lost before the check finished")
+            return
+
+    def run_exclusive(self, name: str, func: Callable[[], T]) -> T | None:
+        """
+        Метод выполнения проверки под арендой name.
+        Если аренда занята, проверка пропускается, а владелец аренды
+        после завершения своей проверки выполняет ее еще раз.
+
+        :param name: str - имя аренды
+        :param func: функция проверки
+        :return: результат func или None, если проверка пропущена
+        """
+        token = self.acquire(name)
+        if token is None:
+            metrics.incr("mail_lease.skipped")
+            if self.coalesce:
+                self.request_rerun(name)
+            logging.info(msg=f"Check {name} is already running, skipped")
+            return None
+
+        metrics.incr("mail_lease.acquired")
+        stop = threading.Event()
+        keeper = threading.Thread(
+            target=self._keep_alive,
+            args=(name, token, stop),
+            name=f"lease:{name}",
+            daemon=True,
+        )
+        keeper.start()
+        try:
+            result = func()
+            if self.coalesce and self.take_rerun(name):
+                metrics.incr("mail_lease.coalesced")
+                result = func()
+            return result
+        finally:
+            stop.set()
+            keeper.join()
+            self.release(name, token)
+
+
+mail_check_leases = LeaseManager(
+    url=settings.REDIS_URL,
+    ttl=settings.MAIL_CHECK_LEASE_TTL_SEC,
+    coalesce=settings.MAIL_CHECK_COALESCE,
+)
@@ -9,6 +9,10 @@ class AbstractMailSender(ABC):
     Должны быть реализованы минимум два метода:
     - send_photo(screenshot)
     - send_warning(data)
+
+    Метод send_album(screenshots) по умолчанию отправляет скриншоты по одному,
+    метод send_screenshots(screenshots, album_size) - альбомами через send_album,
+    метод send_text(text) - отправляет текст письма как уведомление send_warning
     """
 
     @abstractmethod
@@ -16,11 +20,12 @@ class AbstractMailSender(ABC):
         self.user_id = user_id
 
     @abstractmethod
-    async def send_photo(self, screenshot: Any) -> bool:
+    async def send_photo(self, screenshot: Any, caption: str | None = None) -> bool:
         """
         Метод для отправки скриншота получателю(target)
 
         :param screenshot: any - скриншот в заданном формате
+        :param caption: str - подпись скриншота
         :return: bool - результат отправки(True/False)
         """
 
@@ -33,3 +38,54 @@ class AbstractMailSender(ABC):
         :param data: dict - информация для обработки и отправки
         :return: bool - результат отправки(True/False)
         """
+
+    async def send_album(
+        self, screenshots: list[Any], captions: list[str | None] | None = None
+    ) -> list[bool]:
+        """
+        Метод для отправки нескольких скриншотов получателю одним сообщением
+
+        :param screenshots: список скриншотов в заданном формате
+        :param captions: список подписей скриншотов
+        :return: список результатов отправки каждого скриншота(True/False)
+        """
+        captions = captions or [None] * len(screenshots)
+        return [
+            await self.send_photo(screenshot, caption)
+            for screenshot, caption in zip(screenshots, captions)
+        ]
+
+    async def send_screenshots(
+        self, screenshots: list[tuple[Any, str | None]], album_size: int = 1
+    ) -> list[bool]:
+        """
+        Метод для отправки скриншотов получателю альбомами по album_size штук:
+        одного - методом send_photo, нескольких - методом send_album
+
+        :param screenshots: список пар (скриншот, подпись)
+        :param album_size: int - число скриншотов в альбоме
+        :return: список результатов отправки каждого скриншота(True/False)
+        """
+        album_size = max(album_size, 1)
+        results: list[bool] = list()
+        for i in range(0, len(screenshots), album_size):
+            chunk = screenshots[i : i + album_size]  # noqa: E203
+            if len(chunk) == 1:
+                results.append(await self.send_photo(*chunk[0]))
+                continue
+            results.extend(
+                await self.send_album(
+                    [screenshot for screenshot, _ in chunk],
+                    [caption for _, caption in chunk],
+                )
+            )
+        return results
+
+    async def send_text(self, text: str) -> bool:
+        """
+        Метод для отправки текста письма получателю без скриншота
+
+        :param text: str - текст письма с отправителем и получателем
+        :return: bool - результат отправки(True/False)
+        """
+        return await self.send_warning({"msg": text})
@@ -0,0 +1,160 @@
+import io
+import logging
+
+from app_celery.metrics import metrics
+from django.conf import settings
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+IMAGE_PNG = "png"
+IMAGE_JPEG = "jpeg"
+IMAGE_WEBP = "webp"
+IMAGE_FORMATS = (IMAGE_PNG, IMAGE_JPEG, IMAGE_WEBP)
+# максимальная высота изображения, которую может закодировать формат
+MAX_FORMAT_HEIGHT = {IMAGE_PNG: 0, IMAGE_JPEG: 65500, IMAGE_WEBP: 16383}
+
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", IMAGE_PNG),
+    (b"\xff\xd8\xff", IMAGE_JPEG),
+)
+
+
+def image_format(image: bytes) -> str:
+    """
+    Функция определения формата изображения по сигнатуре файла
+
+    :param image: bytes - изображение
+    :return: str - png, jpeg или webp. Неизвестный формат считается png
+    """
+    if image[:4] == b"RIFF" and image[8:12] == b"WEBP":
+        return IMAGE_WEBP
+    for signature, name in IMAGE_SIGNATURES:
+        if image.startswith(signature):
+            return name
+    return IMAGE_PNG
+
+
+class ScreenshotEncoder:
+    """
+    Кодировщик скриншотов писем перед отправкой пользователю.
+
+    Рендер возвращает png без потерь, который для длинных рассылок занимает несколько МБ.
+    Скриншот перекодируется в jpeg или webp с заданным качеством или в png
+    с палитрой из palette_colors цветов. Скриншоты выше max_height разрезаются
+    сверху вниз на части, которые отправляются по порядку.
+
+    Без Pillow скриншоты отправляются как есть.
+
+    :param image_format: str - формат изображений: png, jpeg или webp
+    :param quality: int - качество jpeg и webp от 1 до 100
+    :param palette_colors: int - число цветов палитры png, 0 - без палитры
+    :param max_height: int - максимальная высота части скриншота в пикселях, 0 - без разрезания
+    """
+
+    def __init__(
+        self,
+        image_format: str = IMAGE_PNG,
+        quality: int = 80,
+        palette_colors: int = 0,
+        max_height: int = 0,
+    ) -> None:
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown screenshot image format: {image_format}")
+        self.image_format = image_format
+        self.quality = quality
+        self.palette_colors = palette_colors
+        self.max_height = max_height
+
+    @property
+    def tile_height(self) -> int:
+        """
+        Высота части скриншота с учетом ограничений формата, 0 - без разрезания
+        """
+        limit = MAX_FORMAT_HEIGHT[self.image_format]
+        if not self.max_height:
+            return limit
+        if not limit:
+            return self.max_height
+        return min(self.max_height, limit)
+
+    @property
+    def lossless(self) -> bool:
+        """
+        Скриншот рендера отправляется без перекодирования, если его не требуется разрезать
+        """
+        return self.image_format == IMAGE_PNG and not self.palette_colors
+
+    def encode(self, screenshot: bytes) -> list[bytes]:
+        """
+        Метод кодирования скриншота. Выполняется синхронно, поэтому вызывается из потока
+
+        :param screenshot: bytes - скриншот рендера в формате png
+        :return: список частей скриншота сверху вниз
+        """
+        metrics.incr("screenshot_output.produced_bytes", len(screenshot))
+        if self.lossless and not self.max_height:
+            images = [screenshot]
+        elif Image is None:
+            logging.warning(msg="Pillow is not installed, screenshot is sent as is")
+            images = [screenshot]
+        else:
+            images = self._encode(screenshot)
+        metrics.incr("screenshot_output.encoded_bytes", sum(map(len, images)))
+        metrics.incr("screenshot_output.tiles", len(images))
+        if len(images) > 1:
+            metrics.incr("screenshot_output.tiled")
+        return images
+
+    @staticmethod
+    def stats() -> dict:
+        """
+        Статистика скриншотов: байты, полученные от рендера, после кодирования
+        и отправленные пользователям, доля отправленных байт от полученных
+        """
+        counters = metrics.snapshot(prefix="screenshot_output.")["counters"]
+        produced = counters.get("screenshot_output.produced_bytes", 0)
+        uploaded = counters.get("screenshot_output.uploaded_bytes", 0)
+        return {
+            **counters,
+            "screenshot_output.upload_ratio": (
+                round(uploaded / produced, 3) if produced else None
+            ),
+        }
+
+    def _encode(self, screenshot: bytes) -> list[bytes]:
+        with Image.open(io.BytesIO(screenshot)) as image:
+            width, height = image.size
+            tile_height = self.tile_height
+            if not tile_height or height <= tile_height:
+                return [screenshot if self.lossless else self._save(image)]
+            return [
+                self._save(image.crop((0, top, width, min(top + tile_height, height))))
+                for top in range(0, height, tile_height)
+            ]
+
+    def _save(self, image: "Image.Image") -> bytes:
+        buffer = io.BytesIO()
+        if self.image_format == IMAGE_JPEG:
+            image.convert("RGB").save(
+                buffer, "JPEG", quality=self.quality, optimize=True, progressive=True
+            )
+        elif self.image_format == IMAGE_WEBP:
+            image.convert("RGB").save(buffer, "WEBP", quality=self.quality, method=4)
+        elif self.palette_colors:
+            image.convert("RGB").quantize(colors=self.palette_colors).save(
+                buffer, "PNG", optimize=True
+            )
+        else:
+            image.save(buffer, "PNG")
+        return buffer.getvalue()
+
+
+screenshot_encoder = ScreenshotEncoder(
+    image_format=settings.SCREENSHOT_FORMAT,
+    quality=settings.SCREENSHOT_QUALITY,
+    palette_colors=settings.SCREENSHOT_PALETTE_COLORS,
+    max_height=settings.SCREENSHOT_MAX_HEIGHT,
+)
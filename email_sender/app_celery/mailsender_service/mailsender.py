@@ -1,9 +1,51 @@
+import asyncio
 import io
 import logging
 import os
+from collections.abc import Awaitable, Callable, Iterator
 
-from aiogram import Bot, types
+from aiogram import types
+from aiogram.utils.exceptions import RetryAfter
 from app_celery.mailsender_service.base import AbstractMailSender
+from app_celery.mailsender_service.images import (
+    ScreenshotEncoder,
+    image_format,
+    screenshot_encoder,
+)
+from app_celery.mailsender_service.ratelimit import RateLimiter, delivery_limiter
+from app_celery.mailsender_service.session import BotSessionManager, bot_session
+from app_celery.metrics import metrics
+from django.conf import settings
+
+ALBUM_MAX_SIZE = settings.TELEGRAM_ALBUM_MAX_SIZE
+MESSAGE_MAX_LENGTH = 4096
+
+
+def split_message(text: str, limit: int = MESSAGE_MAX_LENGTH) -> list[str]:
+    """
+    Функция разбиения текста на сообщения не длиннее limit символов
+    по переносам строк, а строк длиннее limit - по limit символов
+
+    :param text: str - текст
+    :param limit: int - максимальная длина сообщения
+    :return: список сообщений
+    """
+    messages: list[str] = list()
+    current = ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            messages.append(current)
+            current = ""
+        current += line
+    if current.strip() or not messages:
+        messages.append(current)
+    return messages
 
 
 class MailSender(AbstractMailSender):
@@ -11,45 +53,260 @@ class MailSender(AbstractMailSender):
     Сервис отправки уведомлений и сообщений пользователю.
     Основное использование в параметрах почтового сервиса
 
-    Имеет два метода:
+    Имеет четыре метода:
      - send_photo(screenshot) - метод для отправки скриншота письма
+     - send_album(screenshots) - метод для отправки нескольких скриншотов альбомом
+     - send_text(text) - метод для отправки текста письма сообщениями без скриншота
      - send_warning(data) - метод для отправки уведомлений о сбое в работе системы
+
+    Сообщения отправляются через общий для процесса бот с постоянными соединениями
+    с соблюдением лимитов telegram: при превышении лимита отправка ожидает своей очереди,
+    а после ответа RetryAfter повторяется по истечении указанного времени.
+
+    :param user_id: int - telegram_id получателя
+    :param session: BotSessionManager - менеджер сессии бота. По умолчанию общий для процесса
+    :param limiter: RateLimiter - ограничитель частоты отправки. По умолчанию общий для процесса
+    :param encoder: ScreenshotEncoder - кодировщик скриншотов перед отправкой:
+    формат, качество и разрезание высоких скриншотов. По умолчанию из настроек проекта
     """
 
-    def __init__(self, user_id: int) -> None:
+    def __init__(
+        self,
+        user_id: int,
+        session: BotSessionManager = bot_session,
+        limiter: RateLimiter = delivery_limiter,
+        encoder: ScreenshotEncoder = screenshot_encoder,
+    ) -> None:
         self.user_id = user_id
-        self.bot_token = os.environ.get("API_TOKEN")
+        self.session = session
+        self.limiter = limiter
+        self.encoder = encoder
         self.screenshot_filename: str = "mail_screenshot.png"
 
-    async def send_photo(self, screenshot: bytes) -> bool:
+    async def _deliver(self, send: Callable[[], Awaitable]) -> None:
+        """
+        Метод отправки сообщения с ожиданием лимитов и повтором после RetryAfter
+
+        :param send: функция, выполняющая запрос к api telegram
+        """
+        while True:
+            await self.limiter.acquire(self.user_id)
+            try:
+                await send()
+                return
+            except RetryAfter as err:
+                logging.warning(
+                    msg=f"Flood control for {self.user_id}, retry in {err.timeout}s"
+                )
+                await self.limiter.retry_after(self.user_id, err.timeout)
+
+    async def _encode(self, screenshot: bytes) -> list[bytes]:
+        """
+        Метод кодирования скриншота в формат отправки в потоке, чтобы не блокировать событийный цикл
+        """
+        return await asyncio.to_thread(self.encoder.encode, screenshot)
+
+    def _input_file(self, image: bytes) -> types.InputFile:
+        name, _ = os.path.splitext(self.screenshot_filename)
+        return types.InputFile(io.BytesIO(image), f"{name}.{image_format(image)}")
+
+    async def _send_group(
+        self, images: list[bytes], captions: list[str | None]
+    ) -> None:
+        """
+        Метод отправки изображений одним сообщением: одного - документом, нескольких - альбомом
+
+        :param images: список изображений, не более ALBUM_MAX_SIZE
+        :param captions: список подписей изображений
+        """
+        if len(images) == 1:
+            await self._deliver(
+                lambda: self.session.get_bot().send_document(
+                    chat_id=self.user_id,
+                    document=self._input_file(images[0]),
+                    caption=captions[0],
+                )
+            )
+        else:
+            await self._deliver(
+                lambda: self.session.get_bot().send_media_group(
+                    chat_id=self.user_id,
+                    media=[
+                        types.InputMediaDocument(
+                            self._input_file(image), caption=caption
+                        )
+                        for image, caption in zip(images, captions)
+                    ],
+                )
+            )
+        metrics.incr("screenshot_output.uploaded_bytes", sum(map(len, images)))
+
+    async def _send_screenshot(
+        self, images: list[bytes], caption: str | None = None
+    ) -> bool:
+        """
+        Метод отправки частей одного скриншота по порядку, подпись - у первой части
+
+        Если часть альбомов уже отправлена, скриншот считается отправленным,
+        а пользователь получает предупреждение: повторная отправка продублировала бы
+        уже полученные им части.
+
+        :param images: список частей скриншота
+        :param caption: подпись скриншота
+        :return: bool - результат отправки(True/False), False - не отправлено ни одной части
+        """
+        captions = [caption] + [None] * (len(images) - 1)
+        sent = 0
+        try:
+            for i in range(0, len(images), ALBUM_MAX_SIZE):
+                await self._send_group(
+                    images[i : i + ALBUM_MAX_SIZE],  # noqa: E203
+                    captions[i : i + ALBUM_MAX_SIZE],  # noqa: E203
+                )
+                sent = min(i + ALBUM_MAX_SIZE, len(images))
+        except Exception as e:
+            logging.error(
+                "Ошибка при отправке скриншота письма пользователю {} - {}".format(
+                    self.user_id, e.__str__()
+                )
+            )
+            if not sent:
+                return False
+            metrics.incr("screenshot_output.partial_deliveries")
+            logging.warning(
+                msg=f"Screenshot sent to user {self.user_id} partially: "
+                f"{sent} of {len(images)} parts"
+            )
+            await self.send_warning(
+                data={
+                    "msg": "Скриншот письма отправлен не полностью. "
+                    "Рекомендуется проверить письмо напрямую"
+                }
+            )
+        return True
+
+    async def send_photo(self, screenshot: bytes, caption: str | None = None) -> bool:
         """
         Метод для отправки сгенерированных скриншотов пользователю бота.
+        Высокий скриншот отправляется частями по порядку.
 
         :param screenshot: Список скриншот в виде байтовой строки.
+        :param caption: Подпись скриншота.
         :return: bool - результат отправки(True/False)
         """
-        success: bool = True
-        bot = Bot(self.bot_token)
-
         try:
-            await bot.send_document(
-                chat_id=self.user_id,
-                document=types.InputFile(
-                    io.BytesIO(screenshot), self.screenshot_filename
-                ),
-            )
+            images = await self._encode(screenshot)
         except Exception as e:
             logging.error(
-                "Ошибка при отправке скриншота письма пользователю {} - {}".format(
+                "Ошибка при кодировании скриншота письма пользователю {} - {}".format(
                     self.user_id, e.__str__()
                 )
             )
-            success = False
-        finally:
-            bot_session = await bot.get_session()
-            await bot_session.close()
+            return False
+        return await self._send_screenshot(images, caption)
 
-        return success
+    async def send_album(
+        self, screenshots: list[bytes], captions: list[str | None] | None = None
+    ) -> list[bool]:
+        """
+        Метод для отправки нескольких скриншотов пользователю бота альбомами
+        send_media_group до ALBUM_MAX_SIZE документов. Части одного скриншота
+        не разделяются между альбомами. Если отправить альбом не удалось,
+        скриншоты альбома отправляются по одному.
+
+        :param screenshots: Список скриншотов в виде байтовых строк.
+        :param captions: Список подписей скриншотов.
+        :return: список результатов отправки каждого скриншота(True/False)
+        """
+        captions = captions or [None] * len(screenshots)
+        results: list[bool] = [False] * len(screenshots)
+        encoded: list[tuple[int, list[bytes]]] = list()
+        for index, screenshot in enumerate(screenshots):
+            try:
+                encoded.append((index, await self._encode(screenshot)))
+            except Exception as e:
+                logging.error(
+                    "Ошибка при кодировании скриншота письма пользователю {} - {}".format(
+                        self.user_id, e.__str__()
+                    )
+                )
+
+        for album in self._albums(encoded):
+            if len(album) == 1:
+                index, images = album[0]
+                results[index] = await self._send_screenshot(images, captions[index])
+                continue
+            try:
+                await self._send_group(
+                    [image for _, images in album for image in images],
+                    [
+                        captions[index] if i == 0 else None
+                        for index, images in album
+                        for i in range(len(images))
+                    ],
+                )
+                metrics.incr("telegram_album.sent")
+                metrics.incr("telegram_album.screenshots", len(album))
+                for index, _ in album:
+                    results[index] = True
+            except Exception as e:
+                logging.warning(
+                    "Ошибка при отправке альбома пользователю {}, отправка по одному - {}".format(
+                        self.user_id, e.__str__()
+                    )
+                )
+                metrics.incr("telegram_album.fallback")
+                for index, images in album:
+                    results[index] = await self._send_screenshot(
+                        images, captions[index]
+                    )
+        return results
+
+    @staticmethod
+    def _albums(
+        encoded: list[tuple[int, list[bytes]]]
+    ) -> Iterator[list[tuple[int, list[bytes]]]]:
+        """
+        Метод разбиения скриншотов на альбомы не более ALBUM_MAX_SIZE изображений
+        без разделения частей одного скриншота
+
+        :param encoded: список (номер скриншота, части скриншота)
+        """
+        album: list[tuple[int, list[bytes]]] = list()
+        size = 0
+        for index, images in encoded:
+            if album and size + len(images) > ALBUM_MAX_SIZE:
+                yield album
+                album, size = list(), 0
+            album.append((index, images))
+            size += len(images)
+        if album:
+            yield album
+
+    async def send_text(self, text: str) -> bool:
+        """
+        Метод для отправки текста письма пользователю бота сообщениями
+        не длиннее MESSAGE_MAX_LENGTH символов.
+
+        :param text: str - текст письма с отправителем и получателем
+        :return: bool - результат отправки(True/False)
+        """
+        try:
+            for message in split_message(text):
+                await self._deliver(
+                    lambda: self.session.get_bot().send_message(
+                        chat_id=self.user_id, text=message
+                    )
+                )
+                metrics.incr("telegram_text.messages")
+        except Exception as e:
+            logging.error(
+                "Ошибка при отправке текста письма пользователю {} - {}".format(
+                    self.user_id, e.__str__()
+                )
+            )
+            return False
+        return True
 
     async def send_warning(self, data: dict) -> bool:
         """
@@ -59,16 +316,17 @@ class MailSender(AbstractMailSender):
         :return: bool - результат отправки(True/False)
         """
         success: bool = True
-        bot = Bot(self.bot_token)
 
         try:
-            await bot.send_message(
-                chat_id=self.user_id,
-                text=data.get(
-                    "msg",
-                    "Возникла непредвиденная ошибка при отправке скриншота письма.\n"
-                    "Возможно письмо слишком большое. Рекомендуется проверить письмо напрямую",
-                ),
+            await self._deliver(
+                lambda: self.session.get_bot().send_message(
+                    chat_id=self.user_id,
+                    text=data.get(
+                        "msg",
+                        "Возникла непредвиденная ошибка при отправке скриншота письма.\n"
+                        "Возможно письмо слишком большое. Рекомендуется проверить письмо напрямую",
+                    ),
+                )
             )
         except Exception as e:
             logging.error(
@@ -77,8 +335,5 @@ class MailSender(AbstractMailSender):
                 )
             )
             success = False
-        finally:
-            bot_session = await bot.get_session()
-            await bot_session.close()
 
         return success
@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import time
+import weakref
+
+import redis.asyncio as aioredis
+from app_celery.metrics import metrics
+from django.conf import settings
+from redis.exceptions import RedisError
+
+WAIT_BUCKETS: tuple[float, ...] = (0, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# KEYS: общий бакет, бакет чата, блокировка чата после RetryAfter
+# ARGV: скорость и емкость общего бакета, скорость и емкость бакета чата (токенов в секунду)
+# Возвращает 0, если токены получены, иначе время ожидания в миллисекундах
+TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+
+local blocked = redis.call('PTTL', KEYS[3])
+if blocked > 0 then
+    return blocked
+end
+
+local function tokens(key, rate, burst)
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local value = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    return math.min(burst, value + math.max(0, now - ts) * rate / 1000)
+end
+
+local buckets = {
+    {KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2])},
+    {KEYS[2], tonumber(ARGV[3]), tonumber(ARGV[4])},
+}
+local wait = 0
+for i, bucket in ipairs(buckets) do
+    bucket[4] = tokens(bucket[1], bucket[2], bucket[3])
+    if bucket[4] < 1 then
+        wait = math.max(wait, math.ceil((1 - bucket[4]) * 1000 / bucket[2]))
+    end
+end
+if wait > 0 then
+    return wait
+end
+for i, bucket in ipairs(buckets) do
+    redis.call('HSET', bucket[1], 'tokens', tostring(bucket[4] - 1), 'ts', now)
+    redis.call('PEXPIRE', bucket[1], math.ceil(bucket[3] * 1000 / bucket[2]) + 1000)
+end
+return 0
+"""
+
+
+class DeliveryTimeout(Exception):
+    """Сообщение не удалось отправить в пределах допустимого ожидания"""
+
+
+class RateLimiter:
+    """
+    Ограничитель частоты отправки сообщений в telegram на основе token bucket.
+
+    Соблюдает общий лимит бота и лимит на один чат. Если токенов нет,
+    отправка ожидает их появления (но не дольше max_wait), а не завершается ошибкой.
+    После ответа RetryAfter отправка в чат блокируется на указанное сервером время.
+    Состояние хранится в памяти процесса, для общих лимитов всех воркеров используется RedisRateLimiter.
+
+    :param global_rate: float - сообщений в секунду для всего бота
+    :param chat_rate: float - сообщений в секунду для одного чата
+    :param max_wait: float - максимальное время ожидания отправки в секундах, 0 - без ограничения
+    """
+
+    def __init__(
+        self, global_rate: float = 30, chat_rate: float = 1, max_wait: float = 300
+    ) -> None:
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.max_wait = max_wait
+        self._buckets: dict[str, tuple[float, float]] = dict()
+        self._blocked_until: dict[str, float] = dict()
+
+    @staticmethod
+    def _chat_key(chat_id: int) -> str:
+        return f"chat:{chat_id}"
+
+    def _tokens(self, key: str, rate: float, now: float) -> float:
+        tokens, updated = self._buckets.get(key, (max(rate, 1), now))
+        return min(max(rate, 1), tokens + (now - updated) * rate)
+
+    async def _reserve(self, chat_id: int) -> float:
+        """
+        Метод получения токенов общего бакета и бакета чата
+
+        :return: float - 0, если токены получены, иначе время ожидания в секундах
+        """
+        now = time.monotonic()
+        chat_key = self._chat_key(chat_id)
+        blocked = self._blocked_until.get(chat_key, 0)
+        if blocked > now:
+            return blocked - now
+
+        buckets = (("global", self.global_rate), (chat_key, self.chat_rate))
+        tokens = [self._tokens(key, rate, now) for key, rate in buckets]
+        waits = [
+            (1 - value) / rate for value, (_, rate) in zip(tokens, buckets) if value < 1
+        ]
+        if waits:
+            return max(waits)
+        for value, (key, _) in zip(tokens, buckets):
+            self._buckets[key] = (value - 1, now)
+        return 0.0
+
+    async def acquire(self, chat_id: int) -> float:
+        """
+        Метод ожидания разрешения на отправку сообщения в чат chat_id
+
+        :param chat_id: int - telegram_id получателя
+        :return: float - время ожидания в секундах
+        :raise DeliveryTimeout: если ожидание превысило max_wait
+        """
+        started = time.monotonic()
+        while (wait := await self._reserve(chat_id)) > 0:
+            waited = time.monotonic() - started
+            if self.max_wait and waited + wait > self.max_wait:
+                metrics.incr("telegram_rate.timeouts")
+                raise DeliveryTimeout(
+                    f"Delivery to {chat_id} is throttled for {waited + wait:.1f}s"
+                )
+            metrics.incr("telegram_rate.throttled")
+            await asyncio.sleep(wait)
+        waited = time.monotonic() - started
+        metrics.observe("telegram_rate.wait_seconds", waited, WAIT_BUCKETS)
+        return waited
+
+    async def retry_after(self, chat_id: int, timeout: float) -> None:
+        """
+        Метод блокировки отправки в чат после ответа RetryAfter
+
+        :param chat_id: int - telegram_id получателя
+        :param timeout: float - время блокировки в секундах из ответа сервера
+        """
+        metrics.incr("telegram_rate.retry_after")
+        self._blocked_until[self._chat_key(chat_id)] = time.monotonic() + timeout
+
+    async def close(self) -> None:
+        pass
+
+
+class RedisRateLimiter(RateLimiter):
+    """
+    Ограничитель частоты отправки с бакетами в redis, общими для всех процессов воркеров.
+    Токены обоих бакетов проверяются и списываются атомарно lua-скриптом.
+    Если redis недоступен, используется ограничение в памяти процесса.
+
+    :param url: str - адрес redis
+    :param prefix: str - префикс ключей
+    """
+
+    def __init__(self, url: str, prefix: str = "telegram_rate", **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.url = url
+        self.prefix = prefix
+        self._clients: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, aioredis.Redis
+        ] = weakref.WeakKeyDictionary()
+
+    def _client(self) -> aioredis.Redis:
+        loop = asyncio.get_running_loop()
+        if loop not in self._clients:
+            self._clients[loop] = aioredis.from_url(self.url)
+        return self._clients[loop]
+
+    async def _reserve(self, chat_id: int) -> float:
+        chat_key = self._chat_key(chat_id)
+        try:
+            wait_ms = await self._client().eval(
+                TOKEN_BUCKET_SCRIPT,
+                3,
+                f"{self.prefix}:bucket:global",
+                f"{self.prefix}:bucket:{chat_key}",
+                f"{self.prefix}:blocked:{chat_key}",
+                self.global_rate,
+                max(self.global_rate, 1),
+                self.chat_rate,
+                max(self.chat_rate, 1),
+            )
+        except RedisError as err:
+            logging.warning(msg=f"Redis rate limiter is unavailable: {err!r}")
+            metrics.incr("telegram_rate.redis_errors")
+            return await super()._reserve(chat_id)
+        return int(wait_ms) / 1000
+
+    async def retry_after(self, chat_id: int, timeout: float) -> None:
+        await super().retry_after(chat_id, timeout)
+        try:
+            await self._client().set(
+                f"{self.prefix}:blocked:{self._chat_key(chat_id)}",
+                1,
+                px=max(1, int(timeout * 1000)),
+            )
+        except RedisError as err:
+            logging.warning(msg=f"Redis rate limiter is unavailable: {err!r}")
+
+    async def close(self) -> None:
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+
+def build_rate_limiter() -> RateLimiter:
+    """
+    Создает ограничитель частоты отправки по настройкам проекта:
+    с бакетами в redis, если задан REDIS_URL, иначе в памяти процесса
+    """
+    params = dict(
+        global_rate=settings.TELEGRAM_RATE_GLOBAL,
+        chat_rate=settings.TELEGRAM_RATE_PER_CHAT,
+        max_wait=settings.TELEGRAM_DELIVERY_MAX_WAIT_SEC,
+    )
+    if settings.REDIS_URL:
+        return RedisRateLimiter(url=settings.REDIS_URL, **params)
+    return RateLimiter(**params)
+
+
+delivery_limiter = build_rate_limiter()
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+import weakref
+from types import SimpleNamespace
+
+import aiohttp
+from aiogram import Bot
+from aiogram.utils import json
+from app_celery.metrics import metrics
+from django.conf import settings
+
+
+async def _on_connection_created(
+    session: aiohttp.ClientSession, context: SimpleNamespace, params: object
+) -> None:
+    metrics.incr("telegram_session.connections.created")
+
+
+async def _on_connection_reused(
+    session: aiohttp.ClientSession, context: SimpleNamespace, params: object
+) -> None:
+    metrics.incr("telegram_session.connections.reused")
+
+
+class PooledBot(Bot):
+    """
+    Бот с постоянными (keep-alive) соединениями к api.telegram.org,
+    учитывающий в метриках создание и переиспользование соединений.
+
+    :param keepalive_timeout: float - время жизни простаивающего соединения в секундах
+    """
+
+    def __init__(self, *args, keepalive_timeout: float = 60, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._connector_init["keepalive_timeout"] = keepalive_timeout
+
+    async def get_new_session(self) -> aiohttp.ClientSession:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(_on_connection_created)
+        trace_config.on_connection_reuseconn.append(_on_connection_reused)
+        metrics.incr("telegram_session.sessions")
+        return aiohttp.ClientSession(
+            connector=self._connector_class(**self._connector_init),
+            json_serialize=json.dumps,
+            trace_configs=[trace_config],
+        )
+
+
+class BotSessionManager:
+    """
+    Общий для процесса воркера бот отправки сообщений.
+
+    Один экземпляр бота и его пул соединений создаются лениво на каждый событийный цикл
+    и переиспользуются всеми задачами процесса вместо нового TLS-соединения на каждое сообщение.
+    Сессия закрывается при остановке воркера.
+
+    :param token: str - токен бота, по умолчанию из переменной окружения API_TOKEN
+    :param connections_limit: int - максимальное число одновременных соединений
+    :param keepalive_timeout: float - время жизни простаивающего соединения в секундах
+    """
+
+    def __init__(
+        self,
+        token: str | None = None,
+        connections_limit: int = 100,
+        keepalive_timeout: float = 60,
+    ) -> None:
+        self.token = token
+        self.connections_limit = connections_limit
+        self.keepalive_timeout = keepalive_timeout
+        self._bots: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, PooledBot
+        ] = weakref.WeakKeyDictionary()
+
+    def get_bot(self) -> Bot:
+        """
+        Возвращает бота текущего событийного цикла, создавая его при первом обращении
+        """
+        loop = asyncio.get_running_loop()
+        bot = self._bots.get(loop)
+        if bot is None:
+            bot = PooledBot(
+                self.token or os.environ.get("API_TOKEN"),
+                connections_limit=self.connections_limit,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._bots[loop] = bot
+        metrics.incr("telegram_session.requests")
+        return bot
+
+    @property
+    def started(self) -> bool:
+        return bool(self._bots)
+
+    async def close(self) -> None:
+        """
+        Метод закрытия сессии бота текущего событийного цикла
+        """
+        bot = self._bots.pop(asyncio.get_running_loop(), None)
+        if bot is None:
+            return
+        session = await bot.get_session()
+        await session.close()
+        logging.info(msg=f"Telegram bot session closed, stats: {self.stats()}")
+
+    @staticmethod
+    def stats() -> dict:
+        """
+        Статистика сессии: число запросов, созданных и переиспользованных соединений
+        """
+        return metrics.snapshot(prefix="telegram_session.")["counters"]
+
+
+bot_session = BotSessionManager(
+    connections_limit=settings.TELEGRAM_CONNECTIONS_LIMIT,
+    keepalive_timeout=settings.TELEGRAM_KEEPALIVE_SEC,
+)
@@ -0,0 +1,52 @@
+import base64
+import time
+
+import rsa
+from api.encrypt import EncryptionService
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Измеряет время расшифровки пароля почтового ящика с кэшами ключей и паролей и без них"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200)
+
+    def handle(self, *args, **options):
+        iterations = options["iterations"]
+        service = EncryptionService(cache_ttl=0, envelope=False)
+        crypto = service.encrypt("benchmark-password")
+        envelope = EncryptionService(cache_ttl=0)
+        envelope_crypto = envelope.encrypt("benchmark-password")
+
+        def parse_key_and_decrypt() -> str:
+            key = service._format_key(
+                key=settings.PRIVATE_KEY,
+                prefix=settings.PRIVATE_KEY_PREFIX,
+                suffix=settings.PRIVATE_KEY_SUFFIX,
+            )
+            private = rsa.PrivateKey.load_pkcs1(key, format="PEM")
+            return rsa.decrypt(base64.b64decode(crypto), private).decode()
+
+        cached = EncryptionService()
+        cases = (
+            ("parse key on every call", parse_key_and_decrypt),
+            ("cached key", lambda: service.decrypt(crypto.encode())),
+            ("cached key and password", lambda: cached.decrypt(crypto.encode())),
+            (
+                "envelope (AES-GCM)",
+                lambda: envelope.decrypt(envelope_crypto.encode()),
+            ),
+        )
+        baseline = None
+        for name, decrypt in cases:
+            decrypt()
+            started = time.perf_counter()
+            for _ in range(iterations):
+                decrypt()
+            per_call = (time.perf_counter() - started) / iterations * 1_000_000
+            baseline = baseline or per_call
+            self.stdout.write(
+                f"{name:<26} {per_call:>10.1f} us/decrypt  x{baseline / per_call:.1f}"
+            )
@@ -0,0 +1,100 @@
+import asyncio
+import resource
+import statistics
+import time
+import tracemalloc
+
+from app_celery.browser_pool import BrowserPool, children_rss_mb
+from app_celery.mailsender_service.mailsender import split_message
+from app_celery.render_service import RenderError, TextRenderer
+from app_celery.render_service.browser import BrowserRenderer
+from app_celery.services import plain_text_html
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+SAMPLE_PARAGRAPH = (
+    "Здравствуйте! Напоминаем, что оплата по счету № 4521 должна быть проведена "
+    "до конца месяца. Если вы уже оплатили счет, просто проигнорируйте это письмо.\n"
+    "Order #4521 is due at the end of the month, see https://example.com/invoices/4521\n"
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает время и память отображения текстового письма: скриншот браузером, "
+        "изображение текста без браузера (image) и подготовка текстовых сообщений (message)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--paragraphs", type=int, default=20)
+        parser.add_argument(
+            "--skip-browser", action="store_true", help="не запускать браузер"
+        )
+
+    def handle(self, *args, **options):
+        iterations = options["iterations"]
+        text = SAMPLE_PARAGRAPH * options["paragraphs"]
+        text_renderer = TextRenderer(
+            font_path=settings.RENDER_TEXT_FONT,
+            font_size=settings.RENDER_TEXT_FONT_SIZE,
+            width=settings.RENDER_TEXT_WIDTH,
+        )
+
+        async def prepare_messages() -> list[str]:
+            return split_message(text)
+
+        cases = [
+            ("message (split only)", prepare_messages),
+            ("image (Pillow)", lambda: text_renderer.render(text)),
+        ]
+        browser_pool = BrowserPool(size=1)
+        if not options["skip_browser"]:
+            browser_renderer = BrowserRenderer(browser_pool)
+            cases.append(
+                (
+                    "browser (Firefox)",
+                    lambda: browser_renderer.render(plain_text_html(text)),
+                )
+            )
+
+        self.stdout.write(
+            f"text: {len(text)} chars, iterations: {iterations}\n"
+            f"{'case':<22} {'p50 ms':>9} {'mean ms':>9} {'py peak KB':>11} "
+            f"{'children MB':>12} {'output KB':>10}"
+        )
+        try:
+            asyncio.run(self._run(cases, iterations, browser_pool))
+        finally:
+            self.stdout.write(
+                f"process max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB"
+            )
+
+    async def _run(self, cases: list, iterations: int, browser_pool: BrowserPool):
+        try:
+            for name, run in cases:
+                try:
+                    # первый запуск прогревает браузер и шрифты и не учитывается
+                    await run()
+                except RenderError as err:
+                    self.stderr.write(f"{name}: {err}")
+                    continue
+                timings: list[float] = list()
+                tracemalloc.start()
+                for _ in range(iterations):
+                    started = time.perf_counter()
+                    result = await run()
+                    timings.append((time.perf_counter() - started) * 1000)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                size = (
+                    sum(map(len, result)) if isinstance(result, list) else len(result)
+                )
+                self.stdout.write(
+                    f"{name:<22} {statistics.median(timings):>9.1f} "
+                    f"{statistics.mean(timings):>9.1f} {peak / 1024:>11.0f} "
+                    f"{children_rss_mb():>12.0f} {size / 1024:>10.1f}"
+                )
+        finally:
+            if browser_pool.started:
+                await browser_pool.close()
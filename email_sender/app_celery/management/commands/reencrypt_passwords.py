@@ -0,0 +1,91 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from api.encrypt import encryption_service
+from api.models import Mail
+from app_celery.snapshots import user_snapshots
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+def reencrypt(password: str) -> str | None:
+    """
+    Перешифровывает пароль в процессе пула, None - если пароль не удалось расшифровать
+    """
+    try:
+        return encryption_service.reencrypt(password)
+    except Exception:
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Перешифровывает пароли почтовых ящиков в текущем формате текущим ключом. "
+        "Пароли обрабатываются пачками в нескольких процессах, строка обновляется, "
+        "только если ее пароль не изменился за время перешифровки"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        stats = dict(checked=0, reencrypted=0, conflicts=0, failed=0)
+        # соединения с бд не должны наследоваться процессами пула
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+            last_pk = 0
+            while True:
+                batch = list(
+                    Mail.objects.filter(pk__gt=last_pk)
+                    .order_by("pk")
+                    .values_list("pk", "password")[:batch_size]
+                )
+                if not batch:
+                    break
+                last_pk = batch[-1][0]
+                stats["checked"] += len(batch)
+                reencrypted: list[int] = list()
+                stale = [
+                    (pk, password)
+                    for pk, password in batch
+                    if not encryption_service.is_current(password)
+                ]
+                chunksize = max(1, len(stale) // (options["workers"] * 4))
+                results = executor.map(
+                    reencrypt, [password for _, password in stale], chunksize=chunksize
+                )
+                for (pk, password), new_password in zip(stale, results):
+                    if new_password is None:
+                        stats["failed"] += 1
+                        self.stderr.write(f"Failed to reencrypt password of mail {pk}")
+                        continue
+                    if options["dry_run"]:
+                        stats["reencrypted"] += 1
+                        continue
+                    # update не вызывает сигналы, поэтому пароль не шифруется повторно
+                    updated = Mail.objects.filter(pk=pk, password=password).update(
+                        password=new_password
+                    )
+                    stats["reencrypted" if updated else "conflicts"] += 1
+                    encryption_service.forget(password)
+                    if updated:
+                        reencrypted.append(pk)
+                # update не вызывает и сигналы обновления снимков, а снимок со старым
+                # шифром нельзя расшифровать после удаления прежнего ключа
+                self._refresh_snapshots(reencrypted)
+        self.stdout.write(", ".join(f"{key}: {value}" for key, value in stats.items()))
+
+    @staticmethod
+    def _refresh_snapshots(pks: list[int]) -> None:
+        """
+        Пересобирает снимки владельцев перешифрованных ящиков
+        """
+        tg_ids = (
+            Mail.objects.filter(pk__in=pks)
+            .values_list("user__tg_id", flat=True)
+            .distinct()
+        )
+        for tg_id in tg_ids:
+            user_snapshots.refresh(tg_id)
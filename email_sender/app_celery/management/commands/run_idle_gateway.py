@@ -0,0 +1,15 @@
+from app_celery.idle_gateway import IdleGateway
+from app_celery.runtime import worker_runtime
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Запускает шлюз IMAP IDLE для получения новых писем без периодического опроса"
+    )
+
+    def handle(self, *args, **options):
+        try:
+            worker_runtime.run(IdleGateway().run())
+        finally:
+            worker_runtime.shutdown()
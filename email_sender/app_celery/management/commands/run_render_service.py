@@ -0,0 +1,38 @@
+from app_celery.browser_pool import browser_pool
+from app_celery.render_service import (
+    RenderServer,
+    browser_renderer_from_settings,
+    with_render_cache,
+)
+from app_celery.runtime import worker_runtime
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Запускает сервис рендера писем: принимает html по http или через unix-сокет "
+        "и возвращает скриншот, чтобы воркерам не требовались playwright и браузер"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default=settings.RENDER_SERVICE_URL)
+        parser.add_argument(
+            "--concurrency", type=int, default=settings.RENDER_SERVICE_CONCURRENCY
+        )
+        parser.add_argument(
+            "--queue-size", type=int, default=settings.RENDER_SERVICE_QUEUE_SIZE
+        )
+
+    def handle(self, *args, **options):
+        server = RenderServer(
+            renderer=with_render_cache(browser_renderer_from_settings(browser_pool)),
+            concurrency=options["concurrency"],
+            queue_size=options["queue_size"],
+        )
+        try:
+            worker_runtime.run(server.serve(options["url"]))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            worker_runtime.shutdown()
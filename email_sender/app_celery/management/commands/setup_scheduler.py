@@ -0,0 +1,23 @@
+from app_celery.tasks import SCHEDULER_PER_USER, SCHEDULER_SHARDED, setup_scheduler
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Создает периодические задачи проверки почты для выбранного режима планировщика"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--mode",
+            choices=(SCHEDULER_PER_USER, SCHEDULER_SHARDED),
+            default=settings.SCHEDULER_MODE,
+        )
+        parser.add_argument("--shards", type=int, default=settings.SCHEDULER_SHARDS)
+
+    def handle(self, *args, **options):
+        setup_scheduler(mode=options["mode"], shards=options["shards"])
+        self.stdout.write(
+            f"Scheduler mode: {options['mode']}, shards: {options['shards']}"
+        )
@@ -0,0 +1,146 @@
+import threading
+from collections import defaultdict
+
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+class Histogram:
+    """
+    Гистограмма наблюдаемых значений с фиксированными границами корзин.
+
+    :param buckets: верхние границы корзин в порядке возрастания
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Учитывает новое значение в гистограмме
+
+        :param value: float - наблюдаемое значение
+        """
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else 0.0,
+            "max": round(self.max, 6),
+            "buckets": {
+                **{str(bound): cnt for bound, cnt in zip(self.buckets, self.counts)},
+                "+Inf": self.counts[-1],
+            },
+        }
+
+
+class Metrics:
+    """
+    Реестр метрик процесса воркера: счетчики, текущие значения и гистограммы.
+
+    Метрики живут в памяти процесса и пишутся в лог при его остановке,
+    а также доступны через snapshot() для отладки и подбора параметров.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: defaultdict[str, int] = defaultdict(int)
+        self._gauges: dict[str, float] = dict()
+        self._histograms: dict[str, Histogram] = dict()
+
+    def incr(self, name: str, value: int = 1) -> None:
+        """
+        Увеличивает счетчик name на value
+
+        :param name: str - имя счетчика
+        :param value: int - величина приращения
+        """
+        with self._lock:
+            self._counters[name] += value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        """
+        Устанавливает текущее значение показателя name
+
+        :param name: str - имя показателя
+        :param value: float - значение
+        """
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(
+        self, name: str, value: float, buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        """
+        Добавляет значение в гистограмму name
+
+        :param name: str - имя гистограммы
+        :param value: float - наблюдаемое значение
+        :param buckets: границы корзин, используются при первом обращении
+        """
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(buckets)
+            self._histograms[name].observe(value)
+
+    def get(self, name: str) -> int:
+        return self._counters.get(name, 0)
+
+    def snapshot(self, prefix: str = "") -> dict:
+        """
+        Возвращает текущие значения метрик, имя которых начинается с prefix
+
+        :param prefix: str - префикс имени метрики
+        :return: dict - {"counters": {...}, "gauges": {...}, "histograms": {...}}
+        """
+        with self._lock:
+            return {
+                "counters": {
+                    name: value
+                    for name, value in self._counters.items()
+                    if name.startswith(prefix)
+                },
+                "gauges": {
+                    name: value
+                    for name, value in self._gauges.items()
+                    if name.startswith(prefix)
+                },
+                "histograms": {
+                    name: histogram.to_dict()
+                    for name, histogram in self._histograms.items()
+                    if name.startswith(prefix)
+                },
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,224 @@
+import asyncio
+import base64
+import logging
+import uuid
+
+import aioimaplib
+import redis
+from app_celery.metrics import metrics
+from app_celery.render_service import (
+    AbstractRenderer,
+    RenderScheduler,
+    render_scheduler,
+    renderer,
+)
+from app_celery.services import MailService
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from email_sender.celery import celery_app
+
+PIPELINE_INLINE = "inline"
+PIPELINE_QUEUES = "queues"
+
+QUEUE_IO = "io"
+QUEUE_RENDER = "render"
+QUEUE_DELIVER = "deliver"
+PIPELINE_QUEUES_NAMES = (QUEUE_IO, QUEUE_RENDER, QUEUE_DELIVER)
+
+INLINE_REF = "inline:"
+REDIS_REF = "redis:"
+
+
+class MessageStore:
+    """
+    Хранилище содержимого писем и скриншотов, передаваемых между этапами конвейера.
+    Задачи этапов получают ссылки на данные, а не сами данные, чтобы не передавать
+    большие письма и изображения через брокер.
+    Без redis данные передаются в самой ссылке.
+
+    :param url: str - адрес redis
+    :param ttl: int - время хранения данных в секундах
+    :param prefix: str - префикс ключей
+    """
+
+    def __init__(
+        self, url: str = "", ttl: int = 60 * 60, prefix: str = "mail_pipeline"
+    ) -> None:
+        self.url = url
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client: redis.Redis | None = None
+
+    def _redis(self) -> redis.Redis | None:
+        if not self.url:
+            return None
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def put(self, data: bytes) -> str:
+        """
+        Метод сохранения данных
+
+        :param data: bytes - содержимое письма или скриншот
+        :return: str - ссылка на данные
+        """
+        client = self._redis()
+        if client is not None:
+            key = f"{self.prefix}:{uuid.uuid4().hex}"
+            try:
+                client.set(key, data, ex=self.ttl)
+                return f"{REDIS_REF}{key}"
+            except RedisError as err:
+                logging.warning(msg=f"Redis message store is unavailable: {err!r}")
+                metrics.incr("mail_pipeline.redis_errors")
+        return f"{INLINE_REF}{base64.b64encode(data).decode('ascii')}"
+
+    def get(self, ref: str) -> bytes:
+        """
+        Метод получения данных по ссылке
+
+        :raise KeyError: если срок хранения данных истек
+        """
+        if ref.startswith(INLINE_REF):
+            return base64.b64decode(ref[len(INLINE_REF) :])  # noqa: E203
+        data = self._redis().get(ref[len(REDIS_REF) :])  # type: ignore # noqa: E203
+        if data is None:
+            raise KeyError(ref)
+        return data
+
+    def delete(self, refs: list[str]) -> None:
+        """
+        Метод удаления данных, которые больше не нужны следующим этапам
+        """
+        keys = [
+            ref[len(REDIS_REF) :]  # noqa: E203
+            for ref in refs
+            if ref.startswith(REDIS_REF)
+        ]
+        client = self._redis()
+        if not keys or client is None:
+            return
+        try:
+            client.delete(*keys)
+        except RedisError as err:
+            logging.warning(msg=f"Redis message store is unavailable: {err!r}")
+
+
+message_store = MessageStore(url=settings.REDIS_URL, ttl=settings.MAIL_PIPELINE_TTL_SEC)
+
+
+class PipelineMailService(MailService):
+    """
+    Почтовый сервис этапа io конвейера: отбирает и загружает новые письма,
+    а рендер и отправку скриншотов передает задачам очередей render и deliver.
+    Письма ящика передаются одной задачей рендера и отмечаются прочитанными после передачи.
+    Письма, которые этапы render и deliver не смогли обработать за все попытки,
+    возвращаются в непрочитанные с откатом состояния синхронизации (release_messages).
+    Текстовые письма пользователей с режимом image или message обрабатываются без браузера
+    на этом же этапе.
+
+    :param store: MessageStore - хранилище содержимого писем
+    """
+
+    def __init__(self, *args, store: MessageStore = message_store, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.store = store
+        self.handoff: dict[str, list[tuple[int, str, str | None]]] = dict()
+
+    def _for_mailbox(self, imap_client: aioimaplib.IMAP4_SSL) -> "PipelineMailService":
+        mailbox_service = super()._for_mailbox(imap_client)
+        mailbox_service.handoff = dict()  # type: ignore
+        return mailbox_service  # type: ignore
+
+    async def generate_screenshot(
+        self, content: str, filename: str, msg_id: int, caption: str | None = None
+    ) -> None:
+        self.handoff.setdefault(filename, []).append((msg_id, content, caption))
+
+    async def _send_rendered(self, to_email: str) -> None:
+        """
+        Метод передачи загруженных писем ящика на этап рендера
+        """
+        # скриншоты текстовых писем, отложенные для отправки альбомом
+        await super()._send_rendered(to_email)
+        messages = sorted(self.handoff.pop(to_email, []))
+        if not messages:
+            return
+        try:
+            await asyncio.to_thread(self._hand_off, to_email, messages)
+        except Exception as err:
+            logging.error(
+                msg=f"Failed to hand off messages of {to_email}", exc_info=err
+            )
+            self.failed_uids.setdefault(to_email, set()).update(
+                uid for uid, *_ in messages
+            )
+            return
+        self.sent_uids.setdefault(to_email, set()).update(uid for uid, *_ in messages)
+        metrics.incr("mail_pipeline.handed_off", len(messages))
+
+    def _hand_off(
+        self, to_email: str, messages: list[tuple[int, str, str | None]]
+    ) -> None:
+        refs = [
+            [uid, self.store.put(content.encode()), caption]
+            for uid, content, caption in messages
+        ]
+        celery_app.send_task(
+            "render_mails",
+            kwargs=dict(
+                tg_id=self.mail_sender_service.user_id,
+                to_email=to_email,
+                messages=refs,
+            ),
+        )
+
+
+async def render_messages(
+    messages: list[tuple[int, str]],
+    message_renderer: AbstractRenderer = renderer,
+    scheduler: RenderScheduler = render_scheduler,
+) -> dict[int, bytes]:
+    """
+    Функция рендера скриншотов писем через очередь рендеров процесса,
+    как при рендере в задаче проверки
+
+    :param messages: список пар (uid письма, html письма)
+    :param message_renderer: AbstractRenderer - рендер писем
+    :param scheduler: RenderScheduler - очередь рендеров процесса
+    :return: dict - {uid письма: скриншот}, письма с ошибкой рендера отсутствуют
+    """
+
+    async def render(uid: int, content: str) -> tuple[int, bytes | None]:
+        try:
+            return uid, await message_renderer.render(content)
+        except Exception as err:
+            logging.error(msg=f"Failed to render message {uid}", exc_info=err)
+            return uid, None
+
+    tasks = [await scheduler.submit(render, uid, content) for uid, content in messages]
+    results = await asyncio.gather(*tasks)
+    return {uid: screenshot for uid, screenshot in results if screenshot is not None}
+
+
+def queue_depths(queues: tuple[str, ...] = PIPELINE_QUEUES_NAMES) -> dict[str, int]:
+    """
+    Функция получения числа сообщений в очередях брокера
+
+    :param queues: имена очередей
+    :return: dict - {очередь: число сообщений}, -1 если очередь недоступна
+    """
+    depths: dict[str, int] = dict()
+    with celery_app.connection_for_read() as connection:
+        for queue in queues:
+            try:
+                with connection.channel() as channel:
+                    depths[queue] = channel.queue_declare(
+                        queue=queue, passive=True
+                    ).message_count
+            except Exception as err:
+                logging.warning(msg=f"Failed to get depth of queue {queue}: {err!r}")
+                depths[queue] = -1
+    return depths
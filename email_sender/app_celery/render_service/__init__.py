@@ -0,0 +1,7 @@
+from .assets import AssetCache, AssetPolicy, asset_policy_from_settings
+from .base import AbstractRenderer, PartialScreenshot, RenderError
+from .cache import CachedRenderer, DiskRenderCache, RedisRenderCache, with_render_cache
+from .renderers import RemoteRenderer, browser_renderer_from_settings, renderer
+from .scheduler import RenderScheduler, render_scheduler
+from .server import RenderServer
+from .text import TextRenderer, text_renderer
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from app_celery.metrics import metrics
+from django.conf import settings
+
+if TYPE_CHECKING:
+    from playwright.async_api import Page, Route
+
+ASSETS_ALLOW = "allow"
+ASSETS_BLOCK = "block"
+ASSETS_FETCH = "fetch"
+ASSETS_CACHE = "cache"
+
+LOCAL_SCHEMES = ("data:", "blob:", "about:")
+
+
+class AssetCache:
+    """
+    Кэш внешних ресурсов писем (изображений, стилей, шрифтов) в памяти процесса,
+    общий для всех рендеров и ограниченный по размеру. При превышении max_bytes
+    вытесняются давно не использованные ресурсы.
+
+    :param max_bytes: int - максимальный суммарный размер ресурсов
+    :param max_item_bytes: int - максимальный размер одного ресурса, большие не кэшируются
+    """
+
+    def __init__(
+        self, max_bytes: int = 64 * 1024 * 1024, max_item_bytes: int = 2 * 1024 * 1024
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.size = 0
+        self._items: OrderedDict[str, tuple[int, dict[str, str], bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> tuple[int, dict[str, str], bytes] | None:
+        """
+        Метод получения ресурса
+
+        :param url: str - адрес ресурса
+        :return: (статус, заголовки, тело) или None, если ресурса нет в кэше
+        """
+        with self._lock:
+            item = self._items.get(url)
+            if item is not None:
+                self._items.move_to_end(url)
+            return item
+
+    def put(self, url: str, status: int, headers: dict[str, str], body: bytes) -> None:
+        """
+        Метод сохранения ресурса с вытеснением давно не использованных
+        """
+        if len(body) > self.max_item_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(url, None)
+            if previous is not None:
+                self.size -= len(previous[2])
+            self._items[url] = (status, headers, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self._items.popitem(last=False)
+                self.size -= len(evicted)
+                metrics.incr("render_assets.evicted")
+
+
+class AssetPolicy:
+    """
+    Политика загрузки внешних ресурсов при рендере письма. Запросы страницы
+    перехватываются маршрутизацией playwright:
+    - allow - ресурсы загружаются браузером без ограничений
+    - block - внешние ресурсы не загружаются, письмо рендерится без них
+    - fetch - ресурсы загружаются в пределах общего для рендера бюджета времени
+    - cache - как fetch, но ресурсы берутся из общего кэша и сохраняются в него
+
+    Встроенные изображения cid: уже подставлены в письмо как data: url при загрузке,
+    поэтому запросов за ними не бывает.
+
+    :param mode: str - режим: allow, block, fetch или cache
+    :param budget: float - бюджет времени на загрузку ресурсов одного рендера в секундах
+    :param cache: AssetCache - кэш ресурсов для режима cache
+    """
+
+    def __init__(
+        self,
+        mode: str = ASSETS_ALLOW,
+        budget: float = 2,
+        cache: AssetCache | None = None,
+    ) -> None:
+        self.mode = mode
+        self.budget = budget
+        self.cache = cache if cache is not None else AssetCache()
+
+    async def attach(self, page: "Page") -> None:
+        """
+        Метод подключения политики к странице перед загрузкой в нее письма
+        """
+        if self.mode == ASSETS_ALLOW:
+            return
+        deadline = time.monotonic() + self.budget
+
+        async def handle(route: "Route") -> None:
+            await self._handle(route, deadline)
+
+        await page.route("**/*", handle)
+
+    async def _handle(self, route: "Route", deadline: float) -> None:
+        url = route.request.url
+        if url.startswith(LOCAL_SCHEMES):
+            await route.continue_()
+            return
+        if self.mode == ASSETS_BLOCK:
+            metrics.incr("render_assets.blocked")
+            await route.abort("blockedbyclient")
+            return
+
+        if self.mode == ASSETS_CACHE:
+            cached = self.cache.get(url)
+            if cached is not None:
+                metrics.incr("render_assets.hits")
+                status, headers, body = cached
+                await route.fulfill(status=status, headers=headers, body=body)
+                return
+            metrics.incr("render_assets.misses")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            metrics.incr("render_assets.budget_exceeded")
+            await route.abort("timedout")
+            return
+        try:
+            response = await asyncio.wait_for(route.fetch(), timeout=remaining)
+            body = await asyncio.wait_for(
+                response.body(), timeout=max(deadline - time.monotonic(), 0)
+            )
+        except asyncio.TimeoutError:
+            metrics.incr("render_assets.budget_exceeded")
+            await route.abort("timedout")
+            return
+        except Exception as err:
+            logging.debug(msg=f"Failed to fetch asset {url}: {err!r}")
+            metrics.incr("render_assets.fetch_errors")
+            await route.abort("failed")
+            return
+        metrics.incr("render_assets.fetched")
+        metrics.incr("render_assets.bytes", len(body))
+        if self.mode == ASSETS_CACHE and response.ok:
+            self.cache.put(url, response.status, response.headers, body)
+        await route.fulfill(response=response, body=body)
+
+
+def asset_policy_from_settings() -> AssetPolicy:
+    """
+    Функция создания политики загрузки внешних ресурсов по настройкам RENDER_ASSETS
+    """
+    return AssetPolicy(
+        mode=settings.RENDER_ASSETS,
+        budget=settings.RENDER_ASSETS_BUDGET_MS / 1000,
+        cache=AssetCache(max_bytes=settings.RENDER_ASSETS_CACHE_MB * 1024 * 1024),
+    )
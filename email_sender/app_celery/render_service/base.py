@@ -0,0 +1,39 @@
+from abc import ABC, abstractmethod
+
+
+class RenderError(Exception):
+    """
+    Ошибка рендера письма
+    """
+
+
+class PartialScreenshot(bytes):
+    """
+    Скриншот письма, загрузка которого остановлена по сроку: отрисована только
+    часть письма. Такой скриншот отправляется пользователю, но не сохраняется
+    в кэш рендера, чтобы не отдавать его другим получателям той же рассылки
+    """
+
+
+class AbstractRenderer(ABC):
+    """
+    Базовый класс для создания сервиса рендера писем
+
+    Должен быть реализован метод render(content).
+    Метод close() закрывает ресурсы рендера и по умолчанию ничего не делает
+    """
+
+    @abstractmethod
+    async def render(self, content: str) -> bytes:
+        """
+        Метод рендера письма в изображение
+
+        :param content: str - html письма, встроенные изображения передаются в нем как data: url
+        :return: bytes - скриншот письма, PartialScreenshot - если письмо загружено не полностью
+        :raise RenderError: если письмо не удалось отрендерить
+        """
+
+    async def close(self) -> None:
+        """
+        Метод закрытия ресурсов рендера
+        """
@@ -0,0 +1,113 @@
+import logging
+import time
+
+from app_celery.browser_pool import BrowserPool, browser_pool
+from app_celery.metrics import metrics
+from playwright.async_api import Page
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+from .assets import AssetPolicy
+from .base import AbstractRenderer, PartialScreenshot, RenderError
+
+# фазы загрузки письма в порядке наступления
+WAIT_PHASES = ("domcontentloaded", "load", "networkidle")
+
+
+class BrowserRenderer(AbstractRenderer):
+    """
+    Рендер писем браузером из пула в процессе воркера.
+
+    Письмо загружается в страницу до фазы wait_until, но не дольше deadline секунд:
+    по истечении срока загрузка останавливается и снимается скриншот того,
+    что успело отрисоваться, и возвращается PartialScreenshot.
+    Длительность каждой фазы пишется в гистограммы render.phase.*
+
+    :param render_pool: BrowserPool - пул браузеров
+    :param asset_policy: AssetPolicy - политика загрузки внешних ресурсов письма,
+    None - ресурсы загружаются браузером без ограничений
+    :param wait_until: str - фаза загрузки перед скриншотом: domcontentloaded, load или networkidle
+    :param deadline: float - срок загрузки письма в секундах
+    :param screenshot_timeout: float - время ожидания скриншота в секундах
+    """
+
+    def __init__(
+        self,
+        render_pool: BrowserPool = browser_pool,
+        asset_policy: AssetPolicy | None = None,
+        wait_until: str = "load",
+        deadline: float = 10,
+        screenshot_timeout: float = 10,
+    ) -> None:
+        if wait_until not in WAIT_PHASES:
+            raise ValueError(f"Unknown render wait condition: {wait_until}")
+        self.render_pool = render_pool
+        self.asset_policy = asset_policy
+        self.wait_until = wait_until
+        self.deadline = deadline
+        self.screenshot_timeout = screenshot_timeout
+
+    async def render(self, content: str) -> bytes:
+        started = time.monotonic()
+        try:
+            async with self.render_pool.page() as page:
+                loading_started = time.monotonic()
+                metrics.observe("render.phase.page_seconds", loading_started - started)
+                if self.asset_policy is not None:
+                    await self.asset_policy.attach(page)
+                loaded = await self._load(
+                    page, content, loading_started + self.deadline
+                )
+
+                screenshot_started = time.monotonic()
+                screenshot = await page.screenshot(
+                    full_page=True, timeout=self.screenshot_timeout * 1000
+                )
+                metrics.observe(
+                    "render.phase.screenshot_seconds",
+                    time.monotonic() - screenshot_started,
+                )
+        except Exception as err:
+            raise RenderError(f"Failed to render message: {err!r}") from err
+        metrics.observe("render.seconds", time.monotonic() - started)
+        return screenshot if loaded else PartialScreenshot(screenshot)
+
+    async def _load(self, page: Page, content: str, deadline: float) -> bool:
+        """
+        Метод загрузки письма в страницу по фазам до wait_until в пределах срока deadline
+
+        :return: bool - False, если загрузка остановлена по сроку
+        """
+        phases = WAIT_PHASES[: WAIT_PHASES.index(self.wait_until) + 1]
+        phase_started = time.monotonic()
+        for phase in phases:
+            # timeout=0 в playwright отключает ограничение, поэтому минимум 1 мс
+            timeout = max((deadline - time.monotonic()) * 1000, 1)
+            try:
+                if phase == phases[0]:
+                    await page.set_content(content, wait_until=phase, timeout=timeout)
+                else:
+                    await page.wait_for_load_state(phase, timeout=timeout)
+            except PlaywrightTimeoutError:
+                metrics.incr("render.deadline_exceeded")
+                metrics.incr(f"render.deadline_exceeded.{phase}")
+                await self._stop_loading(page)
+                return False
+            metrics.observe(
+                f"render.phase.{phase}_seconds", time.monotonic() - phase_started
+            )
+            phase_started = time.monotonic()
+        return True
+
+    @staticmethod
+    async def _stop_loading(page: Page) -> None:
+        """
+        Метод остановки загрузки ресурсов, чтобы скриншот не ждал зависшие запросы
+        """
+        try:
+            await page.evaluate("window.stop()")
+        except Exception as err:
+            logging.warning(msg=f"Failed to stop page loading: {err!r}")
+
+    async def close(self) -> None:
+        if self.render_pool.started:
+            await self.render_pool.close()
@@ -0,0 +1,340 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+import redis
+from app_celery.metrics import metrics
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from .base import AbstractRenderer, PartialScreenshot
+
+RENDER_CACHE_OFF = "off"
+RENDER_CACHE_DISK = "disk"
+RENDER_CACHE_REDIS = "redis"
+
+LINE_BREAKS = re.compile(r"\r\n?")
+
+# KEYS: скриншот, время использования, размеры, общий размер;
+# ARGV: ключ кэша, скриншот, время хранения в секундах, время использования.
+# Скриншот, уже сохраненный другим воркером, не перезаписывается и не учитывается
+# в общем размере повторно. Размер скриншота, истекшего по ttl, но еще не вытесненного,
+# заменяется новым, поэтому общий размер остается суммой размеров
+PUT_SCRIPT = """
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1])
+if not redis.call('SET', KEYS[1], ARGV[2], 'NX', 'EX', ARGV[3]) then
+    return tonumber(redis.call('GET', KEYS[4]) or 0)
+end
+local size = string.len(ARGV[2])
+local previous = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or 0)
+redis.call('HSET', KEYS[3], ARGV[1], size)
+return redis.call('INCRBY', KEYS[4], size - previous)
+"""
+
+
+def content_key(content: str) -> str:
+    """
+    Ключ кэша рендера: хэш нормализованного html письма.
+    Нормализация не меняет результат рендера: приводятся переводы строк
+    и отбрасываются пробелы в начале и конце документа.
+
+    :param content: str - html письма
+    :return: str - ключ кэша
+    """
+    normalized = LINE_BREAKS.sub("\n", content).strip()
+    return hashlib.sha256(normalized.encode(errors="replace")).hexdigest()
+
+
+class AbstractRenderCache(ABC):
+    """
+    Базовый класс кэша скриншотов писем
+
+    Должны быть реализованы методы get(key) и put(key, screenshot).
+    Методы синхронные и вызываются из потоков, чтобы не блокировать событийный цикл
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> bytes | None:
+        """
+        Метод получения скриншота
+
+        :param key: str - ключ кэша
+        :return: bytes - скриншот или None, если его нет в кэше
+        """
+
+    @abstractmethod
+    def put(self, key: str, screenshot: bytes) -> None:
+        """
+        Метод сохранения скриншота с вытеснением давно не использованных
+
+        :param key: str - ключ кэша
+        :param screenshot: bytes - скриншот
+        """
+
+
+class DiskRenderCache(AbstractRenderCache):
+    """
+    Кэш скриншотов в файлах локального диска, ограниченный по размеру.
+    Время последнего использования хранится во времени изменения файла,
+    при превышении max_bytes удаляются давно не использованные скриншоты.
+
+    :param directory: str - директория кэша
+    :param max_bytes: int - максимальный суммарный размер скриншотов
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size: int | None = None
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = list()
+        with os.scandir(self.directory) as files:
+            for file in files:
+                if not file.name.endswith(".png"):
+                    continue
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file.path))
+        return entries
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                screenshot = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return screenshot
+
+    def put(self, key: str, screenshot: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        # запись во временный файл и переименование, чтобы читатели не видели файл частично
+        tmp_path = os.path.join(self.directory, f".{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as file:
+            file.write(screenshot)
+        os.replace(tmp_path, self._path(key))
+        self._size += len(screenshot)
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        # вытеснение до 90% размера, чтобы не сканировать директорию на каждой записи
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            metrics.incr("render_cache.evicted")
+
+
+class RedisRenderCache(AbstractRenderCache):
+    """
+    Кэш скриншотов в redis, общий для всех воркеров, ограниченный по размеру.
+    Время последнего использования скриншотов хранится в отсортированном множестве,
+    при превышении max_bytes удаляются давно не использованные скриншоты.
+    Ошибки redis не прерывают рендер: кэш считается пустым.
+
+    :param url: str - адрес redis
+    :param max_bytes: int - максимальный суммарный размер скриншотов
+    :param ttl: int - время хранения скриншота в секундах
+    :param prefix: str - префикс ключей
+    """
+
+    def __init__(
+        self,
+        url: str,
+        max_bytes: int = 256 * 1024 * 1024,
+        ttl: int = 7 * 24 * 60 * 60,
+        prefix: str = "render_cache",
+    ) -> None:
+        self.url = url
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client: redis.Redis | None = None
+
+    def _redis(self) -> redis.Redis:
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    @staticmethod
+    def _on_redis_error(err: RedisError) -> None:
+        logging.warning(msg=f"Redis render cache is unavailable: {err!r}")
+        metrics.incr("render_cache.redis_errors")
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            screenshot = self._redis().get(f"{self.prefix}:{key}")
+            if screenshot is not None:
+                self._redis().zadd(f"{self.prefix}:used", {key: time.time()})
+        except RedisError as err:
+            self._on_redis_error(err)
+            return None
+        return screenshot
+
+    def put(self, key: str, screenshot: bytes) -> None:
+        try:
+            size = self._redis().eval(
+                PUT_SCRIPT,
+                4,
+                f"{self.prefix}:{key}",
+                f"{self.prefix}:used",
+                f"{self.prefix}:sizes",
+                f"{self.prefix}:bytes",
+                key,
+                screenshot,
+                self.ttl,
+                time.time(),
+            )
+            if size > self.max_bytes:
+                self._evict()
+        except RedisError as err:
+            self._on_redis_error(err)
+
+    def _evict(self, batch: int = 16) -> None:
+        client = self._redis()
+        while int(client.get(f"{self.prefix}:bytes") or 0) > self.max_bytes * 0.9:
+            oldest = client.zpopmin(f"{self.prefix}:used", batch)
+            if not oldest:
+                client.set(f"{self.prefix}:bytes", 0)
+                return
+            keys = [key.decode() for key, _ in oldest]
+            sizes = client.hmget(f"{self.prefix}:sizes", keys)
+            with client.pipeline() as pipe:
+                pipe.delete(*(f"{self.prefix}:{key}" for key in keys))
+                pipe.hdel(f"{self.prefix}:sizes", *keys)
+                pipe.decrby(
+                    f"{self.prefix}:bytes", sum(int(size or 0) for size in sizes)
+                )
+                pipe.execute()
+            metrics.incr("render_cache.evicted", len(keys))
+
+
+class CachedRenderer(AbstractRenderer):
+    """
+    Рендер с кэшем скриншотов по хэшу содержимого письма: одинаковые рассылки,
+    приходящие многим пользователям, рендерятся один раз. Одновременные рендеры
+    одинакового содержимого в процессе также выполняются один раз.
+    Скриншоты писем, загрузка которых остановлена по сроку (PartialScreenshot),
+    в кэш не сохраняются.
+
+    Заголовок письма с адресами отправителя и получателя должен передаваться
+    подписью скриншота (RENDER_HEADER=caption), иначе он входит в содержимое
+    и скриншоты разных получателей не совпадают.
+
+    :param renderer: AbstractRenderer - рендер, выполняющий промахи кэша
+    :param cache: AbstractRenderCache - кэш скриншотов
+    """
+
+    def __init__(self, renderer: AbstractRenderer, cache: AbstractRenderCache) -> None:
+        self.renderer = renderer
+        self.cache = cache
+        self._inflight: dict[str, asyncio.Future] = dict()
+
+    async def render(self, content: str) -> bytes:
+        key = content_key(content)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            metrics.incr("render_cache.coalesced")
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # отменен рендер, которого ожидали, а не текущая задача
+                if not inflight.cancelled():
+                    raise
+            return await self.renderer.render(content)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            screenshot = await self._render(key, content)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as err:
+            future.set_exception(err)
+            # исключение получают ожидающие рендеры, если они есть
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+        future.set_result(screenshot)
+        return screenshot
+
+    async def _render(self, key: str, content: str) -> bytes:
+        try:
+            screenshot = await asyncio.to_thread(self.cache.get, key)
+        except OSError as err:
+            logging.warning(msg=f"Render cache is unavailable: {err!r}")
+            screenshot = None
+        if screenshot is not None:
+            metrics.incr("render_cache.hits")
+            return screenshot
+
+        metrics.incr("render_cache.misses")
+        screenshot = await self.renderer.render(content)
+        # письмо, не загрузившееся к сроку, рендерится заново для следующих получателей
+        if isinstance(screenshot, PartialScreenshot):
+            metrics.incr("render_cache.partial_skipped")
+            return screenshot
+        try:
+            await asyncio.to_thread(self.cache.put, key, screenshot)
+        except OSError as err:
+            logging.warning(msg=f"Failed to save screenshot to render cache: {err!r}")
+        return screenshot
+
+    async def close(self) -> None:
+        await self.renderer.close()
+
+
+def render_cache_from_settings() -> AbstractRenderCache | None:
+    """
+    Функция создания кэша скриншотов по настройке RENDER_CACHE
+    """
+    max_bytes = settings.RENDER_CACHE_MAX_MB * 1024 * 1024
+    if settings.RENDER_CACHE == RENDER_CACHE_DISK:
+        return DiskRenderCache(directory=settings.RENDER_CACHE_DIR, max_bytes=max_bytes)
+    if settings.RENDER_CACHE == RENDER_CACHE_REDIS and settings.REDIS_URL:
+        return RedisRenderCache(
+            url=settings.REDIS_URL,
+            max_bytes=max_bytes,
+            ttl=settings.RENDER_CACHE_TTL_SEC,
+        )
+    return None
+
+
+def with_render_cache(renderer: AbstractRenderer) -> AbstractRenderer:
+    """
+    Функция добавления к рендеру кэша скриншотов, если он включен в настройках
+    """
+    cache = render_cache_from_settings()
+    if cache is None:
+        return renderer
+    if settings.RENDER_HEADER != "caption":
+        logging.warning(
+            msg="Render cache is enabled without RENDER_HEADER=caption: "
+            "the recipient header is rendered into every screenshot, "
+            "so screenshots are not shared between recipients"
+        )
+    return CachedRenderer(renderer, cache)
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+import weakref
+from typing import TYPE_CHECKING
+
+import aiohttp
+from app_celery.metrics import metrics
+from django.conf import settings
+
+from .base import AbstractRenderer, PartialScreenshot, RenderError
+from .cache import with_render_cache
+
+if TYPE_CHECKING:
+    from app_celery.browser_pool import BrowserPool
+
+    from .browser import BrowserRenderer
+
+RENDER_LOCAL = "local"
+RENDER_REMOTE = "remote"
+UNIX_SCHEME = "unix://"
+# адрес для http-запросов через unix-сокет, хост в нем не используется
+UNIX_BASE_URL = "http://render-service"
+# заголовок ответа сервиса рендера со скриншотом, загрузка которого остановлена по сроку
+PARTIAL_HEADER = "X-Render-Partial"
+
+
+class RemoteRenderer(AbstractRenderer):
+    """
+    Рендер писем сервисом рендера (RenderServer) по http или через unix-сокет,
+    чтобы воркерам не требовались playwright и браузер.
+
+    Сессия с пулом соединений создается лениво на каждый событийный цикл
+    и переиспользуется всеми задачами процесса.
+
+    :param url: str - адрес сервиса: http://host:port или unix:///путь/к/сокету
+    :param timeout: float - время ожидания рендера в секундах, включая очередь сервиса
+    :param connections_limit: int - максимальное число одновременных соединений с сервисом
+    """
+
+    def __init__(
+        self, url: str, timeout: float = 60, connections_limit: int = 100
+    ) -> None:
+        self.url = url
+        self.timeout = timeout
+        self.connections_limit = connections_limit
+        self._sessions: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, aiohttp.ClientSession
+        ] = weakref.WeakKeyDictionary()
+
+    @property
+    def base_url(self) -> str:
+        if self.url.startswith(UNIX_SCHEME):
+            return UNIX_BASE_URL
+        return self.url.rstrip("/")
+
+    def _session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector: aiohttp.BaseConnector
+            if self.url.startswith(UNIX_SCHEME):
+                connector = aiohttp.UnixConnector(
+                    path=self.url[len(UNIX_SCHEME) :],  # noqa: E203
+                    limit=self.connections_limit,
+                )
+            else:
+                connector = aiohttp.TCPConnector(limit=self.connections_limit)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._sessions[loop] = session
+        return session
+
+    async def render(self, content: str) -> bytes:
+        started = time.monotonic()
+        try:
+            async with self._session().post(
+                f"{self.base_url}/render",
+                data=content.encode(),
+                headers={"Content-Type": "text/html; charset=utf-8"},
+            ) as response:
+                if response.status != 200:
+                    raise RenderError(
+                        f"Render service responded {response.status}: "
+                        f"{await response.text()}"
+                    )
+                screenshot = await response.read()
+                if response.headers.get(PARTIAL_HEADER):
+                    screenshot = PartialScreenshot(screenshot)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            metrics.incr("render_client.errors")
+            raise RenderError(f"Render service is unavailable: {err!r}") from err
+        except RenderError:
+            metrics.incr("render_client.errors")
+            raise
+        metrics.incr("render_client.renders")
+        metrics.observe("render_client.seconds", time.monotonic() - started)
+        return screenshot
+
+    async def close(self) -> None:
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+            logging.info(msg="Render service session closed")
+
+
+def renderer_from_settings() -> AbstractRenderer:
+    """
+    Функция создания рендера писем по настройкам RENDER_BACKEND и RENDER_CACHE
+    """
+    if settings.RENDER_BACKEND == RENDER_REMOTE:
+        return with_render_cache(
+            RemoteRenderer(
+                url=settings.RENDER_SERVICE_URL,
+                timeout=settings.RENDER_SERVICE_TIMEOUT_SEC,
+            )
+        )
+    return with_render_cache(browser_renderer_from_settings())
+
+
+def browser_renderer_from_settings(
+    render_pool: "BrowserPool | None" = None,
+) -> "BrowserRenderer":
+    """
+    Функция создания рендера браузером с настройками загрузки писем из настроек проекта.
+    Пул браузеров и playwright импортируются только здесь, поэтому воркерам
+    с сервисом рендера (RENDER_BACKEND=remote) playwright не нужен.
+
+    :param render_pool: BrowserPool - пул браузеров, None - общий пул процесса
+    """
+    from app_celery.browser_pool import browser_pool
+
+    from .assets import asset_policy_from_settings
+    from .browser import BrowserRenderer
+
+    return BrowserRenderer(
+        render_pool or browser_pool,
+        asset_policy=asset_policy_from_settings(),
+        wait_until=settings.RENDER_WAIT_UNTIL,
+        deadline=settings.RENDER_DEADLINE_MS / 1000,
+        screenshot_timeout=settings.RENDER_SCREENSHOT_TIMEOUT_MS / 1000,
+    )
+
+
+renderer = renderer_from_settings()
@@ -0,0 +1,117 @@
+import asyncio
+import time
+import weakref
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import Any, TypeVar
+
+from app_celery.metrics import metrics
+from django.conf import settings
+
+T = TypeVar("T")
+
+
+@dataclass
+class SchedulerState:
+    """Очередь рендеров одного событийного цикла"""
+
+    admission: asyncio.Semaphore
+    running: asyncio.Semaphore
+    queued: int = 0
+    active: int = 0
+
+
+class RenderScheduler:
+    """
+    Ограничитель рендеров процесса, общий для всех почтовых сервисов событийного цикла.
+
+    Одновременно выполняется не больше concurrency рендеров, еще queue_size ожидают
+    в очереди. Когда очередь заполнена, submit() не возвращается, пока не освободится
+    место, поэтому загрузка писем с imap-сервера приостанавливается, а не накапливает
+    в памяти задачи рендера для всех новых писем ящика.
+
+    :param concurrency: int - число одновременных рендеров
+    :param queue_size: int - число рендеров, ожидающих выполнения
+    """
+
+    def __init__(self, concurrency: int = 2, queue_size: int = 8) -> None:
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self._states: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, SchedulerState
+        ] = weakref.WeakKeyDictionary()
+
+    def _state(self) -> SchedulerState:
+        loop = asyncio.get_running_loop()
+        state = self._states.get(loop)
+        if state is None:
+            state = SchedulerState(
+                admission=asyncio.Semaphore(self.concurrency + self.queue_size),
+                running=asyncio.Semaphore(self.concurrency),
+            )
+            self._states[loop] = state
+        return state
+
+    async def submit(
+        self, func: Callable[..., Awaitable[T]], *args: Any
+    ) -> "asyncio.Task[T]":
+        """
+        Метод постановки рендера в очередь. Ожидает места в очереди, если она заполнена.
+
+        :param func: асинхронная функция рендера
+        :param args: аргументы функции
+        :return: задача рендера
+        """
+        state = self._state()
+        if state.admission.locked():
+            metrics.incr("render_scheduler.backpressure")
+        wait_started = time.monotonic()
+        await state.admission.acquire()
+        metrics.observe(
+            "render_scheduler.admission_wait_seconds", time.monotonic() - wait_started
+        )
+        state.queued += 1
+        metrics.set_gauge("render_scheduler.queued", state.queued)
+        return asyncio.create_task(self._run(state, func, *args))
+
+    async def _run(
+        self, state: SchedulerState, func: Callable[..., Awaitable[T]], *args: Any
+    ) -> T:
+        queued_at = time.monotonic()
+        try:
+            await state.running.acquire()
+        except BaseException:
+            state.queued -= 1
+            state.admission.release()
+            raise
+        state.queued -= 1
+        state.active += 1
+        metrics.set_gauge("render_scheduler.queued", state.queued)
+        metrics.set_gauge("render_scheduler.active", state.active)
+        metrics.observe(
+            "render_scheduler.queue_wait_seconds", time.monotonic() - queued_at
+        )
+        try:
+            return await func(*args)
+        finally:
+            state.active -= 1
+            metrics.set_gauge("render_scheduler.active", state.active)
+            state.running.release()
+            state.admission.release()
+
+    def stats(self) -> dict:
+        """
+        Статистика очереди текущего событийного цикла: выполняемые и ожидающие рендеры
+        """
+        state = self._state()
+        return {
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "active": state.active,
+            "queued": state.queued,
+        }
+
+
+render_scheduler = RenderScheduler(
+    concurrency=settings.RENDER_CONCURRENCY, queue_size=settings.RENDER_QUEUE_SIZE
+)
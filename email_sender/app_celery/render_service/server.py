@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from app_celery.metrics import metrics
+
+from .base import AbstractRenderer, PartialScreenshot
+from .renderers import PARTIAL_HEADER, UNIX_SCHEME
+
+
+class RenderServer:
+    """
+    Сервис рендера писем: долгоживущий asyncio-процесс с браузерами,
+    принимающий html письма по http или через unix-сокет и возвращающий скриншот.
+
+    API:
+    - POST /render - тело запроса: html письма (встроенные изображения - data: url),
+      ответ: image/png, с заголовком X-Render-Partial, если загрузка письма
+      остановлена по сроку; 503 - очередь сервиса заполнена, 500 - ошибка рендера
+    - GET /health - число выполняемых и ожидающих рендеров и метрики сервиса
+
+    Одновременно выполняется не больше concurrency рендеров, еще queue_size запросов
+    ожидают в очереди, остальные сразу отклоняются, чтобы клиенты не ждали
+    перегруженный сервис до таймаута.
+
+    :param renderer: AbstractRenderer - рендер, выполняющий запросы (обычно BrowserRenderer)
+    :param concurrency: int - число одновременных рендеров
+    :param queue_size: int - число запросов, ожидающих рендера
+    :param max_body_bytes: int - максимальный размер html письма
+    """
+
+    def __init__(
+        self,
+        renderer: AbstractRenderer,
+        concurrency: int = 2,
+        queue_size: int = 50,
+        max_body_bytes: int = 10 * 1024 * 1024,
+    ) -> None:
+        self.renderer = renderer
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.max_body_bytes = max_body_bytes
+        self.active = 0
+        self.waiting = 0
+        self._semaphore: asyncio.Semaphore | None = None
+
+    def app(self) -> web.Application:
+        """
+        Метод создания приложения aiohttp сервиса
+        """
+        app = web.Application(client_max_size=self.max_body_bytes)
+        app.router.add_post("/render", self.render)
+        app.router.add_get("/health", self.health)
+        app.on_cleanup.append(self._close)
+        return app
+
+    async def _close(self, app: web.Application) -> None:
+        await self.renderer.close()
+
+    async def render(self, request: web.Request) -> web.Response:
+        if self.waiting >= self.queue_size:
+            metrics.incr("render_service.rejected")
+            return web.Response(status=503, text="Render queue is full")
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        # место в очереди занимается до первого await, иначе запросы, читающие тело,
+        # проходят проверку одновременно и очередь превышает queue_size
+        self.waiting += 1
+        wait_started = time.monotonic()
+        try:
+            content = await request.text()
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        metrics.observe("render_service.wait_seconds", time.monotonic() - wait_started)
+
+        self.active += 1
+        render_started = time.monotonic()
+        try:
+            screenshot = await self.renderer.render(content)
+        except Exception as err:
+            logging.error(msg="Failed to render message", exc_info=err)
+            metrics.incr("render_service.errors")
+            return web.Response(status=500, text=repr(err))
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+        metrics.incr("render_service.renders")
+        metrics.observe(
+            "render_service.render_seconds", time.monotonic() - render_started
+        )
+        headers = (
+            {PARTIAL_HEADER: "1"} if isinstance(screenshot, PartialScreenshot) else None
+        )
+        return web.Response(body=screenshot, content_type="image/png", headers=headers)
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def stats(self) -> dict:
+        """
+        Статистика сервиса: выполняемые и ожидающие рендеры, счетчики и гистограммы
+        """
+        snapshot = metrics.snapshot(prefix="render_service.")
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "waiting": self.waiting,
+            **snapshot["counters"],
+            **snapshot["histograms"],
+        }
+
+    async def serve(self, url: str) -> None:
+        """
+        Метод запуска сервиса до отмены корутины
+
+        :param url: str - адрес сервиса: http://host:port или unix:///путь/к/сокету
+        """
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site: web.BaseSite
+        if url.startswith(UNIX_SCHEME):
+            site = web.UnixSite(runner, url[len(UNIX_SCHEME) :])  # noqa: E203
+        else:
+            address = urlsplit(url)
+            site = web.TCPSite(runner, address.hostname, address.port)
+        await site.start()
+        logging.info(msg=f"Render service is listening on {url}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            logging.info(msg=f"Render service stopped, stats: {self.stats()}")
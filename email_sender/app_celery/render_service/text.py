@@ -0,0 +1,163 @@
+import asyncio
+import io
+import logging
+import time
+
+from app_celery.metrics import metrics
+from django.conf import settings
+
+from .base import AbstractRenderer, RenderError
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:  # pragma: no cover
+    Image = None
+
+
+class TextRenderer(AbstractRenderer):
+    """
+    Рендер текстовых писем (text/plain) без браузера: текст переносится по ширине
+    изображения и рисуется шрифтом font_path средствами Pillow.
+    Рендер выполняется в потоке и не требует браузера и его памяти.
+
+    :param font_path: str - путь или имя файла шрифта truetype с поддержкой кириллицы
+    :param font_size: int - размер шрифта в пикселях
+    :param width: int - ширина изображения в пикселях
+    :param padding: int - отступ текста от краев изображения в пикселях
+    :param max_chars: int - максимальная длина текста, остаток письма отбрасывается
+    :param max_lines: int - максимальное число строк после переноса, ограничивает высоту
+    изображения для писем из коротких строк, остаток письма отбрасывается
+    """
+
+    def __init__(
+        self,
+        font_path: str = "DejaVuSans.ttf",
+        font_size: int = 15,
+        width: int = 800,
+        padding: int = 16,
+        max_chars: int = 20000,
+        max_lines: int = 1000,
+    ) -> None:
+        self.font_path = font_path
+        self.font_size = font_size
+        self.width = width
+        self.padding = padding
+        self.max_chars = max_chars
+        self.max_lines = max_lines
+        self._font: "ImageFont.FreeTypeFont | None" = None
+
+    @property
+    def line_height(self) -> int:
+        return round(self.font_size * 1.4)
+
+    def font(self) -> "ImageFont.FreeTypeFont":
+        """
+        Шрифт рендера, загружается один раз. Если файл шрифта не найден,
+        используется встроенный шрифт Pillow без кириллицы
+        """
+        if self._font is None:
+            try:
+                self._font = ImageFont.truetype(self.font_path, self.font_size)
+            except OSError as err:
+                logging.warning(msg=f"Failed to load font {self.font_path}: {err!r}")
+                self._font = ImageFont.load_default()
+        return self._font
+
+    async def render(self, content: str) -> bytes:
+        if Image is None:
+            raise RenderError("Pillow is not installed")
+        started = time.monotonic()
+        try:
+            screenshot = await asyncio.to_thread(self.render_sync, content)
+        except Exception as err:
+            raise RenderError(f"Failed to render text message: {err!r}") from err
+        metrics.incr("render.text")
+        metrics.observe("render.text_seconds", time.monotonic() - started)
+        return screenshot
+
+    def render_sync(self, content: str) -> bytes:
+        """
+        Метод рендера текста в png. Выполняется синхронно, поэтому вызывается из потока
+        """
+        if len(content) > self.max_chars:
+            content = f"{content[:self.max_chars]}\n…"
+            metrics.incr("render.text_truncated")
+        font = self.font()
+        lines = self.wrap(content, font)
+        if len(lines) > self.max_lines:
+            lines = lines[: self.max_lines - 1] + ["…"]
+            metrics.incr("render.text_truncated")
+        # изображение в оттенках серого быстрее кодируется и вдвое меньше цветного
+        image = Image.new(
+            "L", (self.width, self.padding * 2 + self.line_height * len(lines)), 255
+        )
+        draw = ImageDraw.Draw(image)
+        for i, line in enumerate(lines):
+            draw.text(
+                (self.padding, self.padding + i * self.line_height),
+                line,
+                fill=0,
+                font=font,
+            )
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        return buffer.getvalue()
+
+    def wrap(self, text: str, font: "ImageFont.FreeTypeFont") -> list[str]:
+        """
+        Метод переноса текста по словам в ширину изображения.
+        Ширина строки считается суммой ширин слов и пробелов, ширина слова измеряется
+        один раз на текст. Слова длиннее строки разрываются
+
+        :param text: str - текст письма
+        :param font: шрифт, которым измеряется ширина строк
+        :return: список строк
+        """
+        max_width = self.width - self.padding * 2
+        space = font.getlength(" ")
+        widths: dict[str, float] = dict()
+        lines: list[str] = list()
+        for paragraph in text.expandtabs(4).splitlines() or [""]:
+            line: list[str] = list()
+            line_width = 0.0
+            for word in paragraph.split(" "):
+                if word not in widths:
+                    widths[word] = font.getlength(word)
+                width = widths[word]
+                if line_width + space * bool(line) + width <= max_width:
+                    line_width += space * bool(line) + width
+                    line.append(word)
+                    continue
+                if line:
+                    lines.append(" ".join(line))
+                while width > max_width:
+                    cut = self._fit(word, font, max_width)
+                    lines.append(word[:cut])
+                    word = word[cut:]
+                    width = font.getlength(word)
+                line, line_width = [word], width
+            lines.append(" ".join(line))
+        return lines
+
+    @staticmethod
+    def _fit(word: str, font: "ImageFont.FreeTypeFont", max_width: float) -> int:
+        """
+        Число первых символов слова, умещающихся в строку, но не меньше одного
+        """
+        low, high = 1, len(word)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if font.getlength(word[:middle]) <= max_width:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+
+text_renderer = TextRenderer(
+    font_path=settings.RENDER_TEXT_FONT,
+    font_size=settings.RENDER_TEXT_FONT_SIZE,
+    width=settings.RENDER_TEXT_WIDTH,
+    max_chars=settings.RENDER_TEXT_MAX_CHARS,
+    max_lines=settings.RENDER_TEXT_MAX_LINES,
+)
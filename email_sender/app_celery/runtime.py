@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Coroutine, TypeVar
+
+from app_celery.metrics import metrics
+from django.conf import settings
+
+T = TypeVar("T")
+ShutdownHook = Callable[[], Awaitable[Any]]
+
+LOOP_ASYNCIO = "asyncio"
+LOOP_UVLOOP = "uvloop"
+
+
+class AsyncRuntime:
+    """
+    Асинхронная среда процесса воркера: один событийный цикл на процесс,
+    на котором выполняются корутины всех задач.
+
+    Ресурсы, привязанные к циклу (пул браузеров, сессия бота, соединения с redis),
+    переживают отдельные задачи и закрываются хуками при остановке процесса.
+    Цикл создается при первом обращении в каждом процессе, поэтому после fork
+    дочерний процесс не использует цикл родителя.
+
+    :param loop_impl: str - реализация цикла: asyncio или uvloop (если установлен)
+    """
+
+    def __init__(self, loop_impl: str = LOOP_ASYNCIO) -> None:
+        self.loop_impl = loop_impl
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._pid: int | None = None
+        self._hooks: list[ShutdownHook] = list()
+
+    def _new_loop(self) -> asyncio.AbstractEventLoop:
+        if self.loop_impl == LOOP_UVLOOP:
+            try:
+                import uvloop
+
+                return uvloop.new_event_loop()
+            except ImportError:
+                logging.warning(msg="uvloop is not installed, asyncio loop is used")
+        return asyncio.new_event_loop()
+
+    @property
+    def started(self) -> bool:
+        return (
+            self._loop is not None
+            and not self._loop.is_closed()
+            and self._pid == os.getpid()
+        )
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """
+        Событийный цикл текущего процесса, создается при первом обращении
+        """
+        if not self.started:
+            self.start()
+        return self._loop  # type: ignore
+
+    def start(self) -> None:
+        """
+        Метод создания событийного цикла процесса
+        """
+        if self.started:
+            return
+        self._loop = self._new_loop()
+        self._pid = os.getpid()
+        asyncio.set_event_loop(self._loop)
+        metrics.incr("worker_runtime.loops")
+        logging.info(msg=f"Worker event loop started: {type(self._loop).__name__}")
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        """
+        Метод выполнения корутины задачи на цикле процесса
+
+        :param coro: корутина
+        :return: результат корутины
+        """
+        return self.loop.run_until_complete(coro)
+
+    def on_shutdown(self, hook: ShutdownHook) -> ShutdownHook:
+        """
+        Метод регистрации асинхронного хука закрытия ресурса.
+        Хуки выполняются при остановке в обратном порядке регистрации.
+        Может использоваться как декоратор.
+        """
+        self._hooks.append(hook)
+        return hook
+
+    def shutdown(self) -> None:
+        """
+        Метод остановки: выполняет хуки закрытия ресурсов, отменяет
+        оставшиеся задачи цикла и закрывает его. Повторный вызов ничего не делает.
+        """
+        if not self.started:
+            return
+        loop: asyncio.AbstractEventLoop = self._loop  # type: ignore
+        try:
+            loop.run_until_complete(self._run_hooks())
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(
+                    asyncio.gather(*pending, return_exceptions=True)
+                )
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+            self._loop = None
+            asyncio.set_event_loop(None)
+            logging.info(msg="Worker event loop closed")
+
+    async def _run_hooks(self) -> None:
+        for hook in reversed(self._hooks):
+            try:
+                await hook()
+            except Exception as err:
+                logging.error(msg=f"Shutdown hook {hook!r} failed", exc_info=err)
+
+
+worker_runtime = AsyncRuntime(loop_impl=settings.WORKER_EVENT_LOOP)
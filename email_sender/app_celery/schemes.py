@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 @dataclass
@@ -8,3 +8,5 @@ class Mail:
     email: str
     password: bytes | str
     provider: dict
+    uid_validity: int | None = field(default=None, compare=False)
+    last_uid: int = field(default=0, compare=False)
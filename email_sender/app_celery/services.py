@@ -1,24 +1,96 @@
 import asyncio
+import copy
 import datetime
+import html
 import imaplib
 import logging
+import os
 import re
 import uuid
+import weakref
 from asyncio import Task
+from contextlib import suppress
 from email.parser import BytesHeaderParser, BytesParser
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
 import aioimaplib
 from api.encrypt import EncryptionService, encryption_service
+from app_celery import bodystructure
 from app_celery.abstracts import AbstractMailService
 from app_celery.mailsender_service import MailSender
+from app_celery.metrics import metrics
+from app_celery.render_service import (
+    AbstractRenderer,
+    RenderScheduler,
+    render_scheduler,
+    renderer,
+    text_renderer,
+)
+from app_celery.runtime import worker_runtime
 from app_celery.schemes import Mail
 from app_celery.utils import MAIL_FOLDER, STATE_AUTH
-from playwright.async_api import async_playwright
+from django.conf import settings
+
+if TYPE_CHECKING:
+    from app_celery.browser_pool import BrowserPool
 
 ID_HEADER_SET = {"From", "To", "Date"}
 FETCH_MESSAGE_DATA_UID = re.compile(rb".*UID (?P<uid>\d+).*")
 FETCH_MESSAGE_DATA_FLAGS = re.compile(rb".*FLAGS \((?P<flags>.*?)\).*")
+SELECT_UIDVALIDITY = re.compile(rb"\[UIDVALIDITY (?P<uid_validity>\d+)\]")
+SELECT_UIDNEXT = re.compile(rb"\[UIDNEXT (?P<uid_next>\d+)\]")
+IMAP_MONTHS = (
+    "Jan",
+    "Feb",
+    "Mar",
+    "Apr",
+    "May",
+    "Jun",
+    "Jul",
+    "Aug",
+    "Sep",
+    "Oct",
+    "Nov",
+    "Dec",
+)
+FETCH_PATH_SEARCH = "search"
+FETCH_PATH_CLIENT = "fetch"
+FETCH_MODE_STRUCTURE = "bodystructure"
+FETCH_MODE_RFC822 = "rfc822"
+HEADER_INLINE = "inline"
+HEADER_CAPTION = "caption"
+PLAIN_TEXT_BROWSER = "browser"
+PLAIN_TEXT_IMAGE = "image"
+PLAIN_TEXT_MESSAGE = "message"
+
+# ограничения числа соединений с одним imap-сервером, общие для всех сервисов событийного цикла
+_host_limits: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[str, asyncio.Semaphore]
+] = weakref.WeakKeyDictionary()
+
+
+def host_limit(host: str, limit: int) -> asyncio.Semaphore:
+    """
+    Возвращает семафор, ограничивающий число одновременных соединений с сервером host
+    в текущем событийном цикле
+
+    :param host: str - адрес imap-сервера
+    :param limit: int - максимальное число соединений
+    """
+    limits = _host_limits.setdefault(asyncio.get_running_loop(), dict())
+    if host not in limits:
+        limits[host] = asyncio.Semaphore(limit)
+    return limits[host]
+
+
+def plain_text_html(text: str) -> str:
+    """
+    Разметка текстового письма для рендера браузером с сохранением переносов строк
+    """
+    return (
+        '<pre style="white-space: pre-wrap; font-family: sans-serif;">'
+        f"{html.escape(text)}</pre>"
+    )
 
 
 class MailService(AbstractMailService):
@@ -35,6 +107,32 @@ class MailService(AbstractMailService):
     :param timeout: int, таймоут ожидания для подключения к серверу. По умолчанию 10 секунд
     :param send_method: any - Сервис отправки сообщения. Это может быть телеграм бот,
     SMTP совместимый сервис или любой другой пользовательский сервис, способный принимать входящие файлы
+    :param render_pool: BrowserPool - пул браузеров для рендера писем. По умолчанию None - общий пул процесса
+    :param renderer: AbstractRenderer - рендер писем, например RemoteRenderer сервиса рендера.
+    По умолчанию None - рендер браузером из render_pool
+    :param resync_window: int - число последних писем, просматриваемых при первой синхронизации ящика
+    или после смены UIDVALIDITY. По умолчанию 500
+    :param search_enabled: bool - отбирать письма на сервере командой UID SEARCH.
+    Если сервер не смог выполнить поиск, используется отбор по заголовкам на клиенте. По умолчанию True
+    :param search_chunk_size: int - максимальное число отправителей в одной команде поиска. По умолчанию 20
+    :param max_connections: int - число почтовых ящиков, проверяемых одновременно. По умолчанию 4
+    :param max_host_connections: int - максимальное число одновременных соединений с одним imap-сервером
+    в пределах процесса. По умолчанию 8
+    :param fetch_mode: str - способ загрузки письма: bodystructure - только часть для рендера
+    и встроенные изображения, rfc822 - письмо целиком. По умолчанию bodystructure
+    :param fetch_max_bytes: int - бюджет байт на загрузку одного письма в режиме bodystructure,
+    0 - без ограничения. По умолчанию 1 МБ
+    :param fetch_batch_size: int - максимальное число писем в одной команде загрузки. По умолчанию 50
+    :param album_size: int - число скриншотов, отправляемых одним альбомом после рендера всех писем ящика.
+    По умолчанию 1 - каждый скриншот отправляется сразу после рендера
+    :param render_scheduler: RenderScheduler - очередь рендеров, общая для сервисов процесса.
+    Загрузка писем приостанавливается, пока в очереди нет места
+    :param header_mode: str - где показывать отправителя и получателя письма: inline - над письмом
+    на скриншоте, caption - в подписи скриншота, тогда скриншоты одинаковых рассылок разных получателей
+    совпадают и берутся из кэша рендера. По умолчанию inline
+    :param plain_text_mode: str - отображение писем только с text/plain: browser - скриншот браузером,
+    image - изображение текста без браузера, message - текстовое сообщение. По умолчанию browser
+    :param text_renderer: AbstractRenderer - рендер текстовых писем без браузера для режима image
     """
 
     def __init__(
@@ -46,6 +144,21 @@ class MailService(AbstractMailService):
         timeout: int = 10,
         encrypt_method: EncryptionService = encryption_service,
         send_method: Any = None,
+        render_pool: "BrowserPool | None" = None,
+        renderer: AbstractRenderer | None = None,
+        render_scheduler: RenderScheduler = render_scheduler,
+        resync_window: int = 500,
+        search_enabled: bool = True,
+        search_chunk_size: int = 20,
+        max_connections: int = 4,
+        max_host_connections: int = 8,
+        fetch_mode: str = FETCH_MODE_STRUCTURE,
+        fetch_max_bytes: int = 1024 * 1024,
+        fetch_batch_size: int = 50,
+        album_size: int = 1,
+        header_mode: str = HEADER_INLINE,
+        plain_text_mode: str = PLAIN_TEXT_BROWSER,
+        text_renderer: AbstractRenderer = text_renderer,
     ) -> None:
         self.mails = mails
         self.senders = senders
@@ -53,6 +166,28 @@ class MailService(AbstractMailService):
         self.date = date
         self.timeout = timeout
         self.encrypt_method = encrypt_method
+        self.render_pool = render_pool
+        self.renderer = renderer
+        self.render_scheduler = render_scheduler
+        self.resync_window = resync_window
+        self.search_enabled = search_enabled
+        self.search_chunk_size = search_chunk_size
+        self.max_connections = max_connections
+        self.max_host_connections = max_host_connections
+        self.fetch_mode = fetch_mode
+        self.fetch_max_bytes = fetch_max_bytes
+        self.fetch_batch_size = fetch_batch_size
+        self.album_size = album_size
+        self.header_mode = header_mode
+        self.plain_text_mode = plain_text_mode
+        self.text_renderer = text_renderer
+        self.sync_states: dict[str, dict] = dict()
+        self.fetch_paths: dict[str, str] = dict()
+        self._uid_next: dict[str, int] = dict()
+        self.failed_uids: dict[str, set[int]] = dict()
+        self.sent_uids: dict[str, set[int]] = dict()
+        self.rendered: dict[str, list[tuple[int, bytes, str | None]]] = dict()
+        self.plain_text_uids: set[int] = set()
         self.mail_list: list[Task] = list()
         self.imap_client: aioimaplib.IMAP4_SSL = None  # type: ignore
         if send_method is None:
@@ -61,6 +196,38 @@ class MailService(AbstractMailService):
             self.mail_sender_service: MailSender = send_method  # type: ignore
         self.errors: dict = dict()
 
+    @classmethod
+    def from_settings(
+        cls, tg_id: int, mails: list[Mail], senders: list[str], **kwargs: Any
+    ) -> "MailService":
+        """
+        Метод создания сервиса для пользователя tg_id с параметрами из настроек проекта
+
+        :param tg_id: int - telegram_id пользователя, получателя скриншотов
+        :param mails: список почтовых ящиков пользователя
+        :param senders: список отслеживаемых адресов отправителей
+        :param kwargs: параметры, переопределяющие значения из настроек
+        """
+        params: dict[str, Any] = dict(
+            date=datetime.datetime.now()
+            - datetime.timedelta(hours=settings.DELTA_HOURS_CHECK_MAIL),
+            timeout=settings.IMAP_TIMEOUT_SEC,
+            send_method=MailSender(user_id=tg_id),
+            renderer=renderer,
+            resync_window=settings.IMAP_RESYNC_WINDOW,
+            search_enabled=settings.IMAP_SEARCH_ENABLED,
+            search_chunk_size=settings.IMAP_SEARCH_CHUNK_SIZE,
+            max_connections=settings.IMAP_MAX_CONNECTIONS_PER_USER,
+            max_host_connections=settings.IMAP_MAX_CONNECTIONS_PER_HOST,
+            fetch_mode=settings.IMAP_FETCH_MODE,
+            fetch_max_bytes=settings.IMAP_FETCH_MAX_BYTES,
+            fetch_batch_size=settings.IMAP_FETCH_BATCH_SIZE,
+            album_size=settings.TELEGRAM_ALBUM_SIZE,
+            header_mode=settings.RENDER_HEADER,
+        )
+        params.update(kwargs)
+        return cls(mails=mails, senders=senders, **params)
+
     @classmethod
     def validate_mail(cls, mail: Mail) -> bool:
         """
@@ -78,61 +245,197 @@ class MailService(AbstractMailService):
         except Exception:
             return False
 
-    def _connect_imap(self, host: str, port: int) -> None:
+    def _connect_imap(self, host: str, port: int) -> aioimaplib.IMAP4_SSL:
         """
-        Метод для подключения к imap-серверу
+        Метод создания клиента для подключения к imap-серверу
 
         :param host: строка вида imap.server.com, адрес почтового сервера
         :param port: int, порт сервера
+        :return: IMAP4_SSL - новый клиент, у каждого ящика свой
         """
-        self.imap_client = aioimaplib.IMAP4_SSL(
-            host=host, port=port, timeout=self.timeout
-        )
+        return aioimaplib.IMAP4_SSL(host=host, port=port, timeout=self.timeout)
+
+    def _for_mailbox(self, imap_client: aioimaplib.IMAP4_SSL) -> "MailService":
+        """
+        Метод создания копии сервиса для проверки одного ящика: со своим imap-клиентом,
+        списком задач рендера и ошибками. Состояния синхронизации, ключами которых
+        служат адреса ящиков, остаются общими с исходным сервисом.
+        """
+        mailbox_service = copy.copy(self)
+        mailbox_service.imap_client = imap_client
+        mailbox_service.mail_list = list()
+        mailbox_service.rendered = dict()
+        mailbox_service.plain_text_uids = set()
+        mailbox_service.errors = dict()
+        return mailbox_service
 
     async def check_new_mails(self) -> None:
         """
         Метод проверки новых писем на отслеживаемых почтовых ящиках.
+        Ящики проверяются одновременно, не более max_connections для пользователя
+        и не более max_host_connections для одного imap-сервера.
+        Ошибки проверки отдельных ящиков собираются в self.errors.
+        """
+        user_limit = asyncio.Semaphore(self.max_connections)
+        results = await asyncio.gather(
+            *(self._check_mailbox(mail, user_limit) for mail in self.mails),
+            return_exceptions=True,
+        )
+        for mail, result in zip(self.mails, results):
+            if isinstance(result, BaseException):
+                logging.error(msg=f"Failed to check {mail.email}", exc_info=result)
+                result = {"unknown": [mail.email]}
+            for error, emails in result.items():
+                self.errors.setdefault(error, []).extend(emails)
+
+    async def _check_mailbox(self, mail: Mail, user_limit: asyncio.Semaphore) -> dict:
+        """
+        Метод проверки новых писем в одном почтовом ящике на отдельном соединении
 
+        :param mail: Mail - почтовый ящик
+        :param user_limit: Semaphore - ограничение числа одновременно проверяемых ящиков пользователя
+        :return: dict - ошибки проверки ящика
         """
-        for mail in self.mails:
+        host = mail.provider["host"]
+        async with user_limit, host_limit(host, self.max_host_connections):
+            mailbox_service = self._for_mailbox(
+                self._connect_imap(host=host, port=mail.provider["port"])
+            )
             try:
-                self._connect_imap(
-                    host=mail.provider["host"], port=mail.provider["port"]
-                )
-                await self.imap_client.wait_hello_from_server()
-            except TimeoutError:
-                logging.warning(msg=f"Timeout connect to {mail.provider['host']}")
-                self.errors.get("timeout", []).append(mail.email)
-                continue
-            except Exception as err:
-                logging.error(msg="Unknown error", exc_info=err)
-                continue
+                await mailbox_service._check_connected(mail)
+            finally:
+                with suppress(Exception):
+                    await mailbox_service.imap_client.logout()
+        return mailbox_service.errors
 
-            password = self.encrypt_method.decrypt(mail.password.encode())  # type: ignore
-            await self.imap_client.login(mail.email, password)
-            state = self.imap_client.get_state()
-            if state != STATE_AUTH:
-                await self.mail_sender_service.send_warning(
-                    data={
-                        "msg": f"Не удалось подключиться к почтовому ящику {mail.email}. "
-                        f"Возможно, вы изменили пароль."
-                    }
-                )
+    async def _check_connected(self, mail: Mail) -> None:
+        """
+        Метод авторизации в ящике и обработки новых писем на imap-клиенте сервиса
+        """
+        try:
+            await self.imap_client.wait_hello_from_server()
+        except (TimeoutError, asyncio.TimeoutError):
+            logging.warning(msg=f"Timeout connect to {mail.provider['host']}")
+            self.errors.setdefault("timeout", []).append(mail.email)
+            return
+
+        password = self.encrypt_method.decrypt(mail.password.encode())  # type: ignore
+        await self.imap_client.login(mail.email, password)
+        state = self.imap_client.get_state()
+        if state != STATE_AUTH:
+            await self.mail_sender_service.send_warning(
+                data={
+                    "msg": f"Не удалось подключиться к почтовому ящику {mail.email}. "
+                    f"Возможно, вы изменили пароль."
+                }
+            )
+            self.errors.setdefault("auth", []).append(mail.email)
+            return
+        response = await self.imap_client.select("INBOX")
+        from_uid = self.sync_from_uid(mail, response)
+        await self.process_new_messages(mail.email, from_uid)
+        await self.imap_client.close()
+
+    @staticmethod
+    def mailbox_status(response: aioimaplib.Response) -> tuple[int | None, int | None]:
+        """
+        Метод извлечения UIDVALIDITY и UIDNEXT из ответа сервера на команду SELECT
+
+        :param response: ответ на SELECT
+        :return: tuple - (UIDVALIDITY, UIDNEXT), None если сервер не сообщил значение
+        """
+        uid_validity: int | None = None
+        uid_next: int | None = None
+        for line in response.lines:
+            if not isinstance(line, (bytes, bytearray)):
                 continue
-            await self.imap_client.select("INBOX")
-            await self._fetch_messages_headers(mail.email)
-            if self.mail_list:
-                await asyncio.wait(self.mail_list)
-            self.mail_list.clear()
-            await self.imap_client.close()
+            if match := SELECT_UIDVALIDITY.search(line):
+                uid_validity = int(match.group("uid_validity"))
+            if match := SELECT_UIDNEXT.search(line):
+                uid_next = int(match.group("uid_next"))
+        return uid_validity, uid_next
+
+    def sync_from_uid(self, mail: Mail, response: aioimaplib.Response) -> int:
+        """
+        Метод определения uid, с которого нужно проверять выбранную папку ящика.
+        Если UIDVALIDITY совпадает с сохраненным, проверяются только письма после
+        последнего обработанного uid, иначе - последние resync_window писем.
 
-    async def _fetch_messages_headers(self, to_email: str) -> None:
+        :param mail: Mail - почтовый ящик с сохраненным состоянием синхронизации
+        :param response: ответ сервера на SELECT
+        :return: int - минимальный uid для проверки
+        """
+        uid_validity, uid_next = self.mailbox_status(response)
+        if uid_validity is not None and uid_validity == mail.uid_validity:
+            from_uid = mail.last_uid + 1
+        else:
+            metrics.incr("mail_sync.resync")
+            from_uid = max(1, uid_next - self.resync_window) if uid_next else 1
+        if uid_next is not None:
+            self._uid_next[mail.email] = uid_next
+        self.sync_states[mail.email] = {
+            "uid_validity": uid_validity,
+            "last_uid": from_uid - 1,
+        }
+        return from_uid
+
+    async def process_new_messages(self, to_email: str, from_uid: int = 1) -> int:
+        """
+        Метод обработки новых писем в выбранной папке уже подключенного imap-клиента:
+        отбирает письма от отслеживаемых отправителей, дожидается отправки их скриншотов
+        и одной командой STORE на каждый исход отмечает письма прочитанными или непрочитанными.
+
+        :param to_email: str - адрес получателя
+        :param from_uid: int - минимальный uid письма, с которого начинается проверка
+        :return: int - uid, до которого включительно письма обработаны. Письма, скриншоты
+        которых не удалось отправить, остаются за его пределами для повторной попытки
+        """
+        last_uid = await self._fetch_messages_headers(to_email, from_uid)
+        if self.mail_list:
+            await asyncio.wait(self.mail_list)
+        self.mail_list.clear()
+        await self._send_rendered(to_email)
+        await self._store_flags(to_email)
+
+        # поиск на сервере просматривает все письма до UIDNEXT, а не только найденные
+        uid_next = self._uid_next.get(to_email)
+        if self.fetch_paths.get(to_email) == FETCH_PATH_SEARCH and uid_next:
+            last_uid = max(last_uid, uid_next - 1)
+
+        failed = self.failed_uids.pop(to_email, set())
+        if failed:
+            last_uid = min(last_uid, min(failed) - 1)
+        if to_email in self.sync_states:
+            self.sync_states[to_email]["last_uid"] = last_uid
+        return last_uid
+
+    async def _fetch_messages_headers(self, to_email: str, from_uid: int = 1) -> int:
         """
         Вспомогательный метод для считывания и обработки заголовков письма
+
+        :param to_email: str - адрес получателя
+        :param from_uid: int - минимальный uid письма, с которого начинается проверка
+        :return: int - наибольший uid среди просмотренных писем
         """
+        last_uid: int = from_uid - 1
+        matched: dict[int, str] = dict()
+        uid_set: str = f"{from_uid}:*"
+        uids = await self._search_new_uids(from_uid) if self.search_enabled else None
+        self.fetch_paths[to_email] = (
+            FETCH_PATH_CLIENT if uids is None else FETCH_PATH_SEARCH
+        )
+        metrics.incr(f"mail_fetch.path.{self.fetch_paths[to_email]}")
+        logging.debug(
+            msg=f"{to_email}: new mail selected by {self.fetch_paths[to_email]}"
+        )
+        if uids is not None:
+            if not uids:
+                return last_uid
+            uid_set = self._uid_set(uids)
+
         response: aioimaplib.Response = await self.imap_client.uid(
             "fetch",
-            "1:*",
+            uid_set,
             f'(UID FLAGS BODY.PEEK[HEADER.FIELDS ({" ".join(ID_HEADER_SET)})])',
         )
         for i in range(0, len(response.lines) - 1, 3):
@@ -146,6 +449,10 @@ class MailService(AbstractMailService):
             flags: bytes = FETCH_MESSAGE_DATA_FLAGS.match(  # type: ignore
                 fetch_command_without_literal
             ).group("flags")
+            # диапазон n:* всегда содержит последнее письмо ящика, даже если его uid меньше n
+            if uid < from_uid:
+                continue
+            last_uid = max(last_uid, uid)
 
             if b"\\Seen" not in flags:
                 message_headers = BytesHeaderParser().parsebytes(response.lines[i + 1])
@@ -155,9 +462,71 @@ class MailService(AbstractMailService):
                 from_date = datetime.datetime.strptime(mail_date, "%d %b %Y")
                 for sender in self.senders:
                     if sender in message_headers["From"] and from_date >= self.date:
-                        await self.get_mail(
-                            msg_id=uid, sender=sender, to_email=to_email
-                        )
+                        matched[uid] = sender
+                        break
+        if matched:
+            await self.get_mails(matched, to_email)
+        return last_uid
+
+    @staticmethod
+    def _uid_set(uids: list[int]) -> str:
+        """
+        Метод сжатия отсортированного списка uid в набор диапазонов вида 1:3,7,9:10
+        """
+        ranges: list[str] = list()
+        start = prev = uids[0]
+        for uid in uids[1:] + [0]:
+            if uid == prev + 1:
+                prev = uid
+                continue
+            ranges.append(str(start) if start == prev else f"{start}:{prev}")
+            start = prev = uid
+        return ",".join(ranges)
+
+    def _search_criteria(self, from_uid: int, senders: list[str]) -> list[str]:
+        """
+        Метод формирования критериев UID SEARCH: непрочитанные письма не старше self.date
+        с uid не меньше from_uid от любого из отправителей senders
+        """
+        since = f"{self.date.day}-{IMAP_MONTHS[self.date.month - 1]}-{self.date.year}"
+        from_criteria: list[str] = ["OR"] * (len(senders) - 1)
+        for sender in senders:
+            quoted = sender.replace("\\", "\\\\").replace('"', '\\"')
+            from_criteria.extend(("FROM", f'"{quoted}"'))
+        return ["UNSEEN", "SINCE", since, "UID", f"{from_uid}:*", *from_criteria]
+
+    async def _search_new_uids(self, from_uid: int) -> list[int] | None:
+        """
+        Метод поиска на сервере непрочитанных писем от отслеживаемых отправителей.
+        Длинный список отправителей разбивается на несколько команд поиска.
+
+        :param from_uid: int - минимальный uid письма
+        :return: отсортированный список uid или None, если сервер не смог выполнить поиск
+        """
+        uids: set[int] = set()
+        for i in range(0, len(self.senders), self.search_chunk_size):
+            senders = self.senders[i : i + self.search_chunk_size]  # noqa: E203
+            try:
+                response = await self.imap_client.uid_search(
+                    *self._search_criteria(from_uid, senders), charset=None
+                )
+            except (aioimaplib.AioImapException, asyncio.TimeoutError) as err:
+                logging.warning(msg=f"IMAP SEARCH failed: {err!r}")
+                return None
+            if response.result != "OK":
+                logging.warning(msg=f"IMAP SEARCH failed: {response.lines[-1:]}")
+                return None
+            # aioimaplib отдает ответ * SEARCH без префикса: b"3 5 7"
+            for line in response.lines[:-1]:
+                if not isinstance(line, bytes):
+                    continue
+                tokens = line.split()
+                if tokens[:1] == [b"SEARCH"]:
+                    tokens = tokens[1:]
+                # строки с другими данными, например * 3 EXISTS, не являются результатом поиска
+                if all(token.isdigit() for token in tokens):
+                    uids.update(int(uid) for uid in tokens)
+        return sorted(uid for uid in uids if uid >= from_uid)
 
     async def get_mail(self, msg_id: int, sender: str, to_email: str) -> None:
         """
@@ -169,58 +538,354 @@ class MailService(AbstractMailService):
         :param sender: str - адрес отправителя
         :param to_email: str - адрес получателя
         """
-        res = await self.imap_client.uid("fetch", str(msg_id), "(RFC822)")
-        msg = BytesParser().parsebytes(res.lines[1])
-        template: str = ""
-
-        for part in msg.walk():
-            if (
-                part.get_content_maintype() in {"text", "html"}
-                and not part.get_filename()
-            ):
-                template = part.get_payload(decode=True).decode()
-
-        content: str = "".join(
-            [
-                f"<strong>From: {sender}</strong><br><strong>To: {to_email}</strong><br>",
-                template,
-            ]
+        await self.get_mails({msg_id: sender}, to_email)
+
+    async def get_mails(self, messages: dict[int, str], to_email: str) -> None:
+        """
+        Метод получения писем с почтового ящика to_email. Письма загружаются
+        пачками по fetch_batch_size одной командой UID FETCH на пачку, рендер каждой пачки
+        начинается, не дожидаясь загрузки следующей. Если очередь рендеров заполнена,
+        загрузка ожидает места в ней.
+
+        :param messages: dict - {uid письма: адрес отправителя}
+        :param to_email: str - адрес получателя
+        """
+        uids = sorted(messages)
+        for i in range(0, len(uids), self.fetch_batch_size):
+            chunk = uids[i : i + self.fetch_batch_size]  # noqa: E203
+            templates: dict[int, str] = dict()
+            if self.fetch_mode == FETCH_MODE_STRUCTURE:
+                templates = await self._fetch_renderable_parts(chunk)
+            missing = [uid for uid in chunk if uid not in templates]
+            if missing:
+                templates.update(await self._fetch_whole_messages(missing))
+            metrics.incr("mail_fetch.batches")
+
+            for uid in chunk:
+                if uid not in templates:
+                    logging.warning(msg=f"Failed to fetch message {uid} of {to_email}")
+                    self.failed_uids.setdefault(to_email, set()).add(uid)
+                    continue
+                content: str = templates[uid]
+                caption: str | None = f"From: {messages[uid]}\nTo: {to_email}"
+                if uid in self.plain_text_uids:
+                    self.plain_text_uids.discard(uid)
+                    if self.plain_text_mode != PLAIN_TEXT_BROWSER:
+                        self.mail_list.append(
+                            asyncio.create_task(
+                                self.send_plain_text(content, to_email, uid, caption)
+                            )
+                        )
+                        continue
+                    content = plain_text_html(content)
+                if self.header_mode != HEADER_CAPTION:
+                    content = "".join(
+                        [
+                            f"<strong>From: {messages[uid]}</strong><br><strong>To: {to_email}</strong><br>",
+                            content,
+                        ]
+                    )
+                    caption = None
+                self.mail_list.append(
+                    await self.render_scheduler.submit(
+                        self.generate_screenshot, content, to_email, uid, caption
+                    )
+                )
+
+    async def _fetch_whole_messages(self, uids: list[int]) -> dict[int, str]:
+        """
+        Метод загрузки писем целиком и извлечения из них текста для рендера
+        со встроенными изображениями cid:
+
+        :param uids: список uid писем
+        :return: dict - {uid письма: текст для рендера}
+        """
+        res = await self.imap_client.uid("fetch", self._uid_set(uids), "(UID RFC822)")
+        metrics.incr(f"mail_fetch.mode.{FETCH_MODE_RFC822}", len(uids))
+        templates: dict[int, str] = dict()
+        for i in range(0, len(res.lines) - 1, 3):
+            match = FETCH_MESSAGE_DATA_UID.match(
+                b"%s %s" % (res.lines[i], res.lines[i + 2])
+            )
+            if match is None:
+                continue
+            metrics.incr("mail_fetch.bytes", len(res.lines[i + 1]))
+            msg = BytesParser().parsebytes(res.lines[i + 1])
+            template: str = ""
+            plain_text = False
+
+            for part in msg.walk():
+                if (
+                    part.get_content_maintype() in {"text", "html"}
+                    and not part.get_filename()
+                ):
+                    template = part.get_payload(decode=True).decode()
+                    plain_text = part.get_content_subtype() == "plain"
+            templates[int(match.group("uid"))] = bodystructure.inline_images(
+                template, bodystructure.message_images(msg)
+            )
+            if plain_text:
+                self.plain_text_uids.add(int(match.group("uid")))
+        return templates
+
+    async def _fetch_renderable_parts(self, uids: list[int]) -> dict[int, str]:
+        """
+        Метод загрузки только тех частей писем, которые нужны для рендера:
+        по BODYSTRUCTURE выбирается text/html (или text/plain) и встроенные изображения cid:,
+        которые загружаются командой BODY.PEEK[n] в пределах fetch_max_bytes.
+        Текст, не уместившийся в бюджет, загружается частично.
+        Письма с одинаковым набором частей загружаются одной командой.
+
+        :param uids: список uid писем
+        :return: dict - {uid письма: текст для рендера}. Письма, структуру которых
+        разобрать не удалось, в результат не попадают
+        """
+        res = await self.imap_client.uid(
+            "fetch", self._uid_set(uids), "(UID BODYSTRUCTURE)"
         )
-        self.mail_list.append(
-            asyncio.create_task(self.generate_screenshot(content, to_email, msg_id))
+        try:
+            structures = bodystructure.parse_fetch_all(res.lines[:-1])
+        except ValueError as err:
+            logging.warning(msg=f"Failed to parse BODYSTRUCTURE: {err!r}")
+            return dict()
+
+        templates: dict[int, str] = dict()
+        selected: dict[int, tuple[bodystructure.BodyPart, str, list]] = dict()
+        groups: dict[tuple[str, ...], list[int]] = dict()
+        for uid in uids:
+            try:
+                parts = bodystructure.parse_bodystructure(
+                    structures[uid]["BODYSTRUCTURE"]
+                )
+            except (KeyError, ValueError, IndexError, TypeError) as err:
+                logging.warning(msg=f"Failed to parse BODYSTRUCTURE of {uid}: {err!r}")
+                continue
+            text, images = bodystructure.select_parts(parts, self.fetch_max_bytes)
+            if text is None:
+                templates[uid] = ""
+                continue
+
+            text_item = f"BODY.PEEK[{text.section}]"
+            text_key = f"BODY[{text.section}]"
+            if self.fetch_max_bytes and text.size > self.fetch_max_bytes:
+                text_item += f"<0.{self.fetch_max_bytes}>"
+                text_key += "<0>"
+                metrics.incr("mail_fetch.truncated")
+            items = (text_item, *(f"BODY.PEEK[{image.section}]" for image in images))
+            groups.setdefault(items, []).append(uid)
+            selected[uid] = (text, text_key, images)
+
+        for items, group in groups.items():
+            res = await self.imap_client.uid(
+                "fetch", self._uid_set(group), f'(UID {" ".join(items)})'
+            )
+            try:
+                fetched = bodystructure.parse_fetch_all(res.lines[:-1])
+            except ValueError as err:
+                logging.warning(msg=f"Failed to parse message parts: {err!r}")
+                continue
+            for uid in group:
+                if uid not in fetched:
+                    continue
+                text, text_key, images = selected[uid]
+                data = {
+                    key: value
+                    for key, value in fetched[uid].items()
+                    if isinstance(value, bytes)
+                }
+                metrics.incr("mail_fetch.bytes", sum(map(len, data.values())))
+                template = bodystructure.decode_text(text, data.get(text_key, b""))
+                if text.subtype == "plain":
+                    self.plain_text_uids.add(uid)
+                templates[uid] = bodystructure.inline_images(
+                    template,
+                    [
+                        (image, data[f"BODY[{image.section}]"])
+                        for image in images
+                        if f"BODY[{image.section}]" in data
+                    ],
+                )
+        metrics.incr(f"mail_fetch.mode.{FETCH_MODE_STRUCTURE}", len(templates))
+        return templates
+
+    async def _store_flags(self, to_email: str) -> None:
+        """
+        Метод обновления флагов обработанных писем ящика: одна команда STORE
+        для отправленных писем (+FLAGS) и одна для неотправленных (-FLAGS)
+        """
+        sent = self.sent_uids.pop(to_email, set())
+        failed = self.failed_uids.get(to_email, set())
+        for flag, uids in (("+FLAGS", sent), ("-FLAGS", failed)):
+            if uids:
+                await self.imap_client.uid(
+                    "STORE", self._uid_set(sorted(uids)), flag, r"\Seen"
+                )
+                metrics.incr("mail_fetch.stores")
+
+    async def release_messages(self, mail: Mail, uids: list[int]) -> bool:
+        """
+        Метод возврата писем, скриншоты которых так и не удалось отправить, в непрочитанные
+        на отдельном соединении. Состояние синхронизации ящика откатывается до первого
+        из писем, поэтому следующая проверка загрузит их повторно, как неотправленные
+        письма при проверке без конвейера.
+
+        :param mail: Mail - почтовый ящик с сохраненным состоянием синхронизации
+        :param uids: list - uid писем
+        :return: bool - письма возвращены(True/False)
+        """
+        imap_client = self._connect_imap(
+            host=mail.provider["host"], port=mail.provider["port"]
         )
-        await self.imap_client.uid("STORE", str(msg_id), "+FLAGS", r"\Seen")
+        try:
+            await imap_client.wait_hello_from_server()
+            password = self.encrypt_method.decrypt(mail.password.encode())  # type: ignore
+            await imap_client.login(mail.email, password)
+            if imap_client.get_state() != STATE_AUTH:
+                return False
+            uid_validity, _ = self.mailbox_status(await imap_client.select("INBOX"))
+            # после смены UIDVALIDITY uid писем относятся к прежнему содержимому ящика
+            if uid_validity != mail.uid_validity:
+                return False
+            await imap_client.uid(
+                "STORE", self._uid_set(sorted(uids)), "-FLAGS", r"\Seen"
+            )
+            await imap_client.close()
+        except Exception as err:
+            logging.error(
+                msg=f"Failed to release messages of {mail.email}", exc_info=err
+            )
+            return False
+        finally:
+            with suppress(Exception):
+                await imap_client.logout()
+        self.sync_states[mail.email] = {
+            "uid_validity": uid_validity,
+            "last_uid": min(mail.last_uid, min(uids) - 1),
+        }
+        return True
 
     async def generate_screenshot(
-        self, content: str, filename: str, msg_id: int
+        self, content: str, filename: str, msg_id: int, caption: str | None = None
     ) -> None:
         """
         Метод сохранения скриншота письма.
+        Результат отправки учитывается в sent_uids или failed_uids для последующего обновления флагов.
+        При album_size больше 1 скриншот откладывается до отправки альбомом.
 
         :param content: str - контент содержимого для рендера страницы письма
         :param filename: str - имя директории, куда будут сохраненые скриншоты,
         если save_screen=True.
         :param msg_id: int - id сообщения для скриншота
+        :param caption: str - подпись скриншота с отправителем и получателем письма
         """
-        async with async_playwright() as p:
-            browser = await p.firefox.launch()
-            page = await browser.new_page()
-            await page.set_content(content)
-            if self.save_screen:
-                await page.screenshot(
-                    path=f"{MAIL_FOLDER}/{filename}/{uuid.uuid4()}.png",
-                    full_page=True,
-                )
-            else:
-                result = await page.screenshot(full_page=True)
-                flag: str = "+FLAGS"
-                if not await self.mail_sender_service.send_photo(result):
-                    flag = "-FLAGS"
-                    await self.mail_sender_service.send_warning(
-                        data={"msg": "Возникла ошибка при отправке скриншота."}
-                    )
-                await self.imap_client.uid("STORE", str(msg_id), flag, r"\Seen")
-            await browser.close()
+        try:
+            message_renderer = self.renderer or self._browser_renderer()
+            result = await message_renderer.render(content)
+        except Exception:
+            self.failed_uids.setdefault(filename, set()).add(msg_id)
+            raise
+        await self._deliver_screenshot(filename, msg_id, result, caption)
+
+    def _browser_renderer(self) -> AbstractRenderer:
+        """
+        Рендер браузером из render_pool, если рендер писем не задан.
+        Playwright импортируется только здесь, а не при загрузке модуля.
+        """
+        from app_celery.browser_pool import browser_pool
+        from app_celery.render_service.browser import BrowserRenderer
+
+        return BrowserRenderer(self.render_pool or browser_pool)
+
+    async def send_plain_text(
+        self, text: str, filename: str, msg_id: int, header: str
+    ) -> None:
+        """
+        Метод отправки письма только с text/plain без браузера: в режиме message - текстовым
+        сообщением, в режиме image (или при save_screen=True) - изображением текста.
+        Результат отправки учитывается в sent_uids или failed_uids.
+
+        :param text: str - текст письма
+        :param filename: str - адрес почтового ящика
+        :param msg_id: int - id сообщения
+        :param header: str - отправитель и получатель письма
+        """
+        metrics.incr(f"plain_text.{self.plain_text_mode}")
+        if self.plain_text_mode == PLAIN_TEXT_MESSAGE and not self.save_screen:
+            success = await self.mail_sender_service.send_text(f"{header}\n\n{text}")
+            uids = self.sent_uids if success else self.failed_uids
+            uids.setdefault(filename, set()).add(msg_id)
+            return
+
+        caption: str | None = header
+        if self.header_mode != HEADER_CAPTION:
+            text = f"{header}\n\n{text}"
+            caption = None
+        try:
+            result = await self.text_renderer.render(text)
+        except Exception:
+            self.failed_uids.setdefault(filename, set()).add(msg_id)
+            raise
+        await self._deliver_screenshot(filename, msg_id, result, caption)
+
+    async def _deliver_screenshot(
+        self, filename: str, msg_id: int, screenshot: bytes, caption: str | None
+    ) -> None:
+        """
+        Метод сохранения или отправки готового скриншота письма.
+        При album_size больше 1 скриншот откладывается до отправки альбомом.
+        """
+        if self.save_screen:
+            try:
+                await asyncio.to_thread(self._save_screenshot, filename, screenshot)
+            except Exception:
+                self.failed_uids.setdefault(filename, set()).add(msg_id)
+                raise
+            self.sent_uids.setdefault(filename, set()).add(msg_id)
+            return
+
+        if self.album_size > 1:
+            self.rendered.setdefault(filename, []).append((msg_id, screenshot, caption))
+            return
+        await self._send_screenshots(filename, [(msg_id, screenshot, caption)])
+
+    @staticmethod
+    def _save_screenshot(filename: str, screenshot: bytes) -> None:
+        """
+        Метод сохранения скриншота в файл в директории MAIL_FOLDER/filename
+        """
+        os.makedirs(f"{MAIL_FOLDER}/{filename}", exist_ok=True)
+        with open(f"{MAIL_FOLDER}/{filename}/{uuid.uuid4()}.png", "wb") as file:
+            file.write(screenshot)
+
+    async def _send_rendered(self, to_email: str) -> None:
+        """
+        Метод отправки накопленных скриншотов ящика альбомами по album_size штук
+        """
+        await self._send_screenshots(to_email, sorted(self.rendered.pop(to_email, [])))
+
+    async def _send_screenshots(
+        self, to_email: str, screenshots: list[tuple[int, bytes, str | None]]
+    ) -> None:
+        """
+        Метод отправки скриншотов пользователю альбомами по album_size штук.
+        Результат отправки учитывается в sent_uids или failed_uids.
+
+        :param to_email: str - адрес почтового ящика
+        :param screenshots: список (uid письма, скриншот, подпись)
+        """
+        if not screenshots:
+            return
+        results = await self.mail_sender_service.send_screenshots(
+            [(screenshot, caption) for _, screenshot, caption in screenshots],
+            self.album_size,
+        )
+        for (msg_id, *_), success in zip(screenshots, results):
+            uids = self.sent_uids if success else self.failed_uids
+            uids.setdefault(to_email, set()).add(msg_id)
+        if not all(results):
+            await self.mail_sender_service.send_warning(
+                data={"msg": "Возникла ошибка при отправке скриншота."}
+            )
 
     @property
     def get_errors(self) -> dict:
@@ -228,6 +893,37 @@ class MailService(AbstractMailService):
 
     def run(self) -> None:
         """
-        Метод запуска сервиса
+        Метод запуска сервиса в событийном цикле процесса воркера
+        """
+        worker_runtime.run(self.check_new_mails())
+
+    @staticmethod
+    async def check_many(services: list["MailService"], concurrency: int) -> None:
+        """
+        Метод проверки новых писем нескольких пользователей в одном событийном цикле,
+        не более concurrency пользователей одновременно.
+        Ошибка проверки одного пользователя не прерывает проверку остальных.
+
+        :param services: список сервисов пользователей
+        :param concurrency: int - число одновременно проверяемых пользователей
+        """
+        limit = asyncio.Semaphore(concurrency)
+
+        async def check(service: MailService) -> None:
+            async with limit:
+                try:
+                    await service.check_new_mails()
+                except Exception as err:
+                    logging.error(msg="Failed to check new mails", exc_info=err)
+                    service.errors.setdefault("unknown", []).extend(
+                        mail.email for mail in service.mails
+                    )
+
+        await asyncio.gather(*(check(service) for service in services))
+
+    @classmethod
+    def run_many(cls, services: list["MailService"], concurrency: int) -> None:
+        """
+        Метод запуска сервисов нескольких пользователей в событийном цикле процесса воркера
         """
-        asyncio.new_event_loop().run_until_complete(self.check_new_mails())
+        worker_runtime.run(cls.check_many(services, concurrency))
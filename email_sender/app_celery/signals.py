@@ -0,0 +1,65 @@
+import logging
+import sys
+
+from app_celery.mailsender_service.images import screenshot_encoder
+from app_celery.mailsender_service.ratelimit import delivery_limiter
+from app_celery.mailsender_service.session import bot_session
+from app_celery.render_service import renderer
+from app_celery.runtime import worker_runtime
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
+
+
+@worker_process_init.connect
+def start_runtime(**kwargs) -> None:
+    """
+    Запускает событийный цикл процесса воркера
+    """
+    worker_runtime.start()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def stop_runtime(**kwargs) -> None:
+    """
+    Закрывает ресурсы и событийный цикл процесса при остановке воркера
+    """
+    worker_runtime.shutdown()
+
+
+@worker_runtime.on_shutdown
+async def close_browser_pool() -> None:
+    """
+    Закрывает пул браузеров процесса, если рендер браузером загружал его
+    """
+    # без рендера браузером пул и playwright не импортируются
+    browser_pool_module = sys.modules.get("app_celery.browser_pool")
+    if browser_pool_module is None:
+        return
+    if browser_pool_module.browser_pool.started:
+        await browser_pool_module.browser_pool.close()
+
+
+@worker_runtime.on_shutdown
+async def close_renderer() -> None:
+    """
+    Закрывает рендер писем: сессию сервиса рендера или браузеры процесса
+    """
+    await renderer.close()
+
+
+@worker_runtime.on_shutdown
+async def close_bot_session() -> None:
+    """
+    Закрывает сессию бота и соединение ограничителя частоты отправки
+    """
+    if bot_session.started:
+        await bot_session.close()
+    await delivery_limiter.close()
+
+
+@worker_runtime.on_shutdown
+async def log_screenshot_output() -> None:
+    """
+    Пишет в лог статистику размера скриншотов: полученных от рендера и отправленных
+    """
+    logging.info(msg=f"Screenshot output stats: {screenshot_encoder.stats()}")
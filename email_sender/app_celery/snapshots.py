@@ -0,0 +1,147 @@
+import json
+import logging
+
+import redis
+from app_celery.metrics import metrics
+from app_celery.utils import get_data_by_tg_id
+from django.conf import settings
+from redis.exceptions import RedisError
+
+CONFIG_FIELD = "config"
+SYNC_FIELD = "sync:"
+
+
+class UserSnapshots:
+    """
+    Снимки настроек пользователей в redis: почтовые ящики с провайдерами и
+    отслеживаемые отправители, чтобы проверка пользователя читала один ключ вместо запросов к бд.
+
+    Снимок хранится в хэше пользователя: поле config со снимком из бд пересобирается
+    при изменении ящиков, отправителей и провайдеров, а поля sync:<email> с состоянием
+    синхронизации обновляются после каждой проверки. Поля независимы, поэтому пересборка
+    снимка не откатывает состояние синхронизации, сохраненное проверкой.
+    Без redis и при его недоступности данные читаются из бд.
+
+    :param url: str - адрес redis
+    :param ttl: int - время жизни снимка в секундах, после которого он пересобирается из бд
+    :param prefix: str - префикс ключей
+    """
+
+    def __init__(
+        self, url: str = "", ttl: int = 24 * 60 * 60, prefix: str = "user_snapshot"
+    ) -> None:
+        self.url = url
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client: redis.Redis | None = None
+
+    def _redis(self) -> redis.Redis | None:
+        if not self.url:
+            return None
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def _key(self, tg_id: int) -> str:
+        return f"{self.prefix}:{tg_id}"
+
+    @staticmethod
+    def _on_redis_error(err: RedisError) -> None:
+        logging.warning(msg=f"Redis user snapshots are unavailable: {err!r}")
+        metrics.incr("user_snapshot.redis_errors")
+
+    def get(self, tg_id: int) -> dict:
+        """
+        Метод получения снимка пользователя: из redis или, при его отсутствии, из бд
+        с сохранением в redis
+
+        :param tg_id: int - telegram_id пользователя
+        :return: dict - {"mails": [...], "senders": [...]}
+        """
+        client = self._redis()
+        if client is None:
+            return get_data_by_tg_id(tg_id)
+        try:
+            fields = client.hgetall(self._key(tg_id))
+        except RedisError as err:
+            self._on_redis_error(err)
+            return get_data_by_tg_id(tg_id)
+
+        if CONFIG_FIELD.encode() not in fields:
+            metrics.incr("user_snapshot.misses")
+            return self.refresh(tg_id)
+        metrics.incr("user_snapshot.hits")
+        data = json.loads(fields[CONFIG_FIELD.encode()])
+        for mail in data["mails"]:
+            sync_state = fields.get(f"{SYNC_FIELD}{mail['email']}".encode())
+            if sync_state is not None:
+                mail.update(json.loads(sync_state))
+        return data
+
+    def refresh(self, tg_id: int) -> dict:
+        """
+        Метод пересборки снимка пользователя из бд
+
+        :param tg_id: int - telegram_id пользователя
+        :return: dict - новый снимок
+        """
+        data = get_data_by_tg_id(tg_id)
+        client = self._redis()
+        if client is None:
+            return data
+        try:
+            with client.pipeline() as pipe:
+                pipe.hset(
+                    self._key(tg_id),
+                    CONFIG_FIELD,
+                    json.dumps(data, separators=(",", ":")),
+                )
+                pipe.expire(self._key(tg_id), self.ttl)
+                pipe.execute()
+        except RedisError as err:
+            self._on_redis_error(err)
+        return data
+
+    def save_sync_states(self, tg_id: int, sync_states: dict[str, dict]) -> None:
+        """
+        Метод сохранения состояний синхронизации ящиков пользователя в его снимке
+
+        :param tg_id: int - telegram_id пользователя
+        :param sync_states: dict - {email: {"uid_validity": ..., "last_uid": ...}}
+        """
+        client = self._redis()
+        if client is None or not sync_states:
+            return
+        try:
+            client.hset(
+                self._key(tg_id),
+                mapping={
+                    f"{SYNC_FIELD}{email}": json.dumps(state, separators=(",", ":"))
+                    for email, state in sync_states.items()
+                },
+            )
+        except RedisError as err:
+            self._on_redis_error(err)
+
+    def clear(self, tg_id: int | None = None) -> None:
+        """
+        Метод удаления снимка пользователя или всех снимков
+
+        :param tg_id: int - telegram_id пользователя, None - удалить все снимки
+        """
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            if tg_id is not None:
+                client.delete(self._key(tg_id))
+                return
+            for key in client.scan_iter(match=f"{self.prefix}:*", count=1000):
+                client.delete(key)
+        except RedisError as err:
+            self._on_redis_error(err)
+
+
+user_snapshots = UserSnapshots(
+    url=settings.REDIS_URL, ttl=settings.USER_SNAPSHOT_TTL_SEC
+)
@@ -1,38 +1,106 @@
 import datetime
 import json
+import logging
+import random
 
+from app_celery.locks import mail_check_leases
 from app_celery.mailsender_service import MailSender
+from app_celery.metrics import metrics
+from app_celery.pipeline import (
+    PIPELINE_QUEUES,
+    PipelineMailService,
+    message_store,
+    queue_depths,
+    render_messages,
+)
+from app_celery.runtime import worker_runtime
 from app_celery.schemes import Mail
-from app_celery.services import MailService
-from app_celery.utils import get_data_by_tg_id
+from app_celery.services import PLAIN_TEXT_BROWSER, MailService
+from app_celery.snapshots import user_snapshots
+from app_celery.utils import (
+    get_active_users,
+    get_shard_data,
+    release_sync_states,
+    save_sync_states,
+)
+from celery import chord, group
 from django.conf import settings
-from django_celery_beat.models import IntervalSchedule, PeriodicTask
+from django.utils import timezone
+from django_celery_beat.models import IntervalSchedule, PeriodicTask, PeriodicTasks
 
 from email_sender.celery import celery_app
 
+SCHEDULER_PER_USER = "per_user"
+SCHEDULER_SHARDED = "sharded"
+
+FANOUT_OFF = "off"
+FANOUT_MAILBOX = "mailbox"
+FANOUT_HOST = "host"
+
 
 @celery_app.task(name="get_new_mail")
 def get_new_mail(tg_id: int):
     """
     Задача на проверку и получение новых писем, если писем или отправителей нет, то не запускаем.
+    При включенном шлюзе IMAP IDLE новые письма получает шлюз, и задача ничего не делает.
+    Если предыдущая проверка пользователя еще идет, задача пропускается.
 
     :param tg_id: int - telegram_id пользователя
     """
-    data = get_data_by_tg_id(tg_id)
+    if settings.IMAP_IDLE_ENABLED:
+        return None
+
+    return mail_check_leases.run_exclusive(f"user:{tg_id}", lambda: check_user(tg_id))
+
+
+def check_user(tg_id: int):
+    """
+    Функция проверки новых писем пользователя по снимку его настроек
+
+    :param tg_id: int - telegram_id пользователя
+    """
+    data = user_snapshots.get(tg_id)
 
     if not data.get("mails") or not data.get("senders"):
         return None
 
-    all_mails: list[Mail] = [Mail(**mail) for mail in data["mails"]]
-    mail_service = MailService(
+    if should_fan_out(data["mails"]):
+        return {"fanout": fan_out(tg_id, data["mails"])}
+
+    return run_check(
+        tg_id,
+        data["mails"],
+        data["senders"],
+        data.get("plain_text_mode", PLAIN_TEXT_BROWSER),
+    )
+
+
+def run_check(
+    tg_id: int,
+    mails: list[dict],
+    senders: list[str],
+    plain_text_mode: str = PLAIN_TEXT_BROWSER,
+) -> dict:
+    """
+    Функция проверки новых писем в ящиках пользователя с сохранением состояния синхронизации
+
+    :param tg_id: int - telegram_id пользователя
+    :param mails: list - почтовые ящики из снимка пользователя
+    :param senders: list - отслеживаемые отправители
+    :param plain_text_mode: str - отображение текстовых писем пользователя
+    :return: dict - ошибки проверки
+    """
+    all_mails: list[Mail] = [Mail(**mail) for mail in mails]
+    mail_service = mail_service_class().from_settings(
+        tg_id=tg_id,
         mails=all_mails,
-        senders=data["senders"],
-        date=datetime.datetime.now()
-        - datetime.timedelta(hours=settings.DELTA_HOURS_CHECK_MAIL),
-        timeout=settings.IMAP_TIMEOUT_SEC,
-        send_method=MailSender(user_id=tg_id),
+        senders=senders,
+        plain_text_mode=plain_text_mode,
     )
+    from_uids = {mail.email: mail.last_uid for mail in all_mails}
     mail_service.run()
+    sync_states = save_sync_states(mail_service.sync_states, from_uids)
+    user_snapshots.save_sync_states(tg_id, sync_states)
 
     if mail_service.get_errors:
         return mail_service.get_errors
@@ -40,11 +108,363 @@ def get_new_mail(tg_id: int):
     return mail_service.errors
 
 
-def create_periodic_task(tg_id: int) -> None:
+def mail_service_class() -> type[MailService]:
+    """
+    Класс почтового сервиса: в режиме очередей рендер и отправка выполняются
+    задачами очередей render и deliver, иначе - в задаче проверки
+    """
+    if settings.MAIL_PIPELINE == PIPELINE_QUEUES:
+        return PipelineMailService
+    return MailService
+
+
+def should_fan_out(mails: list[dict]) -> bool:
+    """
+    Проверяет, нужно ли разделить проверку пользователя на задачи по ящикам
+    """
+    return (
+        settings.MAIL_CHECK_FANOUT != FANOUT_OFF
+        and len(mails) >= settings.MAIL_CHECK_FANOUT_MIN_MAILBOXES
+    )
+
+
+def fanout_groups(mails: list[dict]) -> dict[str, list[str]]:
+    """
+    Функция разбиения ящиков пользователя на группы для отдельных задач:
+    по одному ящику или по imap-серверу в зависимости от MAIL_CHECK_FANOUT
+
+    :param mails: list - почтовые ящики из снимка пользователя
+    :return: dict - {ключ группы: [адреса ящиков]}
+    """
+    groups: dict[str, list[str]] = dict()
+    for mail in mails:
+        if settings.MAIL_CHECK_FANOUT == FANOUT_HOST:
+            key = mail["provider"]["host"]
+        else:
+            key = mail["email"]
+        groups.setdefault(key, []).append(mail["email"])
+    return groups
+
+
+def fan_out(tg_id: int, mails: list[dict]) -> int:
+    """
+    Функция постановки в очередь задач проверки групп ящиков пользователя.
+    Если настроено хранилище результатов, ошибки задач собираются в chord.
+
+    :param tg_id: int - telegram_id пользователя
+    :param mails: list - почтовые ящики из снимка пользователя
+    :return: int - число поставленных задач
+    """
+    groups = fanout_groups(mails)
+    tasks = group(
+        get_new_mail_mailboxes.s(tg_id=tg_id, emails=emails, key=key)
+        for key, emails in groups.items()
+    )
+    if celery_app.conf.result_backend:
+        chord(tasks)(collect_mail_errors.s(tg_id=tg_id))
+    else:
+        tasks.apply_async()
+    return len(groups)
+
+
+@celery_app.task(name="get_new_mail_mailboxes")
+def get_new_mail_mailboxes(tg_id: int, emails: list[str], key: str):
+    """
+    Задача на проверку новых писем в части ящиков пользователя.
+    Настройки ящиков читаются из снимка при запуске, поэтому повторная проверка
+    после пропущенного запуска начинается с сохраненного состояния синхронизации.
+
+    :param tg_id: int - telegram_id пользователя
+    :param emails: list - адреса проверяемых ящиков
+    :param key: str - ключ группы ящиков, по которому исключаются одновременные проверки
+    :return: dict - ошибки проверки
+    """
+
+    def check() -> dict | None:
+        data = user_snapshots.get(tg_id)
+        mails = [mail for mail in data["mails"] if mail["email"] in emails]
+        if not mails or not data["senders"]:
+            return None
+        return run_check(
+            tg_id,
+            mails,
+            data["senders"],
+            data.get("plain_text_mode", PLAIN_TEXT_BROWSER),
+        )
+
+    return mail_check_leases.run_exclusive(f"user:{tg_id}:{key}", check)
+
+
+@celery_app.task(name="collect_mail_errors")
+def collect_mail_errors(results: list[dict | None], tg_id: int):
+    """
+    Задача объединения ошибок проверки групп ящиков пользователя
+
+    :param results: list - результаты задач get_new_mail_mailboxes
+    :param tg_id: int - telegram_id пользователя
+    :return: dict - ошибки проверки
+    """
+    errors: dict[str, list[str]] = dict()
+    for result in results:
+        for error, emails in (result or dict()).items():
+            errors.setdefault(error, []).extend(emails)
+    return errors
+
+
+@celery_app.task(name="get_new_mail_shard")
+def get_new_mail_shard(shard: int, shards: int):
+    """
+    Задача на проверку новых писем всех пользователей шарда: данные пользователей
+    загружаются одним запросом, ящики проверяются в одном событийном цикле.
+    Если предыдущая проверка шарда еще идет, задача пропускается.
+
+    :param shard: int - номер шарда
+    :param shards: int - число шардов
+    :return: dict - ошибки проверки по telegram_id пользователей
+    """
+    if settings.IMAP_IDLE_ENABLED:
+        return None
+
+    return mail_check_leases.run_exclusive(
+        f"shard:{shard}/{shards}", lambda: check_shard(shard, shards)
+    )
+
+
+def check_shard(shard: int, shards: int):
+    """
+    Функция проверки новых писем всех пользователей шарда.
+
+    Данные шарда читаются из бд, а не из снимков: get_shard_data загружает всех
+    пользователей шарда фиксированным числом запросов, а снимки заменяют запросы
+    проверки одного пользователя и потребовали бы чтения redis на каждого.
+    Состояния синхронизации сохраняются и в снимках, поэтому задачи fan_out
+    и режим per_user продолжают с того же uid.
+
+    :param shard: int - номер шарда
+    :param shards: int - число шардов
+    """
+    users = get_shard_data(shard, shards)
+    for user in users:
+        if should_fan_out(user["mails"]):
+            fan_out(user["tg_id"], user["mails"])
+    users = [user for user in users if not should_fan_out(user["mails"])]
+    if not users:
+        return None
+
+    services = [
+        mail_service_class().from_settings(
+            tg_id=user["tg_id"],
+            mails=[Mail(**mail) for mail in user["mails"]],
+            senders=user["senders"],
+            plain_text_mode=user["plain_text_mode"],
+        )
+        for user in users
+    ]
+    from_uids = {
+        mail["email"]: mail["last_uid"] for user in users for mail in user["mails"]
+    }
+    MailService.run_many(services, concurrency=settings.SCHEDULER_SHARD_CONCURRENCY)
+    sync_states: dict[str, dict] = dict()
+    for mail_service in services:
+        sync_states.update(mail_service.sync_states)
+    sync_states = save_sync_states(sync_states, from_uids)
+    for user, mail_service in zip(users, services):
+        user_snapshots.save_sync_states(
+            user["tg_id"],
+            {
+                email: sync_states[email]
+                for email in mail_service.sync_states
+                if email in sync_states
+            },
+        )
+
+    return {
+        user["tg_id"]: mail_service.errors
+        for user, mail_service in zip(users, services)
+        if mail_service.errors
+    }
+
+
+@celery_app.task(name="render_mails")
+def render_mails(tg_id: int, to_email: str, messages: list[list], attempt: int = 1):
+    """
+    Задача этапа render: рендер скриншотов писем ящика и передача их на этап deliver
+
+    :param tg_id: int - telegram_id пользователя
+    :param to_email: str - адрес почтового ящика
+    :param messages: list - [uid письма, ссылка на содержимое в хранилище, подпись скриншота]
+    :param attempt: int - номер попытки
+    :return: dict - число отрендеренных и неотрендеренных писем
+    """
+    contents = load_stage_data(messages)
+    screenshots = worker_runtime.run(
+        render_messages(
+            [(uid, data.decode(errors="replace")) for uid, data in contents.items()]
+        )
+    )
+    if screenshots:
+        celery_app.send_task(
+            "deliver_screenshots",
+            kwargs=dict(
+                tg_id=tg_id,
+                to_email=to_email,
+                screenshots=[
+                    [uid, message_store.put(screenshots[uid]), caption]
+                    for uid, _, caption in messages
+                    if uid in screenshots
+                ],
+            ),
+        )
+    failed = [
+        item for item in messages if item[0] in contents and item[0] not in screenshots
+    ]
+    message_store.delete([ref for uid, ref, _ in messages if uid in screenshots])
+    release_messages(
+        tg_id, to_email, [uid for uid, *_ in messages if uid not in contents]
+    )
+    retry_stage("render_mails", tg_id, to_email, "messages", failed, attempt)
+    return {"rendered": len(screenshots), "failed": len(failed)}
+
+
+@celery_app.task(name="deliver_screenshots")
+def deliver_screenshots(
+    tg_id: int, to_email: str, screenshots: list[list], attempt: int = 1
+):
+    """
+    Задача этапа deliver: отправка скриншотов писем ящика пользователю
+
+    :param tg_id: int - telegram_id пользователя
+    :param to_email: str - адрес почтового ящика
+    :param screenshots: list - [uid письма, ссылка на скриншот в хранилище, подпись скриншота]
+    :param attempt: int - номер попытки
+    :return: dict - число отправленных и неотправленных скриншотов
+    """
+    images = load_stage_data(screenshots)
+    loaded = [(uid, caption) for uid, _, caption in screenshots if uid in images]
+    results = worker_runtime.run(
+        MailSender(user_id=tg_id).send_screenshots(
+            [(images[uid], caption) for uid, caption in loaded],
+            settings.TELEGRAM_ALBUM_SIZE,
+        )
+    )
+    failed_uids = [uid for (uid, _), success in zip(loaded, results) if not success]
+    failed = [item for item in screenshots if item[0] in failed_uids]
+    message_store.delete([ref for uid, ref, _ in screenshots if uid not in failed_uids])
+    release_messages(
+        tg_id, to_email, [uid for uid, *_ in screenshots if uid not in images]
+    )
+    retry_stage("deliver_screenshots", tg_id, to_email, "screenshots", failed, attempt)
+    return {"sent": len(images) - len(failed), "failed": len(failed)}
+
+
+def load_stage_data(refs: list[list]) -> dict[int, bytes]:
+    """
+    Функция загрузки данных этапа конвейера из хранилища
+
+    :param refs: list - [uid письма, ссылка на данные, подпись скриншота]
+    :return: dict - {uid письма: данные}, данные с истекшим сроком хранения пропускаются
+    """
+    data: dict[int, bytes] = dict()
+    for uid, ref, _ in refs:
+        try:
+            data[uid] = message_store.get(ref)
+        except KeyError:
+            logging.warning(msg=f"Pipeline data of message {uid} expired")
+            metrics.incr("mail_pipeline.expired")
+    return data
+
+
+def retry_stage(
+    task_name: str, tg_id: int, to_email: str, key: str, items: list, attempt: int
+) -> None:
+    """
+    Функция повторной постановки в очередь неудавшейся части этапа конвейера
+    с экспоненциальной задержкой. После MAIL_PIPELINE_MAX_ATTEMPTS попыток
+    письма возвращаются в непрочитанные для следующей проверки,
+    а пользователю отправляется предупреждение.
+
+    :param task_name: str - имя задачи этапа
+    :param key: str - имя параметра задачи со списком писем
+    :param items: list - письма, которые нужно обработать повторно
+    :param attempt: int - номер выполненной попытки
+    """
+    if not items:
+        return
+    stage = task_name.split("_")[0]
+    if attempt < settings.MAIL_PIPELINE_MAX_ATTEMPTS:
+        metrics.incr(f"mail_pipeline.{stage}.retries", len(items))
+        celery_app.send_task(
+            task_name,
+            kwargs={
+                "tg_id": tg_id,
+                "to_email": to_email,
+                key: items,
+                "attempt": attempt + 1,
+            },
+            countdown=settings.MAIL_PIPELINE_RETRY_DELAY_SEC * 2 ** (attempt - 1),
+        )
+        return
+    metrics.incr(f"mail_pipeline.{stage}.failed", len(items))
+    message_store.delete([ref for _, ref, _ in items])
+    release_messages(tg_id, to_email, [uid for uid, *_ in items])
+    worker_runtime.run(
+        MailSender(user_id=tg_id).send_warning(
+            data={"msg": "Возникла ошибка при отправке скриншота."}
+        )
+    )
+
+
+def release_messages(tg_id: int, to_email: str, uids: list[int]) -> None:
+    """
+    Функция возврата писем, которые конвейер так и не отправил, в непрочитанные.
+    Этап io отмечает письма прочитанными и сдвигает состояние синхронизации
+    при передаче на рендер, поэтому без отката письма больше не загружались бы.
+    Проверка, идущая во время отката, не сдвигает состояние выше него (release_sync_states).
+
+    :param tg_id: int - telegram_id пользователя
+    :param to_email: str - адрес почтового ящика
+    :param uids: list - uid писем
+    """
+    if not uids:
+        return
+    data = user_snapshots.get(tg_id)
+    mails = [Mail(**mail) for mail in data["mails"] if mail["email"] == to_email]
+    if not mails:
+        return
+    mail_service = MailService.from_settings(
+        tg_id=tg_id, mails=mails, senders=data["senders"]
+    )
+    if not worker_runtime.run(mail_service.release_messages(mails[0], uids)):
+        metrics.incr("mail_pipeline.lost", len(uids))
+        logging.error(msg=f"Messages {uids} of {to_email} were not released")
+        return
+    metrics.incr("mail_pipeline.released", len(uids))
+    user_snapshots.save_sync_states(
+        tg_id, release_sync_states(mail_service.sync_states)
+    )
+
+
+@celery_app.task(name="report_queue_depths")
+def report_queue_depths():
+    """
+    Задача сбора числа сообщений в очередях этапов конвейера
+
+    :return: dict - {очередь: число сообщений}
+    """
+    depths = queue_depths()
+    for queue, depth in depths.items():
+        metrics.set_gauge(f"mail_pipeline.queue.{queue}", depth)
+    logging.info(msg=f"Mail pipeline queue depths: {depths}")
+    return depths
+
+
+def create_periodic_task(tg_id: int, enabled: bool = False) -> None:
     """
     Функция для создания периодической задачи get_new_mail по tg_id пользователя.
+    Задача включается, когда у пользователя появляются ящики и отправители.
 
     :param tg_id: int - telegram_id пользователя
+    :param enabled: bool - включить задачу сразу
     """
     schedule, _ = IntervalSchedule.objects.get_or_create(
         every=settings.DEFAULT_PERIOD_TASKS_MIN,
@@ -56,4 +476,98 @@ def create_periodic_task(tg_id: int) -> None:
         task="get_new_mail",
         kwargs=json.dumps({"tg_id": tg_id}),
         start_time=datetime.datetime.utcnow(),
+        enabled=enabled,
+    )
+
+
+def refresh_user(tg_id: int) -> None:
+    """
+    Функция обновления снимка настроек пользователя после их изменения.
+    В режиме per_user задача пользователя без ящиков или отправителей отключается,
+    чтобы beat не ставил ее в очередь.
+
+    :param tg_id: int - telegram_id пользователя
+    """
+    data = user_snapshots.refresh(tg_id)
+    if settings.SCHEDULER_MODE != SCHEDULER_PER_USER:
+        return
+    active = bool(data["mails"] and data["senders"])
+    if (
+        PeriodicTask.objects.filter(name=f"Get_mails_tg_id:{tg_id}")
+        .exclude(enabled=active)
+        .update(enabled=active)
+    ):
+        PeriodicTasks.update_changed()
+
+
+def setup_scheduler(
+    mode: str = settings.SCHEDULER_MODE, shards: int = settings.SCHEDULER_SHARDS
+) -> None:
+    """
+    Функция приведения периодических задач в соответствие с режимом планировщика.
+
+    В режиме sharded создаются задачи get_new_mail_shard для каждого из shards шардов,
+    запуск которых равномерно и со случайным разбросом распределен по интервалу проверки,
+    а задачи пользователей отключаются. В режиме per_user создаются недостающие задачи
+    пользователей и включаются задачи пользователей с ящиками и отправителями,
+    а задачи шардов отключаются.
+
+    :param mode: str - режим планировщика, per_user или sharded
+    :param shards: int - число шардов
+    """
+    from api.models import User
+
+    schedule, _ = IntervalSchedule.objects.get_or_create(
+        every=settings.DEFAULT_PERIOD_TASKS_MIN,
+        period=IntervalSchedule.MINUTES,
+    )
+    user_tasks = PeriodicTask.objects.filter(task="get_new_mail")
+    shard_tasks = PeriodicTask.objects.filter(task="get_new_mail_shard")
+
+    if mode == SCHEDULER_SHARDED:
+        interval = datetime.timedelta(minutes=settings.DEFAULT_PERIOD_TASKS_MIN)
+        # время с часовым поясом: наивное время django считает локальным (TIME_ZONE)
+        now = timezone.now()
+        names: list[str] = list()
+        for shard in range(shards):
+            name = f"Get_mails_shard:{shard}/{shards}"
+            names.append(name)
+            offset = interval * (shard + random.random()) / shards
+            PeriodicTask.objects.update_or_create(
+                name=name,
+                defaults=dict(
+                    interval=schedule,
+                    task="get_new_mail_shard",
+                    kwargs=json.dumps({"shard": shard, "shards": shards}),
+                    start_time=now + offset,
+                    enabled=True,
+                ),
+            )
+        shard_tasks.exclude(name__in=names).delete()
+        user_tasks.update(enabled=False)
+    else:
+        existing = set(user_tasks.values_list("name", flat=True))
+        for tg_id in User.objects.values_list("tg_id", flat=True):
+            if f"Get_mails_tg_id:{tg_id}" not in existing:
+                create_periodic_task(tg_id)
+        active = get_active_users().values_list("tg_id", flat=True)
+        user_tasks.update(enabled=False)
+        user_tasks.filter(
+            name__in=[f"Get_mails_tg_id:{tg_id}" for tg_id in active]
+        ).update(enabled=True)
+        shard_tasks.update(enabled=False)
+
+    depths_schedule, _ = IntervalSchedule.objects.get_or_create(
+        every=settings.MAIL_PIPELINE_DEPTH_INTERVAL_SEC,
+        period=IntervalSchedule.SECONDS,
+    )
+    PeriodicTask.objects.update_or_create(
+        name="Report_queue_depths",
+        defaults=dict(
+            interval=depths_schedule,
+            task="report_queue_depths",
+            enabled=settings.MAIL_PIPELINE == PIPELINE_QUEUES,
+        ),
     )
+    # массовые update не вызывают сигналы, планировщик beat нужно уведомить явно
+    PeriodicTasks.update_changed()
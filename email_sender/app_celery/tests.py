@@ -1,15 +1,84 @@
+import asyncio
+import base64
+import io
 import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
-from datetime import datetime
-from unittest.mock import AsyncMock, MagicMock, Mock
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
 
-from aioimaplib import Response
+import rsa
+from aiogram.utils.exceptions import RetryAfter
+from aiohttp import web
+from aioimaplib import STOP_WAIT_SERVER_PUSH, Response
 from api.encrypt import EncryptionService
-from app_celery.mailsender_service import AbstractMailSender
+from api.models import Mail as MailModel
+from api.models import MailProvider, MailSyncState, TrackedMailSender, User
+from app_celery import bodystructure
+from app_celery.browser_pool import BrowserPool, PooledBrowser, process_tree_rss_mb
+from app_celery.idle_gateway import MailboxWatcher
+from app_celery.locks import LeaseManager
+from app_celery.mailsender_service import AbstractMailSender, MailSender
+from app_celery.mailsender_service.images import (
+    IMAGE_JPEG,
+    IMAGE_WEBP,
+    Image,
+    ScreenshotEncoder,
+    image_format,
+)
+from app_celery.mailsender_service.mailsender import split_message
+from app_celery.mailsender_service.ratelimit import DeliveryTimeout, RateLimiter
+from app_celery.mailsender_service.session import BotSessionManager
+from app_celery.metrics import metrics
+from app_celery.pipeline import MessageStore, PipelineMailService, render_messages
+from app_celery.render_service import (
+    AbstractRenderer,
+    AssetCache,
+    AssetPolicy,
+    CachedRenderer,
+    DiskRenderCache,
+    PartialScreenshot,
+    RemoteRenderer,
+    RenderError,
+    RenderScheduler,
+    RenderServer,
+    TextRenderer,
+    with_render_cache,
+)
+from app_celery.render_service.browser import BrowserRenderer
+from app_celery.render_service.cache import content_key
+from app_celery.runtime import AsyncRuntime
 from app_celery.schemes import Mail
-from app_celery.services import MailService
-from app_celery.utils import MAIL_FOLDER, STATE_AUTH
+from app_celery.services import (
+    HEADER_CAPTION,
+    PLAIN_TEXT_BROWSER,
+    PLAIN_TEXT_IMAGE,
+    PLAIN_TEXT_MESSAGE,
+    MailService,
+)
+from app_celery.snapshots import user_snapshots
+from app_celery.tasks import (
+    SCHEDULER_PER_USER,
+    SCHEDULER_SHARDED,
+    check_user,
+    collect_mail_errors,
+    create_periodic_task,
+    deliver_screenshots,
+    get_new_mail_mailboxes,
+    release_messages,
+    run_check,
+    setup_scheduler,
+)
+from app_celery.utils import MAIL_FOLDER, STATE_AUTH, get_shard_data
 from django.conf import settings
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django_celery_beat.models import PeriodicTask
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 
 
 class TestResult:
@@ -34,6 +103,17 @@ class TestResult:
         ]
 
 
+BODYSTRUCTURE_RESPONSE = [
+    b'1 FETCH (UID 1 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 10 1 NIL NIL NIL)'
+    b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 40 2 NIL NIL NIL) "ALTERNATIVE" NIL NIL NIL)'
+    b'("IMAGE" "PNG" NIL "<logo@example.com>" NIL "BASE64" 8 NIL ("INLINE" NIL) NIL)'
+    b'("APPLICATION" "PDF" ("NAME" {10}',
+    b"report.pdf",
+    b') NIL NIL "BASE64" 20000000 NIL ("ATTACHMENT" NIL) NIL) "MIXED" NIL NIL NIL))',
+    b"FETCH completed",
+]
+
+
 class FakeEncrypt(EncryptionService):
     """
     Фейковый сервис шифроыки паролей
@@ -51,8 +131,22 @@ class MockMailService(MailService):
     Модифиуированный почтовый сервис с имитацией подключения к imap
     """
 
-    def _connect_imap(self, host: str, port: int) -> None:
-        pass
+    def _connect_imap(self, host: str, port: int):
+        return self.imap_client
+
+
+class FakeRenderPool(BrowserPool):
+    """
+    Фейковый пул браузеров, выдающий страницу-заглушку
+    """
+
+    @asynccontextmanager
+    async def page(self):
+        page = MagicMock()
+        page.set_content = AsyncMock()
+        page.wait_for_load_state = AsyncMock()
+        page.screenshot = AsyncMock(return_value=b"png")
+        yield page
 
 
 class FakeMailSender(AbstractMailSender):
@@ -63,7 +157,7 @@ class FakeMailSender(AbstractMailSender):
     def __init__(self, user_id: int = 1111) -> None:
         self.user_id = user_id
 
-    async def send_photo(self, screenshot: bytes) -> bool:
+    async def send_photo(self, screenshot: bytes, caption: str | None = None) -> bool:
         return True
 
     async def send_warning(self, data: dict) -> bool:
@@ -85,14 +179,27 @@ class TestMailService(unittest.IsolatedAsyncioTestCase):
         self.mock_imap_client.get_state = Mock(return_value=STATE_AUTH)
         self.mock_imap_client.select = AsyncMock()
         self.mock_imap_client.uid = AsyncMock(return_value=TestResult())
+        self.mock_imap_client.uid_search = AsyncMock(
+            return_value=Response(result="OK", lines=[b"1 2", b"SEARCH completed"])
+        )
         self.mock_imap_client.wait_hello_from_server = AsyncMock()
         self.mock_imap_client.close = AsyncMock()
+        self.mock_imap_client.logout = AsyncMock()
 
+        self.render_pool = BrowserPool(size=1)
         self.mail_service = MailService(
-            [], [], save_screen=False, date=datetime.now(), send_method=FakeMailSender()
+            [],
+            [],
+            save_screen=False,
+            date=datetime.now(),
+            send_method=FakeMailSender(),
+            render_pool=self.render_pool,
         )
         self.mail_service.imap_client = self.mock_imap_client
 
+    async def asyncTearDown(self) -> None:
+        await self.render_pool.close()
+
     async def test_check_new_mails(self):
         """
         Интеграционный тест почтового сервиса
@@ -113,6 +220,7 @@ class TestMailService(unittest.IsolatedAsyncioTestCase):
             date=test_date,
             encrypt_method=FakeEncrypt(),
             send_method=FakeMailSender(),
+            render_pool=FakeRenderPool(),
         )
         mail_service.imap_client = self.mock_imap_client
         await mail_service.check_new_mails()
@@ -122,6 +230,144 @@ class TestMailService(unittest.IsolatedAsyncioTestCase):
                 "STORE", "2", "+FLAGS", r"\Seen"
             )
 
+    async def test_check_mailboxes_concurrently(self):
+        """
+        Ящики проверяются одновременно в пределах лимита пользователя,
+        таймаут одного ящика не мешает проверке остальных
+        """
+        test_mails = [
+            Mail(
+                email=f"test{i}@example.com",
+                password="password",
+                provider={"host": "imap.example.com", "port": 993},
+            )
+            for i in range(3)
+        ]
+        mail_service = MockMailService(
+            mails=test_mails,
+            senders=[],
+            encrypt_method=FakeEncrypt(),
+            send_method=FakeMailSender(),
+            render_pool=self.render_pool,
+            max_connections=2,
+        )
+        mail_service.imap_client = self.mock_imap_client
+        active, peak, calls = 0, 0, 0
+
+        async def hello():
+            nonlocal active, peak, calls
+            calls += 1
+            first_call = calls == 1
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            if first_call:
+                raise asyncio.TimeoutError
+
+        self.mock_imap_client.wait_hello_from_server = AsyncMock(side_effect=hello)
+        await mail_service.check_new_mails()
+
+        self.assertEqual(peak, 2)
+        self.assertEqual(mail_service.errors, {"timeout": ["test0@example.com"]})
+        self.assertEqual(self.mock_imap_client.select.await_count, 2)
+        self.assertEqual(self.mock_imap_client.logout.await_count, 3)
+
+    async def test_search_chunks(self):
+        """
+        Поиск на сервере разбивает список отправителей на части
+        и запрашивает заголовки только найденных писем
+        """
+        self.mail_service.senders = [f"sender{i}@example.com" for i in range(5)]
+        self.mail_service.search_chunk_size = 2
+        self.mail_service.get_mails = AsyncMock()  # type: ignore
+
+        await self.mail_service._fetch_messages_headers(self.test_email)
+
+        self.assertEqual(self.mock_imap_client.uid_search.await_count, 3)
+        criteria = self.mock_imap_client.uid_search.await_args_list[0].args
+        self.assertEqual(
+            criteria[-5:],
+            ("OR", "FROM", '"sender0@example.com"', "FROM", '"sender1@example.com"'),
+        )
+        self.assertEqual(self.mock_imap_client.uid.await_args.args[1], "1:2")
+        self.assertEqual(self.mail_service.fetch_paths[self.test_email], "search")
+
+    async def test_search_result_lines(self):
+        """
+        Uid берутся из всех строк ответа поиска кроме завершающей,
+        строки с другими данными и uid меньше from_uid пропускаются
+        """
+        self.mock_imap_client.uid_search = AsyncMock(
+            return_value=Response(
+                result="OK", lines=[b"3 5 7", b"4 EXISTS", b"9", b"SEARCH completed"]
+            )
+        )
+        self.mail_service.senders = [self.test_sender]
+
+        uids = await self.mail_service._search_new_uids(from_uid=4)
+
+        self.assertEqual(uids, [5, 7, 9])
+
+    async def test_release_messages(self):
+        """
+        Письма, не отправленные конвейером, возвращаются в непрочитанные,
+        а состояние синхронизации откатывается до первого из них
+        """
+        self.mock_imap_client.select = AsyncMock(
+            return_value=Response(result="OK", lines=[b"OK [UIDVALIDITY 17]"])
+        )
+        self.mail_service.encrypt_method = FakeEncrypt()
+        self.mail_service._connect_imap = Mock(  # type: ignore
+            return_value=self.mock_imap_client
+        )
+        mail = Mail(
+            email=self.test_email,
+            password="password",
+            provider={"host": "imap.example.com", "port": 993},
+            uid_validity=17,
+            last_uid=10,
+        )
+
+        self.assertTrue(await self.mail_service.release_messages(mail, [7, 5]))
+        self.mock_imap_client.uid.assert_awaited_once_with(
+            "STORE", "5,7", "-FLAGS", r"\Seen"
+        )
+        self.assertEqual(
+            self.mail_service.sync_states[self.test_email],
+            {"uid_validity": 17, "last_uid": 4},
+        )
+
+        mail.uid_validity = 18
+        self.mock_imap_client.uid.reset_mock()
+        self.assertFalse(await self.mail_service.release_messages(mail, [7]))
+        self.mock_imap_client.uid.assert_not_awaited()
+
+    async def test_search_fallback(self):
+        """
+        При ошибке поиска письма отбираются по заголовкам на клиенте
+        """
+        self.mock_imap_client.uid_search = AsyncMock(
+            return_value=Response(result="BAD", lines=[b"SEARCH not supported"])
+        )
+        self.mail_service.senders = [self.test_sender]
+        self.mail_service.date = datetime(year=2000, month=1, day=1)
+        self.mail_service.get_mails = AsyncMock()  # type: ignore
+
+        await self.mail_service._fetch_messages_headers(self.test_email, from_uid=1)
+
+        self.assertEqual(self.mock_imap_client.uid.await_args.args[1], "1:*")
+        self.assertEqual(self.mail_service.fetch_paths[self.test_email], "fetch")
+        self.mail_service.get_mails.assert_awaited_once_with(
+            {1: self.test_sender}, self.test_email
+        )
+
+    def test_uid_set(self):
+        """
+        Список uid сжимается в диапазоны
+        """
+        self.assertEqual(self.mail_service._uid_set([1, 2, 3, 7, 9, 10]), "1:3,7,9:10")
+
     async def test_get_mail(self):
         """
         Тестирование получения письма
@@ -131,6 +377,174 @@ class TestMailService(unittest.IsolatedAsyncioTestCase):
         )
         self.assertTrue(len(self.mail_service.mail_list) == 1)
 
+    async def test_get_mail_renderable_parts(self):
+        """
+        Загружаются только html-часть и встроенное изображение, вложение пропускается
+        """
+        self.mock_imap_client.uid = AsyncMock(
+            side_effect=[
+                Response("OK", BODYSTRUCTURE_RESPONSE),
+                Response(
+                    "OK",
+                    [
+                        b"1 FETCH (UID 1 BODY[1.2] {32}",
+                        b'caf=C3=A9 <img src=3D"cid:logo@e',
+                        b' BODY[2] "aGk=")',
+                        b"FETCH completed",
+                    ],
+                ),
+                Response("OK", []),
+            ]
+        )
+        self.mail_service.generate_screenshot = AsyncMock()  # type: ignore
+        await self.mail_service.get_mail(
+            self.test_msg_id, self.test_sender, self.test_email
+        )
+        await asyncio.wait(self.mail_service.mail_list)
+
+        fetch = self.mock_imap_client.uid.await_args_list[1].args
+        self.assertEqual(fetch[2], "(UID BODY.PEEK[1.2] BODY.PEEK[2])")
+        content = self.mail_service.generate_screenshot.await_args.args[0]
+        self.assertIn("café", content)
+
+    async def test_get_mail_fallback_inline_images(self):
+        """
+        Если BODYSTRUCTURE разобрать не удалось, письмо загружается целиком,
+        а встроенные изображения cid: подставляются в html
+        """
+        raw_message = (
+            b"Content-Type: multipart/related; boundary=b\r\n\r\n"
+            b"--b\r\nContent-Type: text/html; charset=utf-8\r\n\r\n"
+            b'<img src="cid:logo@example.com">\r\n'
+            b"--b\r\nContent-Type: image/png\r\nContent-ID: <logo@example.com>\r\n"
+            b"Content-Transfer-Encoding: base64\r\n\r\naGk=\r\n--b--\r\n"
+        )
+        self.mock_imap_client.uid = AsyncMock(
+            side_effect=[
+                Response(
+                    "OK",
+                    [
+                        b'1 FETCH (UID 1 BODYSTRUCTURE ("TEXT" "HTML\\',
+                        b"FETCH completed",
+                    ],
+                ),
+                Response(
+                    "OK",
+                    [
+                        b"1 FETCH (UID 1 RFC822 {%d}" % len(raw_message),
+                        raw_message,
+                        b")",
+                        b"FETCH completed",
+                    ],
+                ),
+            ]
+        )
+        self.mail_service.generate_screenshot = AsyncMock()  # type: ignore
+        await self.mail_service.get_mails({1: self.test_sender}, self.test_email)
+        await asyncio.wait(self.mail_service.mail_list)
+
+        fetch = self.mock_imap_client.uid.await_args_list[1].args
+        self.assertEqual(fetch[2], "(UID RFC822)")
+        content = self.mail_service.generate_screenshot.await_args.args[0]
+        self.assertIn('src="data:image/png;base64,aGk="', content)
+
+    async def test_get_mails_batches(self):
+        """
+        Письма загружаются одной командой на пачку, флаги обновляются
+        одной командой STORE на каждый исход. Письмо, которое не удалось загрузить,
+        считается неотправленным
+        """
+        self.mail_service.fetch_mode = "rfc822"
+        self.mail_service.fetch_batch_size = 2
+        self.mail_service.render_pool = FakeRenderPool()
+        self.mail_service.mail_sender_service.send_photo = AsyncMock(  # type: ignore
+            return_value=True
+        )
+        await self.mail_service.get_mails(
+            {1: self.test_sender, 2: self.test_sender, 5: self.test_sender},
+            self.test_email,
+        )
+        await asyncio.wait(self.mail_service.mail_list)
+        await self.mail_service._store_flags(self.test_email)
+
+        calls = [call.args for call in self.mock_imap_client.uid.await_args_list]
+        self.assertEqual(
+            calls,
+            [
+                ("fetch", "1:2", "(UID RFC822)"),
+                ("fetch", "5", "(UID RFC822)"),
+                ("STORE", "1:2", "+FLAGS", r"\Seen"),
+                ("STORE", "5", "-FLAGS", r"\Seen"),
+            ],
+        )
+
+    async def test_send_album(self):
+        """
+        Скриншоты писем ящика отправляются одним альбомом после рендера
+        """
+        self.mail_service.fetch_mode = "rfc822"
+        self.mail_service.album_size = 10
+        self.mail_service.render_pool = FakeRenderPool()
+        self.mail_service.mail_sender_service.send_album = AsyncMock(  # type: ignore
+            return_value=[True, True]
+        )
+        self.mail_service.senders = [self.test_sender, "test_sender3@example.com"]
+        self.mail_service.date = datetime(year=2000, month=1, day=1)
+        self.mock_imap_client.uid_search = AsyncMock(
+            return_value=Response(result="BAD", lines=[b"SEARCH not supported"])
+        )
+
+        await self.mail_service.process_new_messages(self.test_email)
+
+        self.mail_service.mail_sender_service.send_album.assert_awaited_once_with(
+            [b"png", b"png"], [None, None]
+        )
+        self.mock_imap_client.uid.assert_awaited_with(
+            "STORE", "1:2", "+FLAGS", r"\Seen"
+        )
+
+    def test_select_parts_budget(self):
+        """
+        Изображения, не уместившиеся в бюджет, не загружаются
+        """
+        data = bodystructure.parse_fetch_all(BODYSTRUCTURE_RESPONSE[:-1])
+        parts = bodystructure.parse_bodystructure(data[1]["BODYSTRUCTURE"])
+        self.assertEqual([part.section for part in parts], ["1.1", "1.2", "2", "3"])
+        self.assertTrue(parts[3].is_attachment)
+        text, images = bodystructure.select_parts(parts, max_bytes=100)
+        self.assertEqual(
+            (text.section, [image.section for image in images]), ("1.2", ["2"])
+        )
+        _, images = bodystructure.select_parts(parts, max_bytes=45)
+        self.assertEqual(images, [])
+
+    def test_parse_list_malformed(self):
+        """
+        Строка, обрывающаяся на экранирующем символе, - ошибка разбора ValueError,
+        по которой проверка переходит к загрузке письма целиком
+        """
+        for data in (b'("abc\\', b'("abc'):
+            with self.assertRaises(ValueError):
+                bodystructure.parse_list(data)
+
+    def test_inline_images(self):
+        """
+        Ссылки cid: заменяются на data URI
+        """
+        image = bodystructure.BodyPart(
+            section="2",
+            maintype="image",
+            subtype="png",
+            encoding="base64",
+            content_id="logo@example.com",
+        )
+        self.assertEqual(
+            bodystructure.inline_images(
+                '<img src="cid:logo@example.com">', [(image, b"aGVs\r\nbG8=")]
+            ),
+            '<img src="data:image/png;base64,aGVsbG8=">',
+        )
+
     async def test_generate_screenshot_bytes(self):
         """
         Тестирование генерации скриншота в виде байтовой строки
@@ -139,11 +553,7 @@ class TestMailService(unittest.IsolatedAsyncioTestCase):
         await self.mail_service.generate_screenshot(
             self.test_content, self.test_email, self.test_msg_id
         )
-        self.mock_imap_client.uid.assert_called_with("STORE", "1", "+FLAGS", r"\Seen")
-        with self.assertRaises(AssertionError):
-            self.mock_imap_client.uid.assert_called_with(
-                "STORE", "2", "+FLAGS", r"\Seen"
-            )
+        self.assertEqual(self.mail_service.sent_uids, {self.test_email: {1}})
 
     async def test_generate_screenshot_png(self):
         """
@@ -166,3 +576,1527 @@ class TestMailService(unittest.IsolatedAsyncioTestCase):
             os.remove(file.path)
         os.rmdir(os.path.join(settings.BASE_DIR.parent, MAIL_FOLDER, self.test_email))
         os.rmdir(os.path.join(settings.BASE_DIR.parent, MAIL_FOLDER))
+
+
+class TestBrowserPool(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты пула браузеров без запуска настоящего Firefox
+    """
+
+    @staticmethod
+    def _fake_browser() -> PooledBrowser:
+        context = MagicMock()
+        context.new_page = AsyncMock(return_value=MagicMock())
+        context.close = AsyncMock()
+        browser = MagicMock()
+        browser.is_connected = Mock(return_value=True)
+        browser.new_context = AsyncMock(return_value=context)
+        browser.close = AsyncMock()
+        return PooledBrowser(browser=browser)
+
+    async def test_browser_reused_and_recycled(self):
+        """
+        Браузер переиспользуется между рендерами и перезапускается после max_renders
+        """
+        pool = BrowserPool(size=1, max_renders=2)
+        pool._launch = AsyncMock(side_effect=self._fake_browser)  # type: ignore
+
+        browsers = []
+        for _ in range(3):
+            async with pool.page():
+                pass
+            browsers.append(pool._browsers._queue[0])  # type: ignore
+
+        self.assertEqual(pool._launch.call_count, 2)
+        self.assertIsNone(browsers[1])
+        browsers[0].browser.close.assert_awaited_once()
+        browsers[2].browser.close.assert_not_called()
+
+    async def test_recycled_by_memory(self):
+        """
+        Браузер перезапускается, если его дерево процессов заняло больше max_memory_mb,
+        память браузера с неизвестным процессом не проверяется
+        """
+        self.assertGreater(process_tree_rss_mb(os.getpid()), 0)
+        pool = BrowserPool(size=1, max_renders=0, max_memory_mb=1)
+        pooled = self._fake_browser()
+        self.assertIsNone(await pool._recycle_reason(pooled))
+        pooled.pid = os.getpid()
+        self.assertEqual(await pool._recycle_reason(pooled), "memory")
+
+    async def test_close(self):
+        """
+        При остановке пула закрываются все запущенные браузеры
+        """
+        pool = BrowserPool(size=2, max_renders=0)
+        pool._launch = AsyncMock(side_effect=self._fake_browser)  # type: ignore
+        async with pool.page():
+            pass
+        pooled = pool._browsers._queue[-1]  # type: ignore
+
+        await pool.close()
+
+        pooled.browser.close.assert_awaited_once()
+        self.assertFalse(pool.started)
+
+
+class TestBotSession(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.session_manager = BotSessionManager(token="123456:TEST")
+
+    async def asyncTearDown(self) -> None:
+        await self.session_manager.close()
+
+    async def test_bot_shared_between_senders(self):
+        """
+        Отправители разных пользователей используют один бот процесса
+        """
+        first = MailSender(user_id=1, session=self.session_manager)
+        second = MailSender(user_id=2, session=self.session_manager)
+        bot = self.session_manager.get_bot()
+        with patch.object(bot, "send_message", AsyncMock()) as send_message:
+            self.assertTrue(await first.send_warning({"msg": "test"}))
+            self.assertTrue(await second.send_warning({"msg": "test"}))
+        self.assertEqual(send_message.await_count, 2)
+        self.assertIs(self.session_manager.get_bot(), bot)
+
+    async def test_connections_reused(self):
+        """
+        Сессия бота переиспользует соединение между запросами
+        """
+
+        async def handler(request: web.Request) -> web.Response:
+            return web.Response(text="ok")
+
+        app = web.Application()
+        app.router.add_get("/", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+
+        created = metrics.get("telegram_session.connections.created")
+        reused = metrics.get("telegram_session.connections.reused")
+        session = await self.session_manager.get_bot().get_session()
+        try:
+            for _ in range(3):
+                async with session.get(f"http://127.0.0.1:{port}/") as response:
+                    await response.read()
+        finally:
+            await runner.cleanup()
+        self.assertEqual(
+            metrics.get("telegram_session.connections.created"), created + 1
+        )
+        self.assertEqual(metrics.get("telegram_session.connections.reused"), reused + 2)
+
+
+class TestMailSenderAlbum(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.session_manager = BotSessionManager(token="123456:TEST")
+        self.mail_sender = MailSender(
+            user_id=1, session=self.session_manager, limiter=RateLimiter(chat_rate=100)
+        )
+        self.bot = self.session_manager.get_bot()
+
+    async def asyncTearDown(self) -> None:
+        await self.session_manager.close()
+
+    async def test_albums_of_ten(self):
+        """
+        Скриншоты разбиваются на альбомы не более 10 документов
+        """
+        with patch.object(self.bot, "send_media_group", AsyncMock()) as send_group:
+            results = await self.mail_sender.send_album([b"png"] * 12)
+        self.assertEqual(results, [True] * 12)
+        self.assertEqual(
+            [len(call.kwargs["media"]) for call in send_group.await_args_list], [10, 2]
+        )
+
+    async def test_album_fallback(self):
+        """
+        При ошибке отправки альбома скриншоты отправляются по одному
+        """
+        with patch.object(
+            self.bot, "send_media_group", AsyncMock(side_effect=Exception)
+        ), patch.object(self.bot, "send_document", AsyncMock()) as send_document:
+            results = await self.mail_sender.send_album([b"png"] * 3)
+        self.assertEqual(results, [True] * 3)
+        self.assertEqual(send_document.await_count, 3)
+
+    async def test_partial_screenshot_not_resent(self):
+        """
+        Высокий скриншот, часть альбомов которого уже отправлена, считается отправленным,
+        чтобы повторная попытка не дублировала части, а пользователь получает предупреждение
+        """
+        self.mail_sender._encode = AsyncMock(return_value=[b"png"] * 12)  # type: ignore
+        with patch.object(
+            self.bot, "send_media_group", AsyncMock(side_effect=[None, Exception])
+        ), patch.object(self.bot, "send_message", AsyncMock()) as send_message:
+            self.assertTrue(await self.mail_sender.send_photo(b"png"))
+        send_message.assert_awaited_once()
+
+        with patch.object(
+            self.bot, "send_media_group", AsyncMock(side_effect=Exception)
+        ), patch.object(self.bot, "send_message", AsyncMock()) as send_message:
+            self.assertFalse(await self.mail_sender.send_photo(b"png"))
+        send_message.assert_not_awaited()
+
+
+def make_png(width: int, height: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (255, 255, 255)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+@unittest.skipIf(Image is None, "Pillow is not installed")
+class TestScreenshotEncoder(unittest.IsolatedAsyncioTestCase):
+    def test_lossless_passthrough(self):
+        """
+        Скриншот png без палитры и разрезания отправляется без перекодирования
+        """
+        screenshot = make_png(100, 300)
+        self.assertEqual(ScreenshotEncoder().encode(screenshot), [screenshot])
+
+    def test_tiles(self):
+        """
+        Высокий скриншот разрезается на части сверху вниз не выше max_height
+        """
+        encoder = ScreenshotEncoder(image_format=IMAGE_JPEG, max_height=250)
+        tiles = encoder.encode(make_png(100, 600))
+        heights = list()
+        for tile in tiles:
+            self.assertEqual(image_format(tile), IMAGE_JPEG)
+            with Image.open(io.BytesIO(tile)) as image:
+                heights.append(image.height)
+        self.assertEqual(heights, [250, 250, 100])
+
+    def test_format_height_limit(self):
+        """
+        Скриншот выше ограничения формата разрезается и без max_height
+        """
+        tiles = ScreenshotEncoder(image_format=IMAGE_WEBP).encode(make_png(10, 20000))
+        self.assertEqual(len(tiles), 2)
+        self.assertEqual(image_format(tiles[0]), IMAGE_WEBP)
+
+    def test_palette_png(self):
+        """
+        Png с палитрой меньше исходного скриншота, статистика учитывает размеры
+        """
+        image = Image.effect_noise((200, 200), 64).convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        screenshot = buffer.getvalue()
+        produced = metrics.get("screenshot_output.produced_bytes")
+        encoded = metrics.get("screenshot_output.encoded_bytes")
+
+        tiles = ScreenshotEncoder(palette_colors=16).encode(screenshot)
+        self.assertLess(len(tiles[0]), len(screenshot))
+        self.assertEqual(
+            metrics.get("screenshot_output.produced_bytes"), produced + len(screenshot)
+        )
+        self.assertEqual(
+            metrics.get("screenshot_output.encoded_bytes"), encoded + len(tiles[0])
+        )
+
+    async def test_send_tiles(self):
+        """
+        Части скриншота отправляются одним альбомом с подписью у первой части,
+        скриншоты альбомов не разделяются
+        """
+        session_manager = BotSessionManager(token="123456:TEST")
+        mail_sender = MailSender(
+            user_id=1,
+            session=session_manager,
+            limiter=RateLimiter(chat_rate=100),
+            encoder=ScreenshotEncoder(image_format=IMAGE_JPEG, max_height=100),
+        )
+        bot = session_manager.get_bot()
+        uploaded = metrics.get("screenshot_output.uploaded_bytes")
+        with patch.object(bot, "send_media_group", AsyncMock()) as send_group:
+            results = await mail_sender.send_album(
+                [make_png(10, 300), make_png(10, 800)], ["first", "second"]
+            )
+        await session_manager.close()
+
+        self.assertEqual(results, [True, True])
+        albums = [call.kwargs["media"] for call in send_group.await_args_list]
+        self.assertEqual([len(media) for media in albums], [3, 8])
+        self.assertEqual([media.caption for media in albums[0]], ["first", None, None])
+        self.assertEqual(albums[1][0].caption, "second")
+        self.assertTrue(albums[0][0].file.filename.endswith(".jpeg"))
+        self.assertGreater(metrics.get("screenshot_output.uploaded_bytes"), uploaded)
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_chat_limit_queues(self):
+        """
+        Сообщения сверх лимита чата ожидают очереди, другие чаты не ограничиваются
+        """
+        limiter = RateLimiter(global_rate=100, chat_rate=10)
+        waits = [await limiter.acquire(chat_id=1) for _ in range(11)]
+        self.assertLess(max(waits[:10]), 0.01)
+        self.assertGreater(waits[10], 0.05)
+        self.assertLess(await limiter.acquire(chat_id=2), 0.01)
+
+    async def test_max_wait(self):
+        """
+        Ожидание дольше max_wait завершается ошибкой
+        """
+        limiter = RateLimiter(chat_rate=1, max_wait=0.01)
+        await limiter.acquire(chat_id=1)
+        with self.assertRaises(DeliveryTimeout):
+            await limiter.acquire(chat_id=1)
+
+    async def test_retry_after(self):
+        """
+        После RetryAfter отправка повторяется по истечении указанного времени
+        """
+        session_manager = BotSessionManager(token="123456:TEST")
+        limiter = RateLimiter(chat_rate=100)
+        mail_sender = MailSender(user_id=1, session=session_manager, limiter=limiter)
+        bot = session_manager.get_bot()
+        retries = metrics.get("telegram_rate.retry_after")
+        with patch.object(
+            bot, "send_message", AsyncMock(side_effect=[RetryAfter(0.05), None])
+        ) as send_message:
+            self.assertTrue(await mail_sender.send_warning({"msg": "test"}))
+        await session_manager.close()
+        self.assertEqual(send_message.await_count, 2)
+        self.assertEqual(metrics.get("telegram_rate.retry_after"), retries + 1)
+
+
+class TestMailboxWatcher(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты цикла IDLE шлюза на имитации imap-клиента
+    """
+
+    async def asyncSetUp(self) -> None:
+        self.watcher = MailboxWatcher(
+            tg_id=1111,
+            mail=Mail(
+                email="test@example.com",
+                password="password",
+                provider={"host": "imap.example.com", "port": 993},
+            ),
+            senders=["test_sender1@example.com"],
+            encrypt_method=FakeEncrypt(),
+        )
+        idle = asyncio.get_running_loop().create_future()
+        idle.set_result(Response(result="OK", lines=[]))
+        self.imap_client = MagicMock("aioimaplib.IMAP_SSL")
+        self.imap_client.idle_start = AsyncMock(return_value=idle)
+        self.imap_client.has_pending_idle = Mock(return_value=True)
+        self.imap_client.idle_done = Mock()
+
+    async def test_idle_exists(self):
+        """
+        Уведомление EXISTS завершает IDLE и сообщает о новых письмах
+        """
+        self.imap_client.wait_server_push = AsyncMock(
+            side_effect=[[b"1 RECENT"], [b"5 EXISTS"]]
+        )
+        self.assertTrue(await self.watcher._idle(self.imap_client))
+        self.imap_client.idle_done.assert_called_once()
+
+    async def test_idle_renew(self):
+        """
+        По истечении таймаута IDLE завершается без новых писем для перезапуска
+        """
+        self.imap_client.wait_server_push = AsyncMock(
+            return_value=STOP_WAIT_SERVER_PUSH
+        )
+        self.assertFalse(await self.watcher._idle(self.imap_client))
+        self.imap_client.idle_done.assert_called_once()
+
+    async def test_session_catches_up_from_sync_state(self):
+        """
+        После подключения проверяются письма после сохраненного последнего uid
+        """
+        self.watcher.mail.uid_validity = 17
+        self.watcher.mail.last_uid = 40
+        self.imap_client.select = AsyncMock(
+            return_value=Response(
+                result="OK", lines=[b"OK [UIDVALIDITY 17] UIDs valid"]
+            )
+        )
+        self.watcher._make_service = Mock(  # type: ignore
+            return_value=MailService(
+                [], [], send_method=FakeMailSender(), encrypt_method=FakeEncrypt()
+            )
+        )
+        self.watcher._process = AsyncMock(side_effect=ConnectionError)  # type: ignore
+        with patch(
+            "app_celery.idle_gateway.aioimaplib.IMAP4_SSL",
+            return_value=self.imap_client,
+        ):
+            self.imap_client.wait_hello_from_server = AsyncMock()
+            self.imap_client.login = AsyncMock()
+            self.imap_client.logout = AsyncMock()
+            self.imap_client.get_state = Mock(return_value=STATE_AUTH)
+            with self.assertRaises(ConnectionError):
+                await self.watcher._session()
+        self.assertEqual(self.watcher.last_uid, 40)
+
+
+class TestMailSync(unittest.TestCase):
+    """
+    Тесты инкрементальной синхронизации по UID
+    """
+
+    def setUp(self) -> None:
+        self.mail = Mail(
+            email="test@example.com",
+            password="password",
+            provider={"host": "imap.example.com", "port": 993},
+            uid_validity=17,
+            last_uid=40,
+        )
+        self.mail_service = MailService(
+            [self.mail], [], send_method=FakeMailSender(), resync_window=10
+        )
+
+    def test_mailbox_status(self):
+        """
+        UIDVALIDITY и UIDNEXT извлекаются из ответа на SELECT
+        """
+        response = Response(
+            result="OK",
+            lines=[
+                b"3 EXISTS",
+                b"OK [UIDVALIDITY 17] UIDs valid",
+                b"OK [UIDNEXT 42] Predicted next UID",
+            ],
+        )
+        self.assertEqual(self.mail_service.mailbox_status(response), (17, 42))
+
+    def test_incremental_sync(self):
+        """
+        При неизменном UIDVALIDITY проверка начинается со следующего после последнего uid
+        """
+        response = Response(
+            result="OK", lines=[b"OK [UIDVALIDITY 17]", b"OK [UIDNEXT 100]"]
+        )
+        self.assertEqual(self.mail_service.sync_from_uid(self.mail, response), 41)
+
+    def test_resync_on_uid_validity_change(self):
+        """
+        При смене UIDVALIDITY просматриваются только последние resync_window писем
+        """
+        response = Response(
+            result="OK", lines=[b"OK [UIDVALIDITY 18]", b"OK [UIDNEXT 100]"]
+        )
+        self.assertEqual(self.mail_service.sync_from_uid(self.mail, response), 90)
+        self.assertEqual(
+            self.mail_service.sync_states[self.mail.email],
+            {"uid_validity": 18, "last_uid": 89},
+        )
+
+
+class TestShardScheduler(TestCase):
+    """
+    Тесты планировщика проверки почты по шардам пользователей
+    """
+
+    def setUp(self) -> None:
+        provider = MailProvider.objects.create(
+            name="example", server="imap.example.com", port=993
+        )
+        for tg_id in range(1, 9):
+            user = User.objects.create(tg_id=tg_id, first_name=f"user{tg_id}")
+            if tg_id == 8:
+                continue
+            for number in range(2):
+                mail = MailModel.objects.create(
+                    email=f"{tg_id}.{number}@example.com",
+                    password="password",
+                    user=user,
+                    provider=provider,
+                )
+                MailSyncState.objects.create(mail=mail, last_uid=tg_id)
+            TrackedMailSender.objects.create(user=user, email=f"sender{tg_id}@a.ru")
+
+    def test_shard_data(self):
+        """
+        Данные шарда загружаются постоянным числом запросов и включают
+        только пользователей шарда с ящиками и отправителями
+        """
+        with self.assertNumQueries(3):
+            data = get_shard_data(shard=0, shards=4)
+        self.assertEqual([user["tg_id"] for user in data], [4])
+        self.assertEqual(len(data[0]["mails"]), 2)
+        self.assertEqual(data[0]["mails"][0]["last_uid"], 4)
+        self.assertEqual(data[0]["senders"], ["sender4@a.ru"])
+
+        users = [
+            user["tg_id"]
+            for shard in range(4)
+            for user in get_shard_data(shard=shard, shards=4)
+        ]
+        self.assertEqual(sorted(users), list(range(1, 8)))
+
+    def test_setup_sharded(self):
+        """
+        В режиме sharded создаются задачи шардов, а задачи пользователей отключаются
+        """
+        create_periodic_task(1)
+        setup_scheduler(mode=SCHEDULER_SHARDED, shards=8)
+        started = timezone.now()
+        setup_scheduler(mode=SCHEDULER_SHARDED, shards=4)
+
+        shard_tasks = PeriodicTask.objects.filter(task="get_new_mail_shard")
+        self.assertEqual(shard_tasks.count(), 4)
+        self.assertEqual(
+            len({task.start_time for task in shard_tasks}),
+            4,
+            "запуски шардов разнесены",
+        )
+        interval = timedelta(minutes=settings.DEFAULT_PERIOD_TASKS_MIN)
+        for task in shard_tasks:
+            self.assertGreater(task.start_time, started, "запуск шарда в будущем")
+            self.assertLessEqual(task.start_time, timezone.now() + interval)
+        self.assertFalse(PeriodicTask.objects.get(task="get_new_mail").enabled)
+
+        setup_scheduler(mode=SCHEDULER_PER_USER)
+        user_tasks = PeriodicTask.objects.filter(task="get_new_mail")
+        self.assertEqual(user_tasks.count(), 8)
+        # у пользователя 8 нет ящиков, его задача остается отключенной
+        self.assertEqual(user_tasks.filter(enabled=True).count(), 7)
+        self.assertFalse(shard_tasks.filter(enabled=True).exists())
+
+
+class TestLeaseManager(unittest.TestCase):
+    """
+    Тесты аренд, исключающих одновременные проверки одного пользователя
+    """
+
+    def setUp(self) -> None:
+        self.leases = LeaseManager(ttl=0.3)
+        metrics.reset()
+
+    def test_acquire_release(self):
+        """
+        Занятая аренда не выдается повторно, чужой токен ее не освобождает
+        """
+        token = self.leases.acquire("user:1")
+        self.assertIsNotNone(token)
+        self.assertIsNone(self.leases.acquire("user:1"))
+        self.assertIsNotNone(self.leases.acquire("user:2"))
+        self.leases.release("user:1", "other")
+        self.assertIsNone(self.leases.acquire("user:1"))
+        self.leases.release("user:1", token)
+        self.assertIsNotNone(self.leases.acquire("user:1"))
+
+    def test_overlapping_run_is_coalesced(self):
+        """
+        Запуск во время проверки пропускается, а проверка повторяется ее владельцем
+        """
+        calls: list[int] = list()
+
+        def check() -> int:
+            calls.append(len(calls))
+            if len(calls) == 1:
+                self.assertIsNone(self.leases.run_exclusive("user:1", check))
+            return len(calls)
+
+        self.assertEqual(self.leases.run_exclusive("user:1", check), 2)
+        self.assertEqual(calls, [0, 1])
+        self.assertEqual(metrics.get("mail_lease.skipped"), 1)
+        self.assertEqual(metrics.get("mail_lease.coalesced"), 1)
+        self.assertIsNotNone(self.leases.acquire("user:1"))
+
+    def test_long_run_renews_lease(self):
+        """
+        Аренда продлевается, пока проверка длится дольше ttl
+        """
+
+        def check() -> None:
+            time.sleep(0.5)
+            self.assertIsNone(self.leases.acquire("user:1"))
+
+        self.leases.run_exclusive("user:1", check)
+        self.assertGreaterEqual(metrics.get("mail_lease.renewed"), 1)
+        self.assertEqual(metrics.get("mail_lease.lost"), 0)
+
+
+class TestAsyncRuntime(unittest.TestCase):
+    """
+    Тесты событийного цикла процесса воркера
+    """
+
+    def setUp(self) -> None:
+        self.runtime = AsyncRuntime()
+        self.addCleanup(self.runtime.shutdown)
+
+    def test_loop_is_reused(self):
+        """
+        Задачи процесса выполняются на одном цикле
+        """
+
+        async def current_loop() -> asyncio.AbstractEventLoop:
+            return asyncio.get_running_loop()
+
+        loop = self.runtime.run(current_loop())
+        self.assertIs(self.runtime.run(current_loop()), loop)
+        self.assertFalse(loop.is_closed())
+
+    def test_shutdown(self):
+        """
+        При остановке хуки выполняются в обратном порядке, даже если один из них упал,
+        оставшиеся задачи отменяются, а цикл закрывается
+        """
+        closed: list[str] = list()
+
+        @self.runtime.on_shutdown
+        async def close_first() -> None:
+            closed.append("first")
+
+        @self.runtime.on_shutdown
+        async def close_second() -> None:
+            closed.append("second")
+            raise RuntimeError
+
+        async def start_background() -> asyncio.Task:
+            return asyncio.create_task(asyncio.sleep(60))
+
+        background = self.runtime.run(start_background())
+        loop = self.runtime.loop
+        self.runtime.shutdown()
+
+        self.assertEqual(closed, ["second", "first"])
+        self.assertTrue(background.cancelled())
+        self.assertTrue(loop.is_closed())
+        self.assertFalse(self.runtime.started)
+        self.assertIsNot(self.runtime.loop, loop)
+
+
+class TestPasswordCache(unittest.TestCase):
+    """
+    Тесты кэша расшифрованных паролей
+    """
+
+    def setUp(self) -> None:
+        self.service = EncryptionService(cache_ttl=60, envelope=False)
+        self.crypto = self.service.encrypt("password").encode()
+
+    def test_decrypt_cached(self):
+        """
+        Повторная расшифровка шифра не обращается к rsa, пока не истек ttl или пароль не удален из кэша
+        """
+        with patch("api.encrypt.encryption.rsa.decrypt", wraps=rsa.decrypt) as decrypt:
+            self.assertEqual(self.service.decrypt(self.crypto), "password")
+            self.assertEqual(self.service.decrypt(self.crypto), "password")
+            self.assertEqual(decrypt.call_count, 1)
+
+            self.service.forget(self.crypto.decode())
+            self.assertEqual(self.service.decrypt(self.crypto), "password")
+            self.assertEqual(decrypt.call_count, 2)
+
+            with patch("api.encrypt.encryption.time.monotonic", return_value=1e12):
+                self.assertEqual(self.service.decrypt(self.crypto), "password")
+            self.assertEqual(decrypt.call_count, 3)
+
+    def test_keys_parsed_once(self):
+        """
+        Ключи разбираются один раз на экземпляр сервиса
+        """
+        with patch(
+            "api.encrypt.encryption.rsa.PrivateKey.load_pkcs1",
+            wraps=rsa.PrivateKey.load_pkcs1,
+        ) as load:
+            EncryptionService(cache_ttl=0).decrypt(self.crypto)
+            service = EncryptionService(cache_ttl=0)
+            for _ in range(3):
+                service.decrypt(self.crypto)
+            self.assertEqual(load.call_count, 2)
+
+
+class TestEnvelopeEncryption(unittest.TestCase):
+    """
+    Тесты шифрования паролей конвертом и перешифровки
+    """
+
+    def setUp(self) -> None:
+        self.service = EncryptionService(cache_ttl=0)
+
+    def test_envelope_roundtrip(self):
+        """
+        Пароли шифруются AES-GCM одним ключом данных, RSA-расшифровка нужна один раз на ключ
+        """
+        crypto = [self.service.encrypt(f"password{i}") for i in range(3)]
+        self.assertTrue(all(self.service.is_current(item) for item in crypto))
+        self.assertEqual(len({item.split(":")[2] for item in crypto}), 1)
+
+        reader = EncryptionService(cache_ttl=0)
+        with patch("api.encrypt.encryption.rsa.decrypt", wraps=rsa.decrypt) as decrypt:
+            for i, item in enumerate(crypto):
+                self.assertEqual(reader.decrypt(item.encode()), f"password{i}")
+            self.assertEqual(decrypt.call_count, 1)
+
+        version, key_id, wrapped_key, nonce, payload = crypto[0].split(":")
+        tampered = ":".join((version, key_id, wrapped_key, nonce, payload[::-1]))
+        with self.assertRaises(Exception):
+            reader.decrypt(tampered.encode())
+
+    def test_reencrypt_legacy_and_rotated(self):
+        """
+        Пароли прежнего формата и прежнего ключа расшифровываются и перешифровываются текущим ключом
+        """
+        legacy = EncryptionService(cache_ttl=0, envelope=False).encrypt("legacy")
+        self.assertFalse(self.service.is_current(legacy))
+        self.assertEqual(self.service.decrypt(legacy.encode()), "legacy")
+        reencrypted = self.service.reencrypt(legacy)
+        self.assertTrue(self.service.is_current(reencrypted))
+        self.assertEqual(self.service.decrypt(reencrypted.encode()), "legacy")
+
+        old_public, old_private = rsa.newkeys(512)
+        old_body = "".join(old_private.save_pkcs1().decode().splitlines()[1:-1])
+        rotated = base64.b64encode(rsa.encrypt(b"rotated", old_public)).decode()
+        with override_settings(OLD_PRIVATE_KEYS=[old_body]):
+            service = EncryptionService(cache_ttl=0)
+            self.assertFalse(service.is_current(rotated))
+            reencrypted = service.reencrypt(rotated)
+        self.assertTrue(self.service.is_current(reencrypted))
+        self.assertEqual(self.service.decrypt(reencrypted.encode()), "rotated")
+
+
+class FakeRedis:
+    """
+    Фейковый клиент redis с хэшами в памяти
+    """
+
+    def __init__(self) -> None:
+        self.data: dict[str, dict[bytes, bytes]] = dict()
+        self.values: dict[str, bytes] = dict()
+
+    @staticmethod
+    def _bytes(value) -> bytes:
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    def hgetall(self, key: str) -> dict:
+        return dict(self.data.get(key, dict()))
+
+    def hset(self, key: str, field=None, value=None, mapping=None) -> None:
+        items = dict(mapping or dict())
+        if field is not None:
+            items[field] = value
+        self.data.setdefault(key, dict()).update(
+            {self._bytes(name): self._bytes(item) for name, item in items.items()}
+        )
+
+    def set(self, key: str, value: bytes, ex: int | None = None) -> None:
+        self.values[key] = value
+
+    def get(self, key: str) -> bytes | None:
+        return self.values.get(key)
+
+    def expire(self, key: str, ttl: int) -> None:
+        pass
+
+    def delete(self, *keys) -> None:
+        for key in keys:
+            key = key.decode() if isinstance(key, bytes) else key
+            self.data.pop(key, None)
+            self.values.pop(key, None)
+
+    def scan_iter(self, match: str, count: int):
+        return [key.encode() for key in list(self.data) if key.startswith(match[:-1])]
+
+    def pipeline(self) -> "FakeRedis":
+        return self
+
+    def execute(self) -> None:
+        pass
+
+    def __enter__(self) -> "FakeRedis":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+class TestUserSnapshots(TestCase):
+    """
+    Тесты снимков настроек пользователей
+    """
+
+    def setUp(self) -> None:
+        self.redis = FakeRedis()
+        patcher = patch.object(user_snapshots, "_redis", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.provider = MailProvider.objects.create(
+            name="example", server="imap.example.com", port=993
+        )
+
+    def create_user(self, tg_id: int) -> User:
+        with self.captureOnCommitCallbacks(execute=True):
+            user = User.objects.create(tg_id=tg_id, first_name="user")
+            MailModel.objects.create(
+                email=f"{tg_id}@example.com",
+                password="password",
+                user=user,
+                provider=self.provider,
+            )
+        return user
+
+    def test_snapshot(self):
+        """
+        Проверка читает снимок без запросов к бд, состояние синхронизации берется из снимка,
+        а изменение отправителей пересобирает снимок
+        """
+        user = self.create_user(1)
+        with self.assertNumQueries(0):
+            data = user_snapshots.get(1)
+        self.assertEqual([mail["email"] for mail in data["mails"]], ["1@example.com"])
+        self.assertEqual(data["senders"], [])
+
+        user_snapshots.save_sync_states(
+            1, {"1@example.com": {"uid_validity": 7, "last_uid": 42}}
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            TrackedMailSender.objects.create(user=user, email="sender@a.ru")
+        with self.assertNumQueries(0):
+            data = user_snapshots.get(1)
+        self.assertEqual(data["senders"], ["sender@a.ru"])
+        self.assertEqual(data["mails"][0]["last_uid"], 42)
+        self.assertEqual(data["mails"][0]["uid_validity"], 7)
+
+        user_snapshots.clear()
+        self.assertEqual(user_snapshots.get(1)["senders"], ["sender@a.ru"])
+
+    @override_settings(SCHEDULER_MODE=SCHEDULER_PER_USER)
+    def test_inactive_user_task_disabled(self):
+        """
+        Задача пользователя включена, только пока у него есть ящики и отправители
+        """
+        user = self.create_user(2)
+        task = PeriodicTask.objects.get(name="Get_mails_tg_id:2")
+        self.assertFalse(task.enabled)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sender = TrackedMailSender.objects.create(user=user, email="sender@a.ru")
+        task.refresh_from_db()
+        self.assertTrue(task.enabled)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sender.delete()
+        task.refresh_from_db()
+        self.assertFalse(task.enabled)
+
+
+class TestSyncStateRelease(TestCase):
+    """
+    Тесты отката состояния синхронизации к письмам, возвращенным конвейером
+    """
+
+    def setUp(self) -> None:
+        patcher = patch.object(user_snapshots, "_redis", return_value=FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        provider = MailProvider.objects.create(
+            name="example", server="imap.example.com", port=993
+        )
+        user = User.objects.create(tg_id=1, first_name="user")
+        self.mail = MailModel.objects.create(
+            email="1@example.com", password="password", user=user, provider=provider
+        )
+        MailSyncState.objects.create(mail=self.mail, uid_validity=17, last_uid=10)
+
+    @staticmethod
+    def check_until(last_uid: int):
+        def run(mail_service: MailService) -> None:
+            mail_service.sync_states["1@example.com"] = {
+                "uid_validity": 17,
+                "last_uid": last_uid,
+            }
+
+        return run
+
+    def test_release_during_check(self):
+        """
+        Проверка, начатая до отката, не поднимает uid выше возвращенных писем,
+        а следующая проверка начинается с них
+        """
+
+        async def release(mail_service, mail, uids):
+            mail_service.sync_states[mail.email] = {
+                "uid_validity": 17,
+                "last_uid": min(uids) - 1,
+            }
+            return True
+
+        def overlapped(mail_service: MailService) -> None:
+            # письма 8 и 9 возвращаются в непрочитанные, пока проверка загружает 11 и 12
+            release_messages(1, "1@example.com", [9, 8])
+            self.check_until(12)(mail_service)
+
+        mails = user_snapshots.get(1)["mails"]
+        with patch.object(MailService, "release_messages", release), patch.object(
+            MailService, "run", overlapped
+        ):
+            run_check(1, mails, ["sender@a.ru"])
+
+        state = MailSyncState.objects.get(mail=self.mail)
+        self.assertEqual((state.last_uid, state.release_uid), (7, None))
+        mails = user_snapshots.get(1)["mails"]
+        self.assertEqual(mails[0]["last_uid"], 7)
+
+        with patch.object(MailService, "run", self.check_until(12)):
+            run_check(1, mails, ["sender@a.ru"])
+        self.assertEqual(MailSyncState.objects.get(mail=self.mail).last_uid, 12)
+        self.assertEqual(user_snapshots.get(1)["mails"][0]["last_uid"], 12)
+
+
+class TestMailCheckFanout(unittest.TestCase):
+    """
+    Тесты разделения проверки пользователя на задачи по ящикам
+    """
+
+    def setUp(self) -> None:
+        self.data = {
+            "mails": [
+                {"email": "a@gmail.com", "provider": {"host": "imap.gmail.com"}},
+                {"email": "b@gmail.com", "provider": {"host": "imap.gmail.com"}},
+                {"email": "c@yandex.ru", "provider": {"host": "imap.yandex.ru"}},
+            ],
+            "senders": ["sender@a.ru"],
+        }
+        patcher = patch.object(user_snapshots, "get", return_value=self.data)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(MAIL_CHECK_FANOUT="host", MAIL_CHECK_FANOUT_MIN_MAILBOXES=2)
+    def test_fan_out_by_host(self):
+        """
+        Пользователь с несколькими ящиками проверяется задачами по imap-серверам
+        """
+        with patch("app_celery.tasks.group") as task_group:
+            self.assertEqual(check_user(1), {"fanout": 2})
+        signatures = list(task_group.call_args.args[0])
+        self.assertEqual(
+            [signature.kwargs for signature in signatures],
+            [
+                {
+                    "tg_id": 1,
+                    "emails": ["a@gmail.com", "b@gmail.com"],
+                    "key": "imap.gmail.com",
+                },
+                {"tg_id": 1, "emails": ["c@yandex.ru"], "key": "imap.yandex.ru"},
+            ],
+        )
+        task_group.return_value.apply_async.assert_called_once()
+
+    @override_settings(MAIL_CHECK_FANOUT="mailbox", MAIL_CHECK_FANOUT_MIN_MAILBOXES=5)
+    def test_small_user_checked_inline(self):
+        """
+        Пользователь с небольшим числом ящиков проверяется в одной задаче
+        """
+        with patch("app_celery.tasks.run_check", return_value=dict()) as run_check:
+            self.assertEqual(check_user(1), dict())
+        run_check.assert_called_once_with(
+            1, self.data["mails"], ["sender@a.ru"], PLAIN_TEXT_BROWSER
+        )
+
+    def test_mailbox_task(self):
+        """
+        Задача группы проверяет только свои ящики, ошибки групп объединяются
+        """
+        with patch(
+            "app_celery.tasks.run_check", return_value={"auth": ["c@yandex.ru"]}
+        ) as run_check:
+            errors = get_new_mail_mailboxes(tg_id=1, emails=["c@yandex.ru"], key="c")
+        run_check.assert_called_once_with(
+            1, self.data["mails"][2:], ["sender@a.ru"], PLAIN_TEXT_BROWSER
+        )
+        self.assertEqual(
+            collect_mail_errors([errors, None, {"auth": ["a@gmail.com"]}], tg_id=1),
+            {"auth": ["c@yandex.ru", "a@gmail.com"]},
+        )
+
+
+class TestMailPipeline(unittest.TestCase):
+    """
+    Тесты конвейера обработки писем по очередям io, render и deliver
+    """
+
+    def test_message_store(self):
+        """
+        Данные передаются ссылкой на redis или, без него, в самой ссылке
+        """
+        inline_store = MessageStore()
+        ref = inline_store.put(b"<html></html>")
+        self.assertEqual(inline_store.get(ref), b"<html></html>")
+
+        redis_store = MessageStore(url="redis://test")
+        redis_store._client = FakeRedis()  # type: ignore
+        ref = redis_store.put(b"png")
+        self.assertTrue(ref.startswith("redis:"))
+        self.assertEqual(redis_store.get(ref), b"png")
+        redis_store.delete([ref])
+        with self.assertRaises(KeyError):
+            redis_store.get(ref)
+
+    def test_hand_off_to_render(self):
+        """
+        Загруженные письма ящика передаются одной задачей рендера и считаются отправленными
+        """
+        service = PipelineMailService(
+            [],
+            [],
+            save_screen=False,
+            date=datetime.now(),
+            send_method=FakeMailSender(user_id=1),
+            store=MessageStore(),
+        )
+
+        async def check():
+            await service.generate_screenshot("<p>2</p>", "a@example.com", 2)
+            await service.generate_screenshot("<p>1</p>", "a@example.com", 1)
+            await service._send_rendered("a@example.com")
+
+        with patch("app_celery.pipeline.celery_app.send_task") as send_task:
+            asyncio.run(check())
+        self.assertEqual(service.sent_uids, {"a@example.com": {1, 2}})
+        kwargs = send_task.call_args.kwargs["kwargs"]
+        self.assertEqual(send_task.call_args.args, ("render_mails",))
+        self.assertEqual([uid for uid, *_ in kwargs["messages"]], [1, 2])
+        self.assertEqual(service.store.get(kwargs["messages"][0][1]), b"<p>1</p>")
+
+    def test_deliver_retries_failed_subset(self):
+        """
+        Повторно ставятся в очередь только неотправленные скриншоты, после последней
+        попытки письма возвращаются в непрочитанные, а пользователь получает предупреждение
+        """
+        store = MessageStore()
+        screenshots = [[1, store.put(b"one"), None], [2, store.put(b"two"), None]]
+        sender = FakeMailSender(user_id=1)
+        sender.send_album = AsyncMock(return_value=[True, False])  # type: ignore
+        sender.send_warning = AsyncMock(return_value=True)  # type: ignore
+
+        with patch("app_celery.tasks.message_store", store), patch(
+            "app_celery.tasks.MailSender", return_value=sender
+        ), patch("app_celery.tasks.celery_app.send_task") as send_task:
+            result = deliver_screenshots(1, "a@example.com", screenshots)
+            self.assertEqual(result, {"sent": 1, "failed": 1})
+            kwargs = send_task.call_args.kwargs["kwargs"]
+            self.assertEqual(kwargs["screenshots"], screenshots[1:])
+            self.assertEqual(kwargs["attempt"], 2)
+            sender.send_warning.assert_not_called()
+
+            sender.send_photo = AsyncMock(return_value=False)  # type: ignore
+            send_task.reset_mock()
+            with patch("app_celery.tasks.release_messages") as release_messages:
+                deliver_screenshots(
+                    1,
+                    "a@example.com",
+                    screenshots[1:],
+                    attempt=settings.MAIL_PIPELINE_MAX_ATTEMPTS,
+                )
+        send_task.assert_not_called()
+        sender.send_warning.assert_called_once()
+        release_messages.assert_called_with(1, "a@example.com", [2])
+
+
+class FakeRenderer(AbstractRenderer):
+    """
+    Фейковый рендер, возвращающий html письма вместо скриншота
+    """
+
+    def __init__(self) -> None:
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def render(self, content: str) -> bytes:
+        await self.release.wait()
+        return content.encode()
+
+
+class TestRenderService(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты сервиса рендера и его клиента
+    """
+
+    async def asyncSetUp(self) -> None:
+        self.socket_dir = tempfile.TemporaryDirectory()
+        self.url = f"unix://{self.socket_dir.name}/render.sock"
+        self.renderer = FakeRenderer()
+        self.server = RenderServer(self.renderer, concurrency=1, queue_size=1)
+        self.serve_task = asyncio.create_task(self.server.serve(self.url))
+        while not os.path.exists(self.url[len("unix://") :]):  # noqa: E203
+            await asyncio.sleep(0.01)
+        self.client = RemoteRenderer(url=self.url, timeout=5)
+
+    async def asyncTearDown(self) -> None:
+        await self.client.close()
+        self.serve_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self.serve_task
+        self.socket_dir.cleanup()
+
+    async def test_remote_render(self):
+        """
+        Клиент получает скриншот от сервиса через unix-сокет
+        """
+        self.assertEqual(
+            await self.client.render("<p>тест</p>"), "<p>тест</p>".encode()
+        )
+
+    async def test_remote_partial_render(self):
+        """
+        Клиент получает признак скриншота, загрузка письма которого остановлена по сроку
+        """
+        self.renderer.render = AsyncMock(  # type: ignore
+            return_value=PartialScreenshot(b"part")
+        )
+        screenshot = await self.client.render("<p>1</p>")
+        self.assertEqual(screenshot, b"part")
+        self.assertIsInstance(screenshot, PartialScreenshot)
+
+    async def test_full_queue_rejected(self):
+        """
+        Запросы сверх concurrency и queue_size сразу отклоняются
+        """
+        self.renderer.release.clear()
+        renders = [asyncio.create_task(self.client.render(str(i))) for i in range(2)]
+        while self.server.active + self.server.waiting < 2:
+            await asyncio.sleep(0.01)
+
+        with self.assertRaisesRegex(RenderError, "503"):
+            await self.client.render("2")
+
+        self.renderer.release.set()
+        self.assertEqual(await asyncio.gather(*renders), [b"0", b"1"])
+
+    async def test_queue_slot_taken_before_body(self):
+        """
+        Место в очереди занимается до чтения тела запроса,
+        поэтому запросы с медленно передаваемым телом не превышают queue_size
+        """
+        body_received = asyncio.Event()
+
+        async def text() -> str:
+            await body_received.wait()
+            return "0"
+
+        first = asyncio.create_task(self.server.render(Mock(text=text)))
+        while not self.server.waiting:
+            await asyncio.sleep(0.01)
+        response = await self.server.render(Mock(text=text))
+        self.assertEqual(response.status, 503)
+
+        body_received.set()
+        self.assertEqual((await first).body, b"0")
+        self.assertEqual(self.server.waiting, 0)
+
+
+class TestRenderCache(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты кэша скриншотов по содержимому писем
+    """
+
+    async def asyncSetUp(self) -> None:
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.renderer = FakeRenderer()
+        self.renderer.render = AsyncMock(wraps=self.renderer.render)  # type: ignore
+        self.cache = DiskRenderCache(self.cache_dir.name, max_bytes=10)
+        self.cached = CachedRenderer(self.renderer, self.cache)
+
+    async def asyncTearDown(self) -> None:
+        self.cache_dir.cleanup()
+
+    def test_cache_requires_header_caption(self):
+        """
+        Кэш с заголовком внутри скриншота включается с предупреждением:
+        скриншоты разных получателей не совпадают
+        """
+        with override_settings(
+            RENDER_CACHE="disk",
+            RENDER_CACHE_DIR=self.cache_dir.name,
+            RENDER_HEADER="inline",
+        ), self.assertLogs(level="WARNING"):
+            self.assertIsInstance(with_render_cache(self.renderer), CachedRenderer)
+
+    async def test_identical_content_rendered_once(self):
+        """
+        Одинаковое содержимое рендерится один раз, в том числе при одновременных рендерах
+        """
+        self.renderer.release.clear()
+        renders = [
+            asyncio.create_task(self.cached.render(content))
+            for content in ("<p>1</p>", "<p>1</p>\r\n")
+        ]
+        await asyncio.sleep(0)
+        self.renderer.release.set()
+        self.assertEqual(await asyncio.gather(*renders), [b"<p>1</p>"] * 2)
+        self.assertEqual(await self.cached.render("<p>1</p>"), b"<p>1</p>")
+        self.assertEqual(self.renderer.render.await_count, 1)
+
+    async def test_partial_screenshot_not_cached(self):
+        """
+        Скриншот письма, загрузка которого остановлена по сроку, не сохраняется в кэш
+        """
+        self.renderer.render.return_value = PartialScreenshot(b"part")
+        for _ in range(2):
+            self.assertEqual(await self.cached.render("<p>1</p>"), b"part")
+        self.assertEqual(self.renderer.render.await_count, 2)
+        self.assertIsNone(self.cache.get(content_key("<p>1</p>")))
+
+    async def test_lru_eviction(self):
+        """
+        При превышении размера вытесняются давно не использованные скриншоты
+        """
+        for content in ("aaaa", "bbbb"):
+            await self.cached.render(content)
+        os.utime(self.cache._path(content_key("aaaa")), (0, 0))
+        await self.cached.render("cccc")
+        self.assertIsNone(self.cache.get(content_key("aaaa")))
+        self.assertEqual(self.cache.get(content_key("bbbb")), b"bbbb")
+
+    async def test_header_in_caption(self):
+        """
+        В режиме caption отправитель и получатель передаются подписью,
+        а не в содержимом рендера
+        """
+        mail_service = MailService(
+            [],
+            [],
+            send_method=FakeMailSender(),
+            renderer=self.cached,
+            header_mode=HEADER_CAPTION,
+        )
+        mail_service.mail_sender_service.send_photo = AsyncMock(  # type: ignore
+            return_value=True
+        )
+        mail_service.fetch_mode = "rfc822"
+        mail_service._fetch_whole_messages = AsyncMock(  # type: ignore
+            return_value={1: "<p>news</p>"}
+        )
+        await mail_service.get_mails({1: "shop@example.com"}, "user@example.com")
+        await asyncio.gather(*mail_service.mail_list)
+        mail_service.mail_sender_service.send_photo.assert_awaited_once_with(
+            b"<p>news</p>", "From: shop@example.com\nTo: user@example.com"
+        )
+
+
+class TestRenderScheduler(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты очереди рендеров процесса
+    """
+
+    async def test_backpressure(self):
+        """
+        Когда очередь заполнена, постановка рендера ожидает завершения одного из рендеров
+        """
+        scheduler = RenderScheduler(concurrency=1, queue_size=1)
+        release = asyncio.Event()
+
+        async def render(result: int) -> int:
+            await release.wait()
+            return result
+
+        tasks = [await scheduler.submit(render, i) for i in range(2)]
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.stats()["active"], 1)
+        self.assertEqual(scheduler.stats()["queued"], 1)
+
+        backpressure = metrics.get("render_scheduler.backpressure")
+        third = asyncio.create_task(scheduler.submit(render, 2))
+        await asyncio.sleep(0.01)
+        self.assertFalse(third.done())
+        self.assertEqual(metrics.get("render_scheduler.backpressure"), backpressure + 1)
+
+        release.set()
+        tasks.append(await third)
+        self.assertEqual(await asyncio.gather(*tasks), [0, 1, 2])
+        self.assertEqual(scheduler.stats()["active"], 0)
+
+    async def test_render_stage(self):
+        """
+        Этап render конвейера ставит рендеры в очередь процесса, а не запускает все сразу
+        """
+        scheduler = RenderScheduler(concurrency=1, queue_size=1)
+        renderer = FakeRenderer()
+        renderer.release.clear()
+        stage = asyncio.create_task(
+            render_messages([(uid, str(uid)) for uid in range(3)], renderer, scheduler)
+        )
+        await asyncio.sleep(0.01)
+        self.assertEqual(scheduler.stats()["active"], 1)
+        self.assertEqual(scheduler.stats()["queued"], 1)
+
+        renderer.release.set()
+        self.assertEqual(await stage, {0: b"0", 1: b"1", 2: b"2"})
+
+
+class TestAssetPolicy(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты политики загрузки внешних ресурсов писем
+    """
+
+    @staticmethod
+    def _route(url: str) -> MagicMock:
+        response = MagicMock(status=200, ok=True, headers={"content-type": "image/png"})
+        response.body = AsyncMock(return_value=b"png")
+        route = MagicMock()
+        route.request.url = url
+        route.fetch = AsyncMock(return_value=response)
+        route.fulfill = AsyncMock()
+        route.abort = AsyncMock()
+        route.continue_ = AsyncMock()
+        return route
+
+    async def test_block(self):
+        """
+        Внешние ресурсы блокируются, data: url загружаются
+        """
+        policy = AssetPolicy(mode="block")
+        remote, inline = self._route("https://t.example.com/pixel.gif"), self._route(
+            "data:image/png;base64,aGVsbG8="
+        )
+        for route in (remote, inline):
+            await policy._handle(route, deadline=time.monotonic() + 1)
+        remote.abort.assert_awaited_once_with("blockedbyclient")
+        inline.continue_.assert_awaited_once()
+
+    async def test_cache(self):
+        """
+        Ресурс загружается один раз и затем отдается из кэша
+        """
+        policy = AssetPolicy(mode="cache", cache=AssetCache(max_bytes=1024))
+        first, second = self._route("https://cdn/logo.png"), self._route(
+            "https://cdn/logo.png"
+        )
+        for route in (first, second):
+            await policy._handle(route, deadline=time.monotonic() + 1)
+        first.fetch.assert_awaited_once()
+        second.fetch.assert_not_called()
+        second.fulfill.assert_awaited_once_with(
+            status=200, headers={"content-type": "image/png"}, body=b"png"
+        )
+
+    async def test_budget_exceeded(self):
+        """
+        После исчерпания бюджета рендера ресурсы не загружаются
+        """
+        policy = AssetPolicy(mode="fetch")
+        route = self._route("https://slow.example.com/font.woff")
+        await policy._handle(route, deadline=time.monotonic() - 1)
+        route.fetch.assert_not_called()
+        route.abort.assert_awaited_once_with("timedout")
+
+    def test_cache_eviction(self):
+        """
+        Кэш ресурсов вытесняет давно не использованные ресурсы
+        """
+        cache = AssetCache(max_bytes=8)
+        cache.put("a", 200, dict(), b"aaaa")
+        cache.put("b", 200, dict(), b"bbbb")
+        cache.get("a")
+        cache.put("c", 200, dict(), b"cccc")
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertEqual(cache.size, 8)
+
+
+class TestRemoteRenderImports(unittest.TestCase):
+    """
+    Тесты воркеров с сервисом рендера, на которых не установлен playwright
+    """
+
+    def test_tasks_without_playwright(self):
+        """
+        Задачи и хуки остановки воркера загружаются без playwright и пула браузеров
+        """
+        code = (
+            "import sys\n"
+            "sys.modules['playwright'] = None\n"
+            "import django\n"
+            "django.setup()\n"
+            "import app_celery.signals, app_celery.tasks\n"
+            "assert 'app_celery.browser_pool' not in sys.modules\n"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=settings.BASE_DIR,
+            env={
+                **os.environ,
+                "DJANGO_SETTINGS_MODULE": "email_sender.settings",
+                "RENDER_BACKEND": "remote",
+            },
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+class TestBrowserRenderer(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты загрузки письма в страницу перед скриншотом
+    """
+
+    def setUp(self) -> None:
+        self.render_pool = FakeRenderPool()
+        self.page = MagicMock()
+        self.page.set_content = AsyncMock()
+        self.page.wait_for_load_state = AsyncMock()
+        self.page.evaluate = AsyncMock()
+        self.page.screenshot = AsyncMock(return_value=b"png")
+
+        @asynccontextmanager
+        async def page():
+            yield self.page
+
+        self.render_pool.page = page  # type: ignore
+
+    async def test_wait_phases(self):
+        """
+        Письмо загружается по фазам до wait_until
+        """
+        renderer = BrowserRenderer(self.render_pool, wait_until="networkidle")
+        screenshot = await renderer.render("<p>1</p>")
+        self.assertEqual(screenshot, b"png")
+        self.assertNotIsInstance(screenshot, PartialScreenshot)
+        self.assertEqual(
+            self.page.set_content.await_args.kwargs["wait_until"], "domcontentloaded"
+        )
+        self.assertEqual(
+            [call.args[0] for call in self.page.wait_for_load_state.await_args_list],
+            ["load", "networkidle"],
+        )
+
+    async def test_deadline(self):
+        """
+        По истечении срока загрузка останавливается и снимается скриншот отрисованного,
+        который помечается как неполный
+        """
+        self.page.wait_for_load_state.side_effect = PlaywrightTimeoutError("timeout")
+        exceeded = metrics.get("render.deadline_exceeded.load")
+        renderer = BrowserRenderer(self.render_pool, wait_until="load", deadline=0.1)
+        screenshot = await renderer.render("<p>1</p>")
+        self.assertEqual(screenshot, b"png")
+        self.assertIsInstance(screenshot, PartialScreenshot)
+        self.page.evaluate.assert_awaited_once_with("window.stop()")
+        self.assertEqual(metrics.get("render.deadline_exceeded.load"), exceeded + 1)
+
+    def test_unknown_wait_condition(self):
+        with self.assertRaises(ValueError):
+            BrowserRenderer(self.render_pool, wait_until="idle")
+
+
+class TestPlainTextMails(unittest.IsolatedAsyncioTestCase):
+    """
+    Тесты отображения писем только с text/plain без браузера
+    """
+
+    raw_message = (
+        b"From: shop@example.com\r\n"
+        b"Content-Type: text/plain; charset=utf-8\r\n\r\n"
+        b"Order <42>\r\nis ready\r\n"
+    )
+
+    def make_service(self, plain_text_mode: str, **kwargs) -> MailService:
+        mail_service = MailService(
+            [],
+            [],
+            send_method=FakeMailSender(),
+            renderer=Mock(spec=AbstractRenderer, render=AsyncMock()),
+            plain_text_mode=plain_text_mode,
+            fetch_mode="rfc822",
+            **kwargs,
+        )
+        mail_service.imap_client = MagicMock()
+        mail_service.imap_client.uid = AsyncMock(
+            return_value=Response(
+                "OK",
+                [
+                    b"1 FETCH (UID 1 RFC822 {%d}" % len(self.raw_message),
+                    self.raw_message,
+                    b")",
+                    b"FETCH completed",
+                ],
+            )
+        )
+        return mail_service
+
+    async def test_message_mode(self):
+        """
+        Текстовое письмо отправляется сообщением без рендера
+        """
+        mail_service = self.make_service(PLAIN_TEXT_MESSAGE)
+        mail_service.mail_sender_service.send_text = AsyncMock(  # type: ignore
+            return_value=True
+        )
+        await mail_service.get_mails({1: "shop@example.com"}, "user@example.com")
+        await asyncio.gather(*mail_service.mail_list)
+
+        mail_service.mail_sender_service.send_text.assert_awaited_once_with(
+            "From: shop@example.com\nTo: user@example.com\n\nOrder <42>\r\nis ready\r\n"
+        )
+        mail_service.renderer.render.assert_not_awaited()  # type: ignore
+        self.assertEqual(mail_service.sent_uids, {"user@example.com": {1}})
+
+    async def test_browser_mode_escapes_text(self):
+        """
+        В режиме browser текст письма экранируется и сохраняет переносы строк
+        """
+        mail_service = self.make_service(PLAIN_TEXT_BROWSER)
+        mail_service.generate_screenshot = AsyncMock()  # type: ignore
+        await mail_service.get_mails({1: "shop@example.com"}, "user@example.com")
+        await asyncio.gather(*mail_service.mail_list)
+
+        content = mail_service.generate_screenshot.await_args.args[0]
+        self.assertIn("<pre", content)
+        self.assertIn("Order &lt;42&gt;", content)
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    async def test_image_mode(self):
+        """
+        В режиме image текст письма рисуется без браузера, отправитель - в подписи
+        """
+        mail_service = self.make_service(PLAIN_TEXT_IMAGE, header_mode=HEADER_CAPTION)
+        mail_service.mail_sender_service.send_photo = AsyncMock(  # type: ignore
+            return_value=True
+        )
+        await mail_service.get_mails({1: "shop@example.com"}, "user@example.com")
+        await asyncio.gather(*mail_service.mail_list)
+
+        (
+            screenshot,
+            caption,
+        ) = mail_service.mail_sender_service.send_photo.await_args.args
+        self.assertEqual(image_format(screenshot), "png")
+        self.assertEqual(caption, "From: shop@example.com\nTo: user@example.com")
+        mail_service.renderer.render.assert_not_awaited()  # type: ignore
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_text_wrap(self):
+        """
+        Строки переносятся по ширине изображения, длинные слова разрываются
+        """
+        text_renderer = TextRenderer(width=200, padding=10)
+        font = text_renderer.font()
+        lines = text_renderer.wrap("word " * 30 + "\n" + "x" * 200, font)
+        self.assertGreater(len(lines), 3)
+        for line in lines:
+            self.assertLessEqual(font.getlength(line), 180)
+        self.assertEqual("".join(line for line in lines if "x" in line), "x" * 200)
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_text_max_lines(self):
+        """
+        Высота изображения ограничена max_lines строками, остаток письма отбрасывается
+        """
+        text_renderer = TextRenderer(font_size=10, padding=10, max_lines=5)
+        screenshot = text_renderer.render_sync("line\n" * 100)
+        height = Image.open(io.BytesIO(screenshot)).height
+        self.assertEqual(height, 10 * 2 + text_renderer.line_height * 5)
+
+    def test_split_message(self):
+        """
+        Длинный текст делится на сообщения по строкам не длиннее лимита
+        """
+        messages = split_message("line\n" * 10 + "y" * 25, limit=20)
+        self.assertTrue(all(len(message) <= 20 for message in messages))
+        self.assertEqual("".join(messages), "line\n" * 10 + "y" * 25)
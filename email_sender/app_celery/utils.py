@@ -1,6 +1,10 @@
 import time
 
-from api.models import Mail, TrackedMailSender, User
+from api.models import Mail, MailSyncState, TrackedMailSender, User
+from django.db import transaction
+from django.db.models import Prefetch
+from django.db.models.functions import Abs, Mod
+from django.utils import timezone
 
 STATE_AUTH = "AUTH"
 MAIL_FOLDER = "all_mails"
@@ -23,10 +27,164 @@ def get_data_by_tg_id(tg_id: int) -> dict:
     """
     Функция-адаптер для получения из бд, преобразования данных и передачи их в MailService
     """
-    user = User.objects.filter(tg_id=tg_id).only("id").first()
-    q_mails = Mail.objects.select_related("provider").filter(user_id=user.id)
+    user = User.objects.filter(tg_id=tg_id).only("id", "plain_text_mode").first()
+    if user is None:
+        return {"mails": [], "senders": []}
+    q_mails = Mail.objects.select_related("provider", "sync_state").filter(
+        user_id=user.id
+    )
     q_senders = TrackedMailSender.objects.filter(user_id=user.id).values("email")
     return {
         "mails": [mail.to_json() for mail in q_mails],
         "senders": [item["email"] for item in q_senders],
+        "plain_text_mode": user.plain_text_mode,
     }
+
+
+def shard_of(tg_id: int, shards: int) -> int:
+    """Номер шарда планировщика, к которому относится пользователь"""
+    return abs(tg_id) % shards
+
+
+def get_active_users():
+    """
+    Пользователи, у которых есть почтовые ящики и отслеживаемые отправители
+    """
+    return User.objects.filter(
+        mail__isnull=False, trackedmailsender__isnull=False
+    ).distinct()
+
+
+def get_shard_data(shard: int, shards: int) -> list[dict]:
+    """
+    Функция-адаптер для получения из бд данных всех пользователей шарда,
+    у которых есть почтовые ящики и отслеживаемые отправители.
+    Ящики и отправители загружаются для всех пользователей шарда сразу, а не по одному.
+
+    :param shard: int - номер шарда
+    :param shards: int - число шардов
+    :return: list - [{"tg_id": ..., "mails": [...], "senders": [...], "plain_text_mode": ...}, ...]
+    """
+    users = (
+        get_active_users()
+        .annotate(shard=Mod(Abs("tg_id"), shards))
+        .filter(shard=shard)
+        .only("id", "tg_id", "plain_text_mode")
+        .prefetch_related(
+            Prefetch(
+                "mail_set",
+                queryset=Mail.objects.select_related("provider", "sync_state"),
+            ),
+            Prefetch(
+                "trackedmailsender_set",
+                queryset=TrackedMailSender.objects.only("user_id", "email"),
+            ),
+        )
+    )
+    return [
+        {
+            "tg_id": user.tg_id,
+            "mails": [mail.to_json() for mail in user.mail_set.all()],
+            "senders": [sender.email for sender in user.trackedmailsender_set.all()],
+            "plain_text_mode": user.plain_text_mode,
+        }
+        for user in users
+    ]
+
+
+def get_tracked_mailboxes() -> list[dict]:
+    """
+    Функция-адаптер для получения из бд всех почтовых ящиков пользователей,
+    у которых есть хотя бы один отслеживаемый отправитель.
+
+    :return: list - [{"tg_id": ..., "mail": {...}, "senders": [...], "plain_text_mode": ...}, ...]
+    """
+    senders: dict[int, list[str]] = dict()
+    for item in TrackedMailSender.objects.values("user_id", "email"):
+        senders.setdefault(item["user_id"], []).append(item["email"])
+
+    q_mails = Mail.objects.select_related("provider", "user", "sync_state").filter(
+        user_id__in=senders.keys()
+    )
+    return [
+        {
+            "tg_id": mail.user.tg_id,
+            "mail": mail.to_json(),
+            "senders": senders[mail.user_id],
+            "plain_text_mode": mail.user.plain_text_mode,
+        }
+        for mail in q_mails
+    ]
+
+
+def save_sync_states(
+    sync_states: dict[str, dict], from_uids: dict[str, int] | None = None
+) -> dict[str, dict]:
+    """
+    Функция сохранения состояния синхронизации почтовых ящиков после проверки.
+    Если во время проверки письма были возвращены в непрочитанные (release_sync_states),
+    а проверка начиналась с uid не меньше первого из них, она их пропустила,
+    поэтому сохраненный uid не поднимается выше отката.
+
+    :param sync_states: dict - {email: {"uid_validity": ..., "last_uid": ...}}
+    :param from_uids: dict - {email: последний обработанный uid на начало проверки}
+    :return: dict - сохраненные состояния синхронизации в формате sync_states
+    """
+    checked_at = timezone.now()
+    from_uids = from_uids or dict()
+    saved: dict[str, dict] = dict()
+    with transaction.atomic():
+        mails = list(
+            Mail.objects.filter(email__in=sync_states.keys()).only("id", "email")
+        )
+        released = {
+            state.mail_id: state
+            for state in MailSyncState.objects.select_for_update().filter(
+                mail__in=mails, release_uid__isnull=False
+            )
+        }
+        for mail in mails:
+            state = dict(sync_states[mail.email])
+            pending = released.get(mail.id)
+            if (
+                pending is not None
+                and pending.uid_validity == state["uid_validity"]
+                and from_uids.get(mail.email, 0) >= pending.release_uid
+            ):
+                state["last_uid"] = min(state["last_uid"], pending.release_uid - 1)
+            MailSyncState.objects.update_or_create(
+                mail=mail,
+                defaults={**state, "last_checked_at": checked_at, "release_uid": None},
+            )
+            saved[mail.email] = state
+    return saved
+
+
+def release_sync_states(sync_states: dict[str, dict]) -> dict[str, dict]:
+    """
+    Функция отката состояния синхронизации почтовых ящиков к письмам, возвращенным
+    в непрочитанные. Первый возвращенный uid запоминается до следующего сохранения
+    состояния проверкой, чтобы проверка, начатая до отката, не сдвинула uid обратно.
+
+    :param sync_states: dict - {email: {"uid_validity": ..., "last_uid": ...}}
+    :return: dict - сохраненные состояния синхронизации в формате sync_states
+    """
+    saved: dict[str, dict] = dict()
+    with transaction.atomic():
+        states = MailSyncState.objects.select_for_update().filter(
+            mail__email__in=sync_states.keys()
+        )
+        for state in states.select_related("mail"):
+            release = sync_states[state.mail.email]
+            # после смены UIDVALIDITY uid писем относятся к прежнему содержимому ящика
+            if state.uid_validity != release["uid_validity"]:
+                continue
+            release_uid = release["last_uid"] + 1
+            state.last_uid = min(state.last_uid, release["last_uid"])
+            state.release_uid = min(state.release_uid or release_uid, release_uid)
+            state.save(update_fields=["last_uid", "release_uid"])
+            saved[state.mail.email] = {
+                "uid_validity": state.uid_validity,
+                "last_uid": state.last_uid,
+            }
+    return saved